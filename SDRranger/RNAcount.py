@@ -7,15 +7,20 @@ import tempfile
 import numpy as np
 import subprocess
 import shutil
+import time
 import scipy
 from . import misc
+from . import encoding
+from . import read_table
+from . import cell_index
+from . import saturation
+from . import dedup
+from . import manifest
+from . import star
 from Bio import SeqIO
 from collections import defaultdict, Counter
-from functools import partial
-from multiprocessing import Pool
-from scipy.sparse import lil_matrix
 from .bc_aligner import CustomBCAligner
-from .umi import get_umi_maps_from_bam_file
+from .umi import iter_reads_with_corrected_umis
 
 
 log = logging.getLogger(__name__)
@@ -25,28 +30,17 @@ pysam.set_verbosity(0)
 n_first_seqs = 10000  # n seqs for finding score threshold
 
 
-def process_RNA_fastqs(arguments):
+def process_RNA_fastqs(arguments, genome=None, count=True):
     """
     Output single file with parsed bcs from bc_fastq in read names and seqs from paired_fastq.
+
+    With a star.SharedGenome, the lanes are aligned with that genome, as in count_all, instead of
+    one loaded for this run. Without count, the run stops at the sorted bam, as in scatter_RNA.
     """
     star_w_bc_fpath = os.path.join(arguments.output_dir, 'RNA_with_bc.bam')
     star_w_bc_sorted_fpath = os.path.join(arguments.output_dir, 'RNA_with_bc.sorted.bam')
-    star_w_bc_umi_fpath = os.path.join(arguments.output_dir, 'RNA_with_bc_umi.bam')
     star_w_bc_umi_sorted_fpath = os.path.join(arguments.output_dir, 'RNA_with_bc_umi.sorted.bam')
-    if os.path.exists(star_w_bc_umi_sorted_fpath):
-        log.info('Sorted bam with UMIs found. Skipping ahead...')
-        completed = 4
-    elif os.path.exists(star_w_bc_umi_fpath):
-        log.info('Corrected UMI file found. Skipping ahead...')
-        completed = 3
-    elif os.path.exists(star_w_bc_sorted_fpath):
-        log.info('Sorted STAR results found. Skipping ahead...')
-        completed = 2
-    elif os.path.exists(star_w_bc_fpath):
-        log.info('STAR results found. Skipping ahead...')
-        completed = 1
-    else:
-        completed = 0
+    dedup_fpath = os.path.join(arguments.output_dir, 'RNA_with_bc_umi.dedup.sorted.bam') if arguments.dedup_bam else None
 
     if not os.path.exists(arguments.output_dir):
         os.makedirs(arguments.output_dir)
@@ -59,24 +53,64 @@ def process_RNA_fastqs(arguments):
         if i < len(paired_fpaths)-1:
             log.info('  -')
 
+    run_manifest = manifest.RunManifest(
+            arguments.output_dir,
+            'RNA',
+            [fpath for fpaths in paired_fpaths for fpath in fpaths] + list(arguments.star_output_path or []),
+            manifest.config_hash(arguments, ['cb_id_tag']))
+    if run_manifest.is_done('umis', [star_w_bc_umi_sorted_fpath, star_w_bc_umi_sorted_fpath + '.bai']):
+        log.info('Sorted bam with UMIs found. Skipping ahead...')
+        completed = 3
+    elif run_manifest.is_done('sort', [star_w_bc_sorted_fpath, star_w_bc_sorted_fpath + '.bai']):
+        log.info('Sorted STAR results found. Skipping ahead...')
+        completed = 2
+    elif run_manifest.is_done('barcodes', [star_w_bc_fpath]):
+        log.info('STAR results found. Skipping ahead...')
+        completed = 1
+    else:
+        completed = 0
+
+    unsorted_fpaths = [star_w_bc_fpath]
     if completed < 1:
         bc_fq_idx, paired_fq_idx = misc.determine_bc_and_paired_fastq_idxs(paired_fpaths, arguments.config)
         log.info(f'Detected barcodes in read{bc_fq_idx+1} files')
 
-        paired_fq_bam_fpaths = []
         namepairidxs = []
-        if not arguments.star_output_path:
+        background = False
+        # Lanes aligned in this run share one genome loaded into shared memory
+        genome = genome or star.SharedGenome(
+                arguments.star_ref_dir,
+                os.path.join(arguments.output_dir, 'STAR_files', 'genome_'),
+                enabled=not arguments.star_output_path and len(paired_fpaths) > 1)
+        if arguments.stream_STAR:
+            # STAR aligns each lane while its output is parsed, each with part of the threads.
+            star_threads, parse_threads, overlap = misc.lane_threads(arguments.threads, len(paired_fpaths), streamed=True)
+            log.info(f'Aligning with {star_threads} threads while parsing barcodes of the STAR output with {parse_threads}')
+            paired_fq_bam_fpaths = []
+            for tup_fastq_fpaths in paired_fpaths:
+                namepairidxs.append(misc.get_namepair_index(tup_fastq_fpaths[bc_fq_idx], tup_fastq_fpaths[paired_fq_idx]))
+                paired_fq_bam_fpaths.append((tup_fastq_fpaths[bc_fq_idx], tup_fastq_fpaths[paired_fq_idx]))
+        elif not arguments.star_output_path:
+            # STAR aligns the lanes one after another in the background while the barcodes of
+            # aligned lanes are parsed, each with part of the threads.
+            star_threads, parse_threads, overlap = misc.lane_threads(arguments.threads, len(paired_fpaths))
             log.info(f'Running STAR alignment...')
+            if overlap:
+                log.info(f'Aligning with {star_threads} threads while parsing barcodes with {parse_threads}')
+            bc_fq_fpaths = []
+            star_args = []
             for tup_fastq_fpaths in paired_fpaths:
                 bc_fq_fpath = tup_fastq_fpaths[bc_fq_idx]
                 paired_fq_fpath = tup_fastq_fpaths[paired_fq_idx]
 
                 namepairidxs.append(misc.get_namepair_index(bc_fq_fpath, paired_fq_fpath))
-
-                log.info(f'  {paired_fq_fpath}')
-                star_out_dir, star_out_fpath = run_STAR_RNA(arguments, paired_fq_fpath)
-                paired_fq_bam_fpaths.append((bc_fq_fpath, star_out_fpath))
+                bc_fq_fpaths.append(bc_fq_fpath)
+                star_args.append((arguments, paired_fq_fpath, run_manifest, star_threads, genome))
+            paired_fq_bam_fpaths = zip(bc_fq_fpaths, misc.background_imap(STAR_RNA_wrapper, star_args, overlap))
+            background = overlap
         else:
+            parse_threads = arguments.threads
+            paired_fq_bam_fpaths = []
             log.info(f'Using STAR results from {arguments.star_output_path}')
             for fpaths, bampath in zip(sorted(paired_fpaths, key=lambda x: x[bc_fq_idx]), arguments.star_output_path, strict=True):
                 paired_fq_bam_fpaths.append((fpaths[bc_fq_idx], bampath))
@@ -84,52 +118,115 @@ def process_RNA_fastqs(arguments):
         log.info('Writing output to:')
         log.info(f'  {star_w_bc_fpath}')
     
-        template_bam = paired_fq_bam_fpaths[0][1]
-        process_fastqs_func = partial(serial_process_RNA_fastqs, sameorder=not arguments.star_output_path) if arguments.threads == 1 else parallel_process_RNA_fastqs
-        with pysam.AlignmentFile(star_w_bc_fpath, 'wb', template=pysam.AlignmentFile(template_bam)) as star_w_bc_fh:
-            for (bc_fq_fpath, star_raw_fpath), namepairidx in zip(paired_fq_bam_fpaths, namepairidxs):
+        # Each lane is parsed into its own bam file, in chunks that a rerun resumes after. Feature
+        # extents are only saved if all reads were parsed in this run. With streamed STAR output,
+        # the paired fastq is aligned while the lane is parsed.
+        extents = misc.FeatureExtentRecorder()
+        extents_complete = True
+        lane_bam_fpaths = []
+        with genome, misc.lane_worker_pool(parse_threads, arguments.config, background):
+            for (bc_fq_fpath, paired_fpath), namepairidx in zip(paired_fq_bam_fpaths, namepairidxs):
+                lane_bam_fpath = os.path.join(arguments.output_dir, f'RNA_with_bc_{misc.file_prefix_from_fpath(bc_fq_fpath)}.bam')
+                lane_bam_fpaths.append(lane_bam_fpath)
+                stage = f'barcodes:{os.path.basename(lane_bam_fpath)}'
+                if run_manifest.is_done(stage, [lane_bam_fpath]):
+                    log.info(f'Barcode output {lane_bam_fpath} found. Skipping barcode detection')
+                    extents_complete = False
+                    continue
                 log.info('Processing files:')
                 log.info(f'  barcode fastq: {bc_fq_fpath}')
+                if arguments.stream_STAR:
+                    log.info(f'  paired fastq:  {paired_fpath}')
+                    if run_manifest.done_chunks(stage):
+                        extents_complete = False
+                    with stream_STAR_RNA(arguments, paired_fpath, star_threads, genome) as star_bam:
+                        stream_process_RNA_fastqs(arguments, bc_fq_fpath, star_bam, lane_bam_fpath, extents, run_manifest, stage, parse_threads)
+                    run_manifest.mark_done(stage, [lane_bam_fpath])
+                    continue
+                star_raw_fpath = paired_fpath
                 log.info(f'  paired bam:    {star_raw_fpath}')
-                process_fastqs_func(arguments, bc_fq_fpath, star_raw_fpath, star_w_bc_fh, namepairidx)
-        shutil.rmtree(star_out_dir)  # clean up intermediate STAR files
+                if arguments.threads == 1:
+                    with manifest.atomic_output(lane_bam_fpath) as tmp_lane_bam_fpath:
+                        with pysam.AlignmentFile(tmp_lane_bam_fpath, 'wb', template=pysam.AlignmentFile(star_raw_fpath)) as lane_bam_fh:
+                            serial_process_RNA_fastqs(
+                                    arguments,
+                                    bc_fq_fpath,
+                                    star_raw_fpath,
+                                    misc.FeatureExtentRecorder(lane_bam_fh, extents.extents_given_ref),
+                                    namepairidx,
+                                    sameorder=not arguments.star_output_path)
+                else:
+                    if run_manifest.done_chunks(stage):
+                        extents_complete = False
+                    parallel_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, lane_bam_fpath, extents, namepairidx, run_manifest, stage, parse_threads)
+                run_manifest.mark_done(stage, [lane_bam_fpath])
+
+        if extents_complete:
+            extents.save(misc.feature_extents_fpath(star_w_bc_sorted_fpath))
+        elif os.path.exists(misc.feature_extents_fpath(star_w_bc_sorted_fpath)):
+            os.remove(misc.feature_extents_fpath(star_w_bc_sorted_fpath))
+        if arguments.stream_STAR:
+            unsorted_fpaths = lane_bam_fpaths  # concatenated straight into the sorter below
+        else:
+            with manifest.atomic_output(star_w_bc_fpath) as tmp_star_w_bc_fpath:
+                misc.concatenate_bams(lane_bam_fpaths, tmp_star_w_bc_fpath)
+            run_manifest.mark_done('barcodes', [star_w_bc_fpath])
+            for lane_bam_fpath in lane_bam_fpaths:
+                os.remove(lane_bam_fpath)
+        star_out_dir = os.path.join(arguments.output_dir, 'STAR_files')
+        if not arguments.star_output_path and os.path.exists(star_out_dir):
+            shutil.rmtree(star_out_dir)  # clean up intermediate STAR files
     
     if completed < 2:
         log.info('Sorting bam...')
-        pysam.sort('-@', str(arguments.threads), '-o', star_w_bc_sorted_fpath, star_w_bc_fpath)
-        os.remove(star_w_bc_fpath)  #clean up unsorted bam
+        with manifest.atomic_output(star_w_bc_sorted_fpath) as tmp_sorted_fpath:
+            if unsorted_fpaths == [star_w_bc_fpath]:
+                pysam.sort('-@', str(arguments.threads), '-o', tmp_sorted_fpath, star_w_bc_fpath)
+            else:
+                with misc.bam_sorter(tmp_sorted_fpath, arguments.threads) as fifo_fpath:
+                    misc.concatenate_bams(unsorted_fpaths, fifo_fpath)
         log.info('Indexing bam...')
-        pysam.index(star_w_bc_sorted_fpath)
+        manifest.index_bam(star_w_bc_sorted_fpath)
+        run_manifest.mark_done('sort', [star_w_bc_sorted_fpath, star_w_bc_sorted_fpath + '.bai'])
+        for fpath in unsorted_fpaths:
+            os.remove(fpath)  #clean up unsorted bams
 
-    if completed < 3:
-        log.info('Correcting UMIs...')
-        correct_UMIs(arguments, star_w_bc_sorted_fpath, star_w_bc_umi_fpath)
+    if not count:
+        log.info('Done')
+        return
 
-    if completed < 4:
-        log.info('Sorting bam...')
-        pysam.sort('-@', str(arguments.threads), '-o', star_w_bc_umi_sorted_fpath, star_w_bc_umi_fpath)
+    if completed < 3:
+        log.info('Correcting UMIs and counting...')
+        correct_UMIs_and_count(arguments, star_w_bc_sorted_fpath, star_w_bc_umi_sorted_fpath, dedup_fpath)
         log.info('Indexing bam...')
-        pysam.index(star_w_bc_umi_sorted_fpath)
-        os.remove(star_w_bc_umi_fpath)
+        manifest.index_bam(star_w_bc_umi_sorted_fpath)
+        if dedup_fpath:
+            manifest.index_bam(dedup_fpath)
+        run_manifest.mark_done('umis', [star_w_bc_umi_sorted_fpath, star_w_bc_umi_sorted_fpath + '.bai'])
         os.remove(star_w_bc_sorted_fpath)
         os.remove(star_w_bc_sorted_fpath + '.bai')
-
-    RNA_count_matrix(arguments, star_w_bc_umi_sorted_fpath)
+        if os.path.exists(misc.feature_extents_fpath(star_w_bc_sorted_fpath)):
+            os.remove(misc.feature_extents_fpath(star_w_bc_sorted_fpath))
+    else:
+        RNA_count_matrix(arguments, star_w_bc_umi_sorted_fpath, with_read_table=True)
+        if dedup_fpath and not os.path.exists(dedup_fpath):
+            log.warning('Deduplicated bam is only written while correcting UMIs, which has already been done')
+        if arguments.cell_index and not cell_index.CellIndex(star_w_bc_umi_sorted_fpath).is_current():
+            log.info('Building cell index...')
+            cell_index.build_cell_index(star_w_bc_umi_sorted_fpath, arguments.threads)
     log.info('Done')
 
 
-def run_STAR_RNA(arguments, fastq_fpath):
-    """
-    Run STAR aligner for RNA files.
+def STAR_RNA_wrapper(args):
+    arguments, fastq_fpath, run_manifest, threads, genome = args
+    star_out_dir, star_out_fpath = run_STAR_RNA(arguments, fastq_fpath, run_manifest, threads, genome)
+    return star_out_fpath
 
-    Returns STAR output directory and bam path.
-    """
-    star_out_dir = os.path.join(arguments.output_dir, 'STAR_files')
-    fastq_bname = misc.file_prefix_from_fpath(fastq_fpath)
-    out_prefix = os.path.join(star_out_dir, f'{fastq_bname}_')
+
+def STAR_RNA_cmd(arguments, fastq_fpath, out_prefix, threads=None):
     cmd_star = [
         'STAR',
-        f'--runThreadN {arguments.threads}',
+        f'--runThreadN {threads or arguments.threads}',
         f'--genomeDir {arguments.star_ref_dir}',
         f'--readFilesIn {fastq_fpath}',
         f'--outFileNamePrefix {out_prefix}',
@@ -139,17 +236,50 @@ def run_STAR_RNA(arguments, fastq_fpath):
     ]
     if fastq_fpath.endswith('gz'):
         cmd_star.append('--readFilesCommand zcat')
+    return cmd_star
+
+
+def run_STAR_RNA(arguments, fastq_fpath, run_manifest=None, threads=None, genome=None):
+    """
+    Run STAR aligner for RNA files. With a run manifest, earlier results are only reused if
+    the alignment completed with the same genome. With a star.SharedGenome, the genome is
+    attached from shared memory.
+
+    Returns STAR output directory and bam path.
+    """
+    star_out_dir = os.path.join(arguments.output_dir, 'STAR_files')
+    fastq_bname = misc.file_prefix_from_fpath(fastq_fpath)
+    out_prefix = os.path.join(star_out_dir, f'{fastq_bname}_')
+    cmd_star = STAR_RNA_cmd(arguments, fastq_fpath, out_prefix, threads)
     star_out_fpath = f'{out_prefix}Aligned.out.bam'
-    if os.path.exists(star_out_fpath):
+    stage, params = f'STAR:{fastq_bname}', {'star_ref_dir': arguments.star_ref_dir}
+    if run_manifest.is_done(stage, [star_out_fpath], params) if run_manifest else os.path.exists(star_out_fpath):
         log.info("STAR results found. Skipping alignment")
     else:
+        if genome:
+            cmd_star.extend(genome.star_options())
+        log.info(f'  {fastq_fpath}')
         subprocess.run(cmd_star, check=True)
+        if run_manifest:
+            run_manifest.mark_done(stage, [star_out_fpath], params)
     return star_out_dir, star_out_fpath
 
 
-def process_bc_rec_and_p_read(config, bc_rec, p_read, aligners, decoders):
+def stream_STAR_RNA(arguments, fastq_fpath, threads=None, genome=None):
     """
-    Find barcodes etc in bc_rec and add them as tags to p_read
+    Runs STAR for RNA files with streamed output, see star.stream. No alignment file is written.
+    """
+    out_prefix = os.path.join(arguments.output_dir, 'STAR_files', f'{misc.file_prefix_from_fpath(fastq_fpath)}_')
+    cmd_star = STAR_RNA_cmd(arguments, fastq_fpath, out_prefix, threads)
+    if genome:
+        cmd_star.extend(genome.star_options())
+    return star.stream(cmd_star)
+
+
+def process_bc_rec_and_p_read(config, bc_rec, p_read, aligners, decoders, cb_encoder=None):
+    """
+    Find barcodes etc in bc_rec and add them as tags to p_read. With a cb_encoder, the integer
+    cell barcode id is added as well.
     """
     blocks = config["barcode_struct_r1"]["blocks"]
     scores_and_pieces = [al.find_norm_score_and_pieces(bc_rec.seq, return_seq=True) for al in aligners]
@@ -205,6 +335,8 @@ def process_bc_rec_and_p_read(config, bc_rec, p_read, aligners, decoders):
     # Cell barcode
     p_read.set_tag("CB", ".".join(bam_bcs))
     p_read.set_tag("CR", ".".join(bam_raw_bcs))
+    if cb_encoder is not None:
+        p_read.set_tag(encoding.cb_id_tag, cb_encoder.encode(".".join(bam_bcs)))
     # Filler sequences
     p_read.set_tag("FL", sum(len(seq) for seq in bam_commonseqs))
     # And raw UMI
@@ -235,6 +367,7 @@ def serial_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, star_w_bc_
     log.info('Building aligners and barcode decoders')
     aligners = misc.build_bc_aligners(arguments.config)
     decoders = misc.build_bc_decoders(arguments.config)
+    cb_encoder = encoding.get_cb_id_encoder(arguments.config) if arguments.cb_id_tag else None
 
     if not sameorder:
         star_readname_sorted_fpath = star_raw_fpath + "_readname_sorted.bam"
@@ -246,7 +379,7 @@ def serial_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, star_w_bc_
     log.info(f'Processing first {n_first_seqs:,d} for score threshold...')
     first_scores_and_reads = []
     for i, (bc_rec, p_read) in enumerate(iterator):
-        first_scores_and_reads.append(process_bc_rec_and_p_read(arguments.config, bc_rec, p_read, aligners, decoders))
+        first_scores_and_reads.append(process_bc_rec_and_p_read(arguments.config, bc_rec, p_read, aligners, decoders, cb_encoder))
         if i >= n_first_seqs:
             break
 
@@ -264,13 +397,13 @@ def serial_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, star_w_bc_
             continue
         if i % 100000 == 0 and i > 0:
             log.info(f'  {i:,d}')
-        score, read = process_bc_rec_and_p_read(arguments.config, bc_rec, p_read, aligners, decoders)
+        score, read = process_bc_rec_and_p_read(arguments.config, bc_rec, p_read, aligners, decoders, cb_encoder)
         if score >= thresh and read:
             total_out += 1
             star_w_bc_fh.write(read)
 
     if not sameorder:
-        os.remove(star_readname_sorted_fpath)
+        misc.remove_readname_bam(bamidx)
 
     log.info(f'{i+1:,d} records processed')
     log.info(f'{total_out:,d} records output')
@@ -287,17 +420,22 @@ def write_chunk(tmpdirname, i, bc_chunk):
     return tmp_fq_fpath, tmp_out_bam_fpath
 
 
-def chunked_RNA_recs_tmp_files_iterator(bc_fq_fpath, tmpdirname, chunksize):
+def chunked_RNA_recs_tmp_files_iterator(bc_fq_fpath, tmpdirname, chunksize, skip=0):
     """
-    Breaks pairs into chunks and writes to files.
+    Breaks pairs into chunks of chunksize bc fastq reads and writes to files. The first skip
+    chunks are not written. The chunks hold the same reads as those of streamed STAR output, so
+    that a rerun with or without --stream-STAR skips the same reads.
     """
     bc_chunk = []
+    nchunks = 0
     for i, bc_req in enumerate(SeqIO.parse(misc.gzip_friendly_open(bc_fq_fpath), 'fastq')):
         bc_chunk.append(bc_req)
-        if i % chunksize == 0 and i > 0:
-            yield write_chunk(tmpdirname, i, bc_chunk)
-            bc_chunk, p_chunk = [], []
-    if i % chunksize:
+        if (i + 1) % chunksize == 0:
+            if nchunks >= skip:
+                yield write_chunk(tmpdirname, i, bc_chunk)
+            nchunks += 1
+            bc_chunk = []
+    if bc_chunk and nchunks >= skip:
         yield write_chunk(tmpdirname, i, bc_chunk)
 
 
@@ -305,37 +443,44 @@ def process_chunk_of_reads(args_and_fpaths):
     """
     Processing chunks of reads. Required to build aligners in each parallel process.
     """
-    (tmp_fq_fpath, tmp_out_bam_fpath), (config, thresh, sorted_bam_fpath, sorted_bam_idx) = args_and_fpaths
+    (tmp_fq_fpath, tmp_out_bam_fpath), (config, thresh, sorted_bam_fpath, sorted_bam_idx, cb_encoder) = args_and_fpaths
     aligners = misc.build_bc_aligners(config)
     decoders = misc.build_bc_decoders(config)
     with pysam.AlignmentFile(tmp_out_bam_fpath, 'wb', template=pysam.AlignmentFile(sorted_bam_fpath)) as out:
         for bc_rec, p_read in RNA_unpaired_recs_iterator(tmp_fq_fpath, sorted_bam_fpath, sorted_bam_idx):
-                score, read = process_bc_rec_and_p_read(config, bc_rec, p_read, aligners, decoders)
+                score, read = process_bc_rec_and_p_read(config, bc_rec, p_read, aligners, decoders, cb_encoder)
                 if score >= thresh and read:
                     out.write(read)
     os.remove(tmp_fq_fpath)
     return tmp_out_bam_fpath
 
 
-def parallel_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, star_w_bc_fh, namepairidx):
+def parallel_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, lane_bam_fpath, extents, namepairidx, run_manifest=None, stage=None, threads=None):
     """
-    Parallel version of serial process.
+    Parallel version of serial process, writing lane_bam_fpath and recording feature extents.
 
     Rather more involved. pysam doesn't parallelize well. AlignedSegment's don't pickle. So one
     must create a large number of temporary files and process things that way, with multiple levels
     of helper functions
+
+    The compressed blocks of each processed chunk are appended to the partial lane bam and the
+    chunk is recorded in the run manifest, so a rerun resumes after the last completed chunk.
     """
     chunksize=100000
+    threads = threads or arguments.threads
+    tmp_lane_bam_fpath = manifest.partial_fpath(lane_bam_fpath)
+    nskip = manifest.resume_chunks(run_manifest, stage, [tmp_lane_bam_fpath])
     aligners = misc.build_bc_aligners(arguments.config)
     decoders = misc.build_bc_decoders(arguments.config)
-    with Pool(arguments.threads) as pool, \
+    cb_encoder = encoding.get_cb_id_encoder(arguments.config) if arguments.cb_id_tag else None
+    with misc.worker_pool(threads) as pool, \
             tempfile.TemporaryDirectory(prefix='/dev/shm/') as tmpdirname:
         log.info(f'Processing first {n_first_seqs:,d} for score threshold...')
         first_scores_and_reads = []
         for i, (bc_rec, p_read) in enumerate(
                 RNA_paired_recs_iterator(bc_fq_fpath, star_raw_fpath)
                 ):
-            first_scores_and_reads.append(process_bc_rec_and_p_read(arguments.config, bc_rec, p_read, aligners, decoders))
+            first_scores_and_reads.append(process_bc_rec_and_p_read(arguments.config, bc_rec, p_read, aligners, decoders, cb_encoder))
             if i >= n_first_seqs:
                 break
 
@@ -344,10 +489,9 @@ def parallel_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, star_w_b
         log.info(f'Score threshold: {thresh:.2f}')
 
         star_readname_sorted_fpath = star_raw_fpath + "_readname_sorted.bam"
-        bamidx = misc.sort_and_index_readname_bam(star_raw_fpath, star_readname_sorted_fpath, namepairidx, arguments.threads)
+        bamidx = misc.sort_and_index_readname_bam(star_raw_fpath, star_readname_sorted_fpath, namepairidx, threads)
 
         log.info(f'Using temporary directory {tmpdirname}')
-        total_out = 0
 
         # The following iteration architecture is designed to overcome a few limitaitons.
         #
@@ -355,9 +499,10 @@ def parallel_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, star_w_b
         # processes directly. Hence, each chunk of reads must be written to an intermediate file
         # and processed as a file. The only objects passed around are arguments and filenames
         #
-        # Second: pysam does not easily append to an existing bam file, so we pass a filehandle
-        # opened in the parent function that does not close until the full, combined bam file is
-        # produced.
+        # Second: pysam does not easily append to an existing bam file, so the compressed blocks
+        # of the chunk bam files are appended to the lane bam file directly. The lane bam file is
+        # complete after each chunk but for the end of file marker, which is what lets a rerun
+        # resume after the last completed chunk.
         #
         # Third: We use the imap method of the Pool object from the multiprocessing library.
         # The original intention was to hand it an iterator that generated the intermediate files
@@ -373,69 +518,357 @@ def parallel_process_RNA_fastqs(arguments, bc_fq_fpath, star_raw_fpath, star_w_b
         chunk_iter = chunked_RNA_recs_tmp_files_iterator(
                 bc_fq_fpath,
                 tmpdirname,
-                chunksize=chunksize)
-        i = 0
-        while True:
-            chunk = list(itertools.islice(chunk_iter, arguments.threads))
-            if not chunk:
-                break
-            chunk_of_args_and_fpaths = zip(chunk,
-                                           itertools.repeat((arguments.config, thresh, star_readname_sorted_fpath, bamidx)))
-            for j, tmp_out_bam_fpath in enumerate(pool.imap(
-                process_chunk_of_reads,
-                chunk_of_args_and_fpaths)):
-                it_idx = i*arguments.threads+j
-                log.info(f'  {it_idx*chunksize:,d}-{(it_idx+1)*chunksize:,d}')
-                for read in pysam.AlignmentFile(tmp_out_bam_fpath).fetch(until_eof=True):
-                    total_out += 1
-                    star_w_bc_fh.write(read)
-                os.remove(tmp_out_bam_fpath)
-            i += 1
-
-    os.remove(star_readname_sorted_fpath)
-    nrecs = int(misc.file_prefix_from_fpath(tmp_out_bam_fpath).split('.')[0])
-    log.info(f'{nrecs:,d} records processed')
+                chunksize=chunksize,
+                skip=nskip)
+        with open(tmp_lane_bam_fpath, 'ab') as lane_fh:
+            total_out, tmp_out_bam_fpath = append_processed_chunks(
+                    pool,
+                    process_chunk_of_reads,
+                    chunk_iter,
+                    (arguments.config, thresh, star_readname_sorted_fpath, bamidx, cb_encoder),
+                    lane_fh,
+                    extents,
+                    run_manifest,
+                    stage,
+                    nskip,
+                    chunksize,
+                    threads)
+            lane_fh.write(misc.bgzf_eof)
+    os.replace(tmp_lane_bam_fpath, lane_bam_fpath)
+
+    misc.remove_readname_bam(bamidx)
+    if tmp_out_bam_fpath:
+        nrecs = int(misc.file_prefix_from_fpath(tmp_out_bam_fpath).split('.')[0])
+        log.info(f'{nrecs:,d} records processed')
+    log.info(f'{total_out:,d} records output')
+
+
+def append_processed_chunks(pool, process_func, chunk_iter, common_args, lane_fh, extents, run_manifest, stage, nskip, chunksize, threads):
+    """
+    Processes the chunks of chunk_iter on the pool, threads chunks at a time, appending the
+    compressed blocks of each processed chunk to the partial lane bam and recording the chunk in
+    the run manifest.
+
+    returns
+        :tuple: (number of reads output, last processed chunk bam path)
+    """
+    total_out = 0
+    tmp_out_bam_fpath = None
+    i = 0
+    while True:
+        chunk = list(itertools.islice(chunk_iter, threads))
+        if not chunk:
+            break
+        chunk_of_args_and_fpaths = zip(chunk, itertools.repeat(common_args))
+        for j, tmp_out_bam_fpath in enumerate(pool.imap(
+            process_func,
+            chunk_of_args_and_fpaths)):
+            it_idx = nskip+i*threads+j
+            log.info(f'  {it_idx*chunksize:,d}-{(it_idx+1)*chunksize:,d}')
+            for read in pysam.AlignmentFile(tmp_out_bam_fpath).fetch(until_eof=True):
+                total_out += 1
+                extents.record(read)
+            misc.copy_bam_blocks(tmp_out_bam_fpath, lane_fh, with_header=lane_fh.tell() == 0)
+            lane_fh.flush()
+            os.fsync(lane_fh.fileno())
+            if run_manifest:
+                run_manifest.mark_chunk(stage, [lane_fh.tell()])
+            os.remove(tmp_out_bam_fpath)
+        i += 1
+    return total_out, tmp_out_bam_fpath
+
+
+def RNA_streamed_recs_iterator(bc_fq_fpath, star_bam):
+    """
+    Iterates bc fastq reads, with their index in the fastq file, with matching records of
+    streamed STAR output in the same order.
+    """
+    bc_fq_iter = enumerate(SeqIO.parse(misc.gzip_friendly_open(bc_fq_fpath), 'fastq'))
+    for p_read in star_bam.fetch(until_eof=True):
+        i, bc_rec = next((i, rec) for i, rec in bc_fq_iter if misc.names_pair(str(rec.id), str(p_read.qname)))
+        yield i, bc_rec, p_read
+
+
+def write_paired_chunk(tmpdirname, k, bc_chunk, p_chunk, template):
+    """
+    Writes chunks of paired reads to files
+    """
+    tmp_fq_fpath = os.path.join(tmpdirname, f'{k}.fq')
+    tmp_bam_fpath = os.path.join(tmpdirname, f'{k}.bam')
+    tmp_out_bam_fpath = os.path.join(tmpdirname, f'{k}.parsed.bam')
+    with open(tmp_fq_fpath, 'w') as fq_out:
+        SeqIO.write(bc_chunk, fq_out, 'fastq')
+    with pysam.AlignmentFile(tmp_bam_fpath, 'wbu', template=template) as bam_out:
+        for p_read in p_chunk:
+            bam_out.write(p_read)
+    return tmp_fq_fpath, tmp_bam_fpath, tmp_out_bam_fpath
+
+
+def chunked_RNA_streamed_recs_tmp_files_iterator(recs_iter, template, tmpdirname, chunksize, skip=0):
+    """
+    Breaks the pairs of recs_iter into chunks of chunksize bc fastq reads and writes them to
+    files. Chunks hold the same reads whichever reads STAR aligned, so that a rerun skips the same
+    skip chunks.
+    """
+    bc_chunk, p_chunk = [], []
+    nchunks = 0
+    for i, bc_rec, p_read in recs_iter:
+        while i >= (nchunks + 1) * chunksize:
+            if nchunks >= skip:
+                yield write_paired_chunk(tmpdirname, nchunks, bc_chunk, p_chunk, template)
+            nchunks += 1
+            bc_chunk, p_chunk = [], []
+        bc_chunk.append(bc_rec)
+        p_chunk.append(p_read)
+    if bc_chunk and nchunks >= skip:
+        yield write_paired_chunk(tmpdirname, nchunks, bc_chunk, p_chunk, template)
+
+
+def process_chunk_of_paired_reads(args_and_fpaths):
+    """
+    Processing chunks of reads in the same order in the bc fastq and paired bam files.
+    """
+    (tmp_fq_fpath, tmp_bam_fpath, tmp_out_bam_fpath), (config, thresh, cb_encoder) = args_and_fpaths
+    aligners = misc.build_bc_aligners(config)
+    decoders = misc.build_bc_decoders(config)
+    with pysam.AlignmentFile(tmp_out_bam_fpath, 'wb', template=pysam.AlignmentFile(tmp_bam_fpath)) as out:
+        for bc_rec, p_read in RNA_paired_recs_iterator(tmp_fq_fpath, tmp_bam_fpath):
+            score, read = process_bc_rec_and_p_read(config, bc_rec, p_read, aligners, decoders, cb_encoder)
+            if score >= thresh and read:
+                out.write(read)
+    os.remove(tmp_fq_fpath)
+    os.remove(tmp_bam_fpath)
+    return tmp_out_bam_fpath
+
+
+def stream_process_RNA_fastqs(arguments, bc_fq_fpath, star_bam, lane_bam_fpath, extents, run_manifest=None, stage=None, threads=None):
+    """
+    Version of the parallel process reading STAR output while STAR runs. The STAR reads are in
+    the order of the fastq reads, so each chunk is written with its paired reads and no read name
+    sorted bam is needed. Chunks are resumed as in the parallel process.
+    """
+    chunksize=100000
+    threads = threads or arguments.threads
+    tmp_lane_bam_fpath = manifest.partial_fpath(lane_bam_fpath)
+    nskip = manifest.resume_chunks(run_manifest, stage, [tmp_lane_bam_fpath])
+    aligners = misc.build_bc_aligners(arguments.config)
+    decoders = misc.build_bc_decoders(arguments.config)
+    cb_encoder = encoding.get_cb_id_encoder(arguments.config) if arguments.cb_id_tag else None
+    with misc.worker_pool(threads) as pool, \
+            tempfile.TemporaryDirectory(prefix='/dev/shm/') as tmpdirname:
+        recs_iter = RNA_streamed_recs_iterator(bc_fq_fpath, star_bam)
+        log.info(f'Processing first {n_first_seqs:,d} for score threshold...')
+        first_recs = list(itertools.islice(recs_iter, n_first_seqs + 1))
+        scores = [process_bc_rec_and_p_read(arguments.config, bc_rec, p_read, aligners, decoders, cb_encoder)[0]
+                  for i, bc_rec, p_read in first_recs]
+        thresh = np.average(scores) - 2 * np.std(scores)
+        log.info(f'Score threshold: {thresh:.2f}')
+
+        log.info(f'Using temporary directory {tmpdirname}')
+        chunk_iter = chunked_RNA_streamed_recs_tmp_files_iterator(
+                itertools.chain(first_recs, recs_iter),
+                star_bam,
+                tmpdirname,
+                chunksize=chunksize,
+                skip=nskip)
+        with open(tmp_lane_bam_fpath, 'ab') as lane_fh:
+            total_out, tmp_out_bam_fpath = append_processed_chunks(
+                    pool,
+                    process_chunk_of_paired_reads,
+                    chunk_iter,
+                    (arguments.config, thresh, cb_encoder),
+                    lane_fh,
+                    extents,
+                    run_manifest,
+                    stage,
+                    nskip,
+                    chunksize,
+                    threads)
+            lane_fh.write(misc.bgzf_eof)
+    os.replace(tmp_lane_bam_fpath, lane_bam_fpath)
     log.info(f'{total_out:,d} records output')
 
 
-def umi_parallel_wrapper(ref_and_input_bam_fpath):
-    ref, input_bam_fpath = ref_and_input_bam_fpath
-    return ref, get_umi_maps_from_bam_file(input_bam_fpath, chrm=ref)
-
-def correct_UMIs(arguments, input_bam_fpath, out_bam_fpath):
-    with pysam.AlignmentFile(input_bam_fpath) as bamfile:
-        reference_names = bamfile.references
-    reference_names_with_input_bam = [(ref, input_bam_fpath) for ref in reference_names]
-
-    with pysam.AlignmentFile(out_bam_fpath, 'wb', template=pysam.AlignmentFile(input_bam_fpath)) as bam_out, \
-            Pool(arguments.threads) as pool:
-        for i, (ref, umi_map_given_bc_then_feature) in enumerate(pool.imap_unordered(
-                umi_parallel_wrapper,
-                reference_names_with_input_bam)):
-            log.info(f'  {ref}')
-            for read in pysam.AlignmentFile(input_bam_fpath).fetch(ref):
-                for gx_gn_tup in misc.gx_gn_tups_from_read(read):
-                    corrected_umi = umi_map_given_bc_then_feature[read.get_tag('CB')][gx_gn_tup][read.get_tag('UR')]
-                    read.set_tag('UB', corrected_umi)
-                    bam_out.write(read)
-                    break # use the first one. Ideally same across all
-
-
-def count_parallel_wrapper(ref_and_input_bam_fpath):
-    ref, input_bam_fpath = ref_and_input_bam_fpath
-    read_count_given_bc_then_feature_then_umi = defaultdict(lambda : defaultdict(Counter))
-    for read in pysam.AlignmentFile(input_bam_fpath).fetch(ref):
-        for gx_gn_tup in misc.gx_gn_tups_from_read(read): # count read toward all compatible genes
-            read_count_given_bc_then_feature_then_umi[read.get_tag('CB')][gx_gn_tup][read.get_tag('UB')] += 1
-    for k in read_count_given_bc_then_feature_then_umi.keys():
-        read_count_given_bc_then_feature_then_umi[k] = dict(read_count_given_bc_then_feature_then_umi[k])
-    read_count_given_bc_then_feature_then_umi = dict(read_count_given_bc_then_feature_then_umi)
-    return ref, read_count_given_bc_then_feature_then_umi
-
-def RNA_count_matrix(arguments, input_bam_fpath):
-    """
-    Counts the reads from the input bam file and outputs sparse matrices of read and UMI counts.
+def umi_counts_to_arrays(encoder, read_count_given_bc_and_feature_then_umi):
+    """
+    Converts the umi counters of a counting worker to local id and count arrays for
+    misc.build_count_matrices, and the stable codes of the umis of each (barcode, feature) in the
+    same order for the umi sidecar.
+    """
+    bc_ids, feature_ids = encoding.id_pair_arrays(read_count_given_bc_and_feature_then_umi.keys())
+    nreads = np.fromiter((sum(umi_cntr.values()) for umi_cntr in read_count_given_bc_and_feature_then_umi.values()), dtype=np.int64)
+    numis = np.fromiter((len(umi_cntr) for umi_cntr in read_count_given_bc_and_feature_then_umi.values()), dtype=np.int64)
+    umi_codes = np.fromiter(
+            (encoder.umi.stable_code(umi) for umi_cntr in read_count_given_bc_and_feature_then_umi.values() for umi in umi_cntr),
+            dtype=np.uint64,
+            count=int(numis.sum()))
+    return (encoder.cb.values, encoder.feature.values, bc_ids, feature_ids, nreads, numis), umi_codes
+
+def correct_and_count_parallel_wrapper(args):
+    (ref, start, end), feature_last_starts, input_bam_fpath, out_bam_fpath, shard_table_dir, shard_index_fpath, dedup_bam_fpath = args
+    t0 = time.time()
+    encoder = encoding.ReadEncoder()
+    table_builder = read_table.ReadTableBuilder(encoder) if shard_table_dir else None
+    index_builder = cell_index.CellIndexBuilder(encoder.cb) if shard_index_fpath else None
+    saturation_entries = saturation.SaturationEntries()
+    read_count_given_bc_and_feature_then_umi = defaultdict(Counter)
+    with pysam.AlignmentFile(input_bam_fpath) as bam_in, \
+            pysam.AlignmentFile(out_bam_fpath, 'wb', template=bam_in) as bam_out:
+        deduplicator = None
+        if dedup_bam_fpath:
+            dedup_bam_out = pysam.AlignmentFile(dedup_bam_fpath, 'wb', template=bam_in)
+            deduplicator = dedup.MoleculeDeduplicator(dedup_bam_out)
+        for read, bc_id, feature_ids, corrected_umi in iter_reads_with_corrected_umis(
+                bam_in,
+                (ref, start, end),
+                feature_last_starts,
+                encoder,
+                deduplicator=deduplicator):
+            read.set_tag('UB', encoder.umi.decode(corrected_umi))
+            if index_builder:
+                offset = bam_out.tell()
+                bam_out.write(read)
+                index_builder.add(bc_id, offset, bam_out.tell())
+            else:
+                bam_out.write(read)
+            if deduplicator:
+                deduplicator.write(read)
+            if table_builder:
+                table_builder.add(read, bc_id, feature_ids, corrected_umi)
+            saturation_entries.add(read, bc_id, feature_ids, corrected_umi)
+            for feature_id in feature_ids: # count read toward all compatible genes
+                read_count_given_bc_and_feature_then_umi[bc_id, feature_id][corrected_umi] += 1
+        if deduplicator:
+            dedup_bam_out.close()
+    if table_builder:
+        table_builder.save(shard_table_dir)
+    if index_builder:
+        index_builder.save(shard_index_fpath)
+    counts, umi_codes = umi_counts_to_arrays(encoder, read_count_given_bc_and_feature_then_umi)
+    tallies = saturation_entries.tally(len(encoder.cb))
+    return (ref, start, end), out_bam_fpath, counts, umi_codes, tallies, time.time() - t0
+
+def correct_UMIs_and_count(arguments, input_bam_fpath, out_bam_fpath, dedup_bam_fpath=None, region_shard=None):
     """
+    Corrects UMIs and counts reads and UMIs of the coordinate sorted input bam in one task per shard.
+
+    Each shard is read twice: UMI maps are built as features are finalized, then reads are
+    written with their UB tag to a per-shard bam while their counts and read table columns are
+    collected. Without the .extents.json sidecar of the input bam, the feature extents are scanned
+    first, so the input is read three times in total. The shard bams are concatenated in order, so the output is coordinate sorted, and
+    the shard tables are merged into the read table of the output bam. With arguments.cell_index,
+    the offsets of the written reads are merged into the cell index of the output bam. With
+    dedup_bam_fpath, one representative read per molecule is also written to a deduplicated bam.
+
+    With region_shard, a (shard, nshards) tuple as in scatter_count, only the slice of the
+    shards of that region shard is processed and no read table is written. The saturation tallies
+    are saved for gather instead of the report.
+    """
+    extents_fpath = misc.feature_extents_fpath(input_bam_fpath)
+    extents_given_ref = misc.load_feature_extents(extents_fpath) if os.path.exists(extents_fpath) else None
+    shard_counts, shard_umi_codes, shard_tallies = [], [], []
+    nshards = arguments.threads * misc.shards_per_thread if region_shard is None else region_shard[1] * misc.shards_per_region
+    with misc.worker_pool(arguments.threads) as pool, \
+            tempfile.TemporaryDirectory(dir=arguments.output_dir) as tmpdirname:
+        shards, extents_given_ref = misc.get_feature_safe_genomic_shards(
+                input_bam_fpath,
+                nshards,
+                pool,
+                with_extents=True,
+                extents_given_ref=extents_given_ref)
+        if region_shard is not None:
+            shards = misc.region_shard_slice(shards, *region_shard)
+        shard_table_dirs = [os.path.join(tmpdirname, f'{i}.reads') if region_shard is None else None for i in range(len(shards))]
+        shard_index_fpaths = [os.path.join(tmpdirname, f'{i}.cbi.npz') if arguments.cell_index else None for i in range(len(shards))]
+        shard_dedup_bam_fpaths = [os.path.join(tmpdirname, f'{i}.dedup.bam') if dedup_bam_fpath else None for i in range(len(shards))]
+        shard_args = []
+        for i, (ref, start, end) in enumerate(shards):
+            feature_last_starts = {feature: last for feature, (first, last) in extents_given_ref.get(ref, {}).items() if start <= first < end}
+            shard_args.append((
+                (ref, start, end),
+                feature_last_starts,
+                input_bam_fpath,
+                os.path.join(tmpdirname, f'{i}.bam'),
+                shard_table_dirs[i],
+                shard_index_fpaths[i],
+                shard_dedup_bam_fpaths[i]))
+
+        log.info(f'Processing {len(shards):,d} shards')
+        shard_bam_fpaths = []
+        for shard, shard_bam_fpath, counts, umi_codes, tallies, elapsed in pool.imap(
+                correct_and_count_parallel_wrapper,
+                shard_args):
+            log.info(f'  {misc.shard_str(shard)} ({elapsed:.1f}s)')
+            shard_bam_fpaths.append(shard_bam_fpath)
+            shard_counts.append(counts)
+            shard_umi_codes.append(umi_codes)
+            shard_tallies.append(tallies)
+
+        log.info('Concatenating shards...')
+        shifts = misc.concatenate_bams(shard_bam_fpaths, out_bam_fpath, input_bam_fpath)
+        if region_shard is None:
+            read_table.merge_read_tables(shard_table_dirs, out_bam_fpath)
+        if arguments.cell_index:
+            cell_index.merge_cell_indexes(shard_index_fpaths, out_bam_fpath, shifts)
+        if dedup_bam_fpath:
+            misc.concatenate_bams(shard_dedup_bam_fpaths, dedup_bam_fpath, input_bam_fpath)
+
+    sorted_complete_bcs, sorted_features, (M_reads,) = misc.build_count_matrices(shard_counts, 1)
+    M_umis, umis = misc.build_umi_matrix(shard_counts, shard_umi_codes, sorted_complete_bcs, sorted_features)
+
+    log.info('Writing raw read count matrix...')
+    for out_dir, M in [(os.path.join(arguments.output_dir, 'raw_reads_bc_matrix'), M_reads),
+                       (os.path.join(arguments.output_dir, 'raw_umis_bc_matrix'), M_umis)]:
+        os.makedirs(out_dir, exist_ok=True)
+        misc.write_matrix(M, sorted_complete_bcs, sorted_features, out_dir, arguments.matrix_formats, arguments.threads)
+    misc.write_umi_sidecar(umis, os.path.join(arguments.output_dir, 'raw_umis_bc_matrix'))
+    tallies = saturation.merge_tallies(shard_tallies, [counts[0] for counts in shard_counts], sorted_complete_bcs)
+    if region_shard is None:
+        saturation.write_saturation_report(tallies, arguments.output_dir)
+    else:
+        saturation.save_tallies(tallies, sorted_complete_bcs, arguments.output_dir)
+
+
+def count_parallel_wrapper(args):
+    shard, input_bam_fpath, shard_table_dir = args
+    t0 = time.time()
+    encoder = encoding.ReadEncoder()
+    table_builder = read_table.ReadTableBuilder(encoder) if shard_table_dir else None
+    saturation_entries = saturation.SaturationEntries()
+    read_count_given_bc_and_feature_then_umi = defaultdict(Counter)
+    with pysam.AlignmentFile(input_bam_fpath) as bam:
+        for read in misc.fetch_shard(bam, shard):
+            bc_id = encoder.cb_id(read) # barcodes of reads without features are still listed
+            feature_ids = encoder.feature_ids(read)
+            if table_builder:
+                table_builder.add(read, bc_id, feature_ids)
+            if not feature_ids:
+                continue
+            umi = encoder.umi_code(read, 'UB')
+            saturation_entries.add(read, bc_id, feature_ids, umi)
+            for feature_id in feature_ids: # count read toward all compatible genes
+                read_count_given_bc_and_feature_then_umi[bc_id, feature_id][umi] += 1
+    if table_builder:
+        table_builder.save(shard_table_dir)
+    counts, umi_codes = umi_counts_to_arrays(encoder, read_count_given_bc_and_feature_then_umi)
+    tallies = saturation_entries.tally(len(encoder.cb))
+    return shard, counts, umi_codes, tallies, time.time() - t0
+
+def RNA_count_matrix(arguments, input_bam_fpath, with_read_table=False):
+    """
+    Counts the reads from the input bam file and outputs sparse matrices of read and UMI counts,
+    and a saturation report.
+
+    If the bam file has a current read table, counts are computed from the table, optionally
+    after correcting the raw UMIs again with a different maximum distance. Otherwise the bam file
+    is counted, writing its read table on the way if with_read_table.
+    """
+    table = read_table.ReadTable(input_bam_fpath)
+    from_table = table.is_current()
+    umi_max_dist = arguments.umi_max_dist
+    if umi_max_dist is not None and not from_table:
+        raise ValueError(f'Correcting UMIs again requires the read table {table.table_dir}')
+
     raw_reads_output_dir = os.path.join(arguments.output_dir, 'raw_reads_bc_matrix')
     raw_umis_output_dir = os.path.join(arguments.output_dir, 'raw_umis_bc_matrix')
     for out_dir in [raw_reads_output_dir, raw_umis_output_dir]:
@@ -445,35 +878,37 @@ def RNA_count_matrix(arguments, input_bam_fpath):
         else:
             os.makedirs(out_dir)
 
-    log.info('Finding all barcodes present...')
-    sorted_complete_bcs, sorted_features = misc.get_bcs_and_features_from_bam(
-            input_bam_fpath,
-            arguments.threads-1
-            )
-    i_given_feature = {feat: i for i, feat in enumerate(sorted_features)}
-    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
-
-
-    with pysam.AlignmentFile(input_bam_fpath) as bamfile:
-        reference_names = bamfile.references
-    reference_names_with_input_bam = [(ref, input_bam_fpath) for ref in reference_names]
-
-
-    log.info('Counting reads...')
-    M_reads = lil_matrix((len(sorted_features), len(sorted_complete_bcs)), dtype=int)
-    M_umis = lil_matrix((len(sorted_features), len(sorted_complete_bcs)), dtype=int)
-    with Pool(arguments.threads) as pool:
-        for ref, read_count_given_bc_then_feature_then_umi in pool.imap_unordered(
-                count_parallel_wrapper,
-                reference_names_with_input_bam):
-            for comp_bc, read_count_given_feature_then_umi in read_count_given_bc_then_feature_then_umi.items():
-                j = j_given_complete_bc[comp_bc]
-                for gx_gn_tup, umi_cntr in read_count_given_feature_then_umi.items():
-                    i = i_given_feature[gx_gn_tup]
-                    for umi, count in umi_cntr.items():
-                        M_reads[i, j] += count
-                        M_umis[i, j] += 1
+    if from_table:
+        ubs = None
+        if umi_max_dist is not None:
+            log.info(f'Correcting UMIs from read table with maximum distance {umi_max_dist}...')
+            ubs = read_table.correct_umis(table, max_dist=umi_max_dist)
+        log.info('Counting reads from read table...')
+        sorted_complete_bcs, sorted_features, (M_reads, M_umis), umis = read_table.count_matrices(table, ubs)
+        tallies = saturation.table_tallies(table, ubs)
+    else:
+        log.info('Counting reads...')
+        shard_counts, shard_umi_codes, shard_tallies = [], [], []
+        with misc.worker_pool(arguments.threads) as pool, \
+                tempfile.TemporaryDirectory(dir=arguments.output_dir) as tmpdirname:
+            shards = misc.get_feature_safe_genomic_shards(input_bam_fpath, arguments.threads * misc.shards_per_thread, pool)
+            shard_table_dirs = [os.path.join(tmpdirname, f'{i}.reads') if with_read_table else None for i in range(len(shards))]
+            for shard, counts, umi_codes, tallies, elapsed in pool.imap(
+                    count_parallel_wrapper,
+                    zip(shards, itertools.repeat(input_bam_fpath), shard_table_dirs)):
+                log.info(f'  {misc.shard_str(shard)} ({elapsed:.1f}s)')
+                shard_counts.append(counts)
+                shard_umi_codes.append(umi_codes)
+                shard_tallies.append(tallies)
+            if with_read_table:
+                log.info('Writing read table...')
+                read_table.merge_read_tables(shard_table_dirs, input_bam_fpath)
+        sorted_complete_bcs, sorted_features, (M_reads,) = misc.build_count_matrices(shard_counts, 1)
+        M_umis, umis = misc.build_umi_matrix(shard_counts, shard_umi_codes, sorted_complete_bcs, sorted_features)
+        tallies = saturation.merge_tallies(shard_tallies, [counts[0] for counts in shard_counts], sorted_complete_bcs)
 
     log.info('Writing raw read count matrix...')
     for out_dir, M in [(raw_reads_output_dir, M_reads), (raw_umis_output_dir, M_umis)]:
-        misc.write_matrix(M, sorted_complete_bcs, sorted_features, out_dir)
+        misc.write_matrix(M, sorted_complete_bcs, sorted_features, out_dir, arguments.matrix_formats, arguments.threads)
+    misc.write_umi_sidecar(umis, raw_umis_output_dir)
+    saturation.write_saturation_report(tallies, arguments.output_dir)
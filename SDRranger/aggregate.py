@@ -0,0 +1,120 @@
+import logging
+import os
+import numpy as np
+from . import misc
+
+log = logging.getLogger(__name__)
+
+
+matrix_dirnames = ('raw_reads_bc_matrix', 'raw_umis_bc_matrix')
+
+
+def join_names(names_given_run):
+    """
+    Builds the sorted union of the names of all runs.
+
+    returns
+        :tuple: (sorted names, list with the index in the union of each name of each run)
+    """
+    names = np.concatenate([np.array(names, dtype=str) for names in names_given_run])
+    sorted_names, union_idxs = np.unique(names, return_inverse=True)
+    splits = np.cumsum([len(names) for names in names_given_run])[:-1]
+    return sorted_names.tolist(), np.split(union_idxs.reshape(-1), splits)
+
+
+def join_runs(runs):
+    """
+    Aligns the barcodes and features of matrices from several runs by name.
+
+    returns
+        :tuple: (sorted_complete_bcs, sorted_features, [(row_idxs, col_idxs) for each run])
+    """
+    sorted_complete_bcs, col_idxs_given_run = join_names([bcs for M, bcs, features in runs])
+    feature_strs, row_idxs_given_run = join_names([[f'{gx}\t{gn}' for gx, gn in features] for M, bcs, features in runs])
+    sorted_features = [tuple(feature_str.split('\t')) for feature_str in feature_strs]
+    return sorted_complete_bcs, sorted_features, list(zip(row_idxs_given_run, col_idxs_given_run))
+
+
+def sum_matrices(runs):
+    """
+    Sums matrices from several runs after aligning them by name.
+    """
+    sorted_complete_bcs, sorted_features, idxs_given_run = join_runs(runs)
+    rows, cols, vals = [], [], []
+    for (M, bcs, features), (row_idxs, col_idxs) in zip(runs, idxs_given_run):
+        M = M.tocoo()
+        rows.append(row_idxs[M.row])
+        cols.append(col_idxs[M.col])
+        vals.append(M.data.astype(np.int64))
+    M = misc.sparse_count_matrix(rows, cols, vals, (len(sorted_features), len(sorted_complete_bcs)))
+    return M, sorted_complete_bcs, sorted_features
+
+
+def merge_umi_matrices(runs, umis_given_run):
+    """
+    Merges umi count matrices from several runs using their umi sidecars, such that umis seen in
+    more than one run for the same barcode and feature are counted once.
+
+    returns
+        :tuple: (M, sorted_complete_bcs, sorted_features, umis sidecar of M)
+    """
+    sorted_complete_bcs, sorted_features, idxs_given_run = join_runs(runs)
+    rows, cols = [], []
+    for (M, bcs, features), umis, (row_idxs, col_idxs) in zip(runs, umis_given_run, idxs_given_run):
+        if len(umis) != M.sum():
+            raise ValueError(f'UMI sidecar with {len(umis):,d} UMIs does not match UMI matrix with {M.sum():,d} UMIs')
+        M = M.tocoo()
+        rows.append(np.repeat(row_idxs[M.row], M.data))
+        cols.append(np.repeat(col_idxs[M.col], M.data))
+    rows, cols, umis = np.concatenate(rows), np.concatenate(cols), np.concatenate(umis_given_run)
+    order = np.lexsort((umis, cols, rows))
+    rows, cols, umis = rows[order], cols[order], umis[order]
+    first = np.ones(len(umis), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]) | (umis[1:] != umis[:-1])
+    rows, cols, umis = rows[first], cols[first], umis[first]
+    M = misc.sparse_count_matrix(
+            [rows],
+            [cols],
+            [np.ones(len(umis), dtype=np.int64)],
+            (len(sorted_features), len(sorted_complete_bcs)))
+    return M, sorted_complete_bcs, sorted_features, umis
+
+
+def aggregate_count_matrices(arguments):
+    """
+    Merges the count matrices in the output directories of several runs, e.g. top-up sequencing of
+    the same library, without recounting the bam files. Barcodes and features are matched by name.
+    """
+    for dirname in matrix_dirnames:
+        in_dirs = [os.path.join(count_dir, dirname) for count_dir in arguments.count_dirs]
+        present = [os.path.isdir(in_dir) for in_dir in in_dirs]
+        if not any(present):
+            continue
+        if not all(present):
+            missing = ', '.join(count_dir for count_dir, is_present in zip(arguments.count_dirs, present) if not is_present)
+            raise ValueError(f'{dirname} missing from {missing}')
+
+        out_dir = os.path.join(arguments.output_dir, dirname)
+        if os.path.exists(out_dir):
+            log.info(f'{dirname} output folder exists. Skipping')
+            continue
+        os.makedirs(out_dir)
+
+        log.info(f'Merging {dirname} of {len(in_dirs):,d} runs...')
+        runs = [misc.read_matrix(in_dir) for in_dir in in_dirs]
+        umis = None
+        if dirname == 'raw_umis_bc_matrix':
+            if all(os.path.exists(misc.umi_sidecar_fpath(in_dir)) for in_dir in in_dirs):
+                M, sorted_complete_bcs, sorted_features, umis = merge_umi_matrices(
+                        runs,
+                        [misc.load_umi_sidecar(in_dir) for in_dir in in_dirs])
+            else:
+                log.warning('UMI sidecar missing for some runs. Summing UMI counts, which counts UMIs seen in several runs more than once')
+                M, sorted_complete_bcs, sorted_features = sum_matrices(runs)
+        else:
+            M, sorted_complete_bcs, sorted_features = sum_matrices(runs)
+
+        log.info(f'  {len(sorted_features):,d} features, {len(sorted_complete_bcs):,d} barcodes')
+        misc.write_matrix(M, sorted_complete_bcs, sorted_features, out_dir, arguments.matrix_formats, arguments.threads)
+        if umis is not None:
+            misc.write_umi_sidecar(umis, out_dir)
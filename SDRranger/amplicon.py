@@ -0,0 +1,115 @@
+import logging
+import numpy as np
+from bisect import bisect_left, bisect_right
+from . import misc
+
+log = logging.getLogger(__name__)
+
+
+def load_amplicons(fpath, references):
+    """
+    Reads amplicons from a BED file, sorted in the order of the bam references. Amplicons on
+    references missing from the bam file are skipped, and it is an error if none are left.
+
+    returns
+        :list: (chrom, start, end, name) tuples with 0-based, half-open coordinates
+    """
+    tid_given_ref = {ref: tid for tid, ref in enumerate(references)}
+    amplicons, missing = [], set()
+    with misc.gzip_friendly_open(fpath) as f:
+        for line in f:
+            if line.startswith('#') or line.startswith('track') or line.startswith('browser') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            if chrom not in tid_given_ref:
+                missing.add(chrom)
+                continue
+            amplicons.append((chrom, start, end, fields[3] if len(fields) > 3 else f'{chrom}:{start+1}-{end}'))
+    if not amplicons:
+        if missing:
+            raise ValueError(f'No amplicons of {fpath} are on references of the bam file. Missing references: {", ".join(sorted(missing))}')
+        raise ValueError(f'No amplicons found in {fpath}')
+    if missing:
+        log.warning(f'Skipping amplicons on references missing from the bam file: {", ".join(sorted(missing))}')
+    amplicons.sort(key=lambda amplicon: (tid_given_ref[amplicon[0]], amplicon[1], amplicon[2]))
+    return amplicons
+
+
+def amplicon_features(amplicons):
+    return [(f'{chrom}:{start+1}-{end}', name) for chrom, start, end, name in amplicons]
+
+
+class IntervalIndex:
+    """
+    Overlap queries on intervals sorted by reference and start. Besides the starts, each reference
+    keeps the running maximum of the ends, so the intervals that can overlap a query are found by
+    two bisections and only these are checked.
+    """
+    def __init__(self, intervals):
+        self._given_ref = {}
+        for i, (ref, start, end, *_) in enumerate(intervals):
+            if ref not in self._given_ref:
+                self._given_ref[ref] = (i, [], [], [])
+            first, starts, ends, max_ends = self._given_ref[ref]
+            starts.append(start)
+            ends.append(end)
+            max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+
+    def overlapping(self, ref, start, end):
+        """Indices of the intervals overlapping [start, end)."""
+        if ref not in self._given_ref:
+            return []
+        first, starts, ends, max_ends = self._given_ref[ref]
+        lo, hi = bisect_right(max_ends, start), bisect_left(starts, end)
+        return [first + i for i in range(lo, hi) if ends[i] > start]
+
+    def best_overlap(self, ref, start, end):
+        """Index of the interval with the largest overlap with [start, end), the first one on ties, or -1."""
+        if ref not in self._given_ref:
+            return -1
+        first, starts, ends, max_ends = self._given_ref[ref]
+        best, best_overlap = -1, 0
+        for i in range(bisect_right(max_ends, start), bisect_left(starts, end)):
+            overlap = min(end, ends[i]) - max(start, starts[i])
+            if overlap > best_overlap:
+                best, best_overlap = first + i, overlap
+        return best
+
+
+def amplicon_tasks(bam_fpath, amplicons, ntasks):
+    """
+    Splits the sorted amplicons into about ntasks runs of consecutive amplicons with similar
+    numbers of reads, estimated from the bam index like the genomic shards. Overlapping amplicons
+    of a task are merged into one region to fetch.
+
+    returns
+        :list: tasks as lists of (ref, start, end, first amplicon, end amplicon) regions
+    """
+    estimates, lengths = misc.get_window_read_estimates(bam_fpath)
+    weights = np.empty(len(amplicons))
+    for i, (chrom, start, end, name) in enumerate(amplicons):
+        est = estimates[chrom]
+        if len(est) == 1:  # no linear index, spread the reads over the reference
+            weights[i] = est[0] * (end - start) / max(lengths[chrom], 1)
+        else:
+            windows = np.arange(start // misc.bai_window_size, min((end - 1) // misc.bai_window_size + 1, len(est)))
+            weights[i] = est[windows].sum() * (end - start) / (len(windows) * misc.bai_window_size) if len(windows) else 0
+    weights += 1  # such that amplicons without estimated reads are still spread over the tasks
+    cumulative = np.cumsum(weights)
+    bounds = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, ntasks) / ntasks) if len(amplicons) else []
+    bounds = [0] + sorted(set(int(b) for b in bounds if 0 < b < len(amplicons))) + [len(amplicons)]
+
+    tasks = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        regions = []
+        for i in range(lo, hi):
+            chrom, start, end, name = amplicons[i]
+            if regions and regions[-1][0] == chrom and start <= regions[-1][2]:
+                ref, region_start, region_end, first, _ = regions[-1]
+                regions[-1] = (ref, region_start, max(region_end, end), first, i + 1)
+            else:
+                regions.append((chrom, start, end, i, i + 1))
+        if regions:
+            tasks.append(regions)
+    return tasks
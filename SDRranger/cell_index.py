@@ -0,0 +1,194 @@
+import os
+import time
+import logging
+import tempfile
+import itertools
+import pysam
+import numpy as np
+from . import misc
+from .encoding import Interner
+
+log = logging.getLogger(__name__)
+
+
+def cell_index_fpath(bam_fpath):
+    return bam_fpath + '.cbi.npz'
+
+
+class CellIndexBuilder:
+    """
+    Collects the virtual offset ranges of the reads of each cell barcode in one shard, merging
+    consecutive reads of the same cell into one range. Cell barcodes are ids of the given
+    barcode encoder. Saved shards are merged into the index of the whole bam file by
+    merge_cell_indexes.
+    """
+    def __init__(self, cb_encoder):
+        self.cb_encoder = cb_encoder
+        self.cb_ids, self.starts, self.ends = [], [], []
+
+    def add(self, bc_id, start, end):
+        if self.cb_ids and self.cb_ids[-1] == bc_id and self.ends[-1] == start:
+            self.ends[-1] = end
+        else:
+            self.cb_ids.append(bc_id)
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def save(self, shard_fpath):
+        np.savez(
+                shard_fpath,
+                barcodes=np.array(self.cb_encoder.values, dtype=str),
+                cb_ids=np.array(self.cb_ids, dtype=np.int64),
+                starts=np.array(self.starts, dtype=np.uint64),
+                ends=np.array(self.ends, dtype=np.uint64))
+
+
+def merge_cell_indexes(shard_fpaths, bam_fpath, shifts=None):
+    """
+    Merges shard indexes, in order, into the cell index of bam_fpath. shifts are the compressed
+    offset shifts of the shards, if their offsets refer to shard bams concatenated with
+    misc.concatenate_bams. The shard files are removed.
+    """
+    shards = [np.load(shard_fpath) for shard_fpath in shard_fpaths]
+    sorted_complete_bcs = sorted(set(bc for shard in shards for bc in shard['barcodes'].tolist()))
+    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
+    cb_ids, starts, ends = [], [], []
+    for i, shard in enumerate(shards):
+        shift = np.uint64(shifts[i] << 16 if shifts else 0)
+        cb_ids.append(misc.remap_ids(shard['cb_ids'], shard['barcodes'].tolist(), j_given_complete_bc))
+        starts.append(shard['starts'] + shift)
+        ends.append(shard['ends'] + shift)
+    cb_ids = np.concatenate(cb_ids) if cb_ids else np.zeros(0, dtype=np.int64)
+    order = np.argsort(cb_ids, kind='stable')
+    ptr = np.zeros(len(sorted_complete_bcs) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cb_ids, minlength=len(sorted_complete_bcs)), out=ptr[1:])
+    stat = misc.file_stat(bam_fpath)
+    np.savez(
+            cell_index_fpath(bam_fpath),
+            barcodes=np.array(sorted_complete_bcs, dtype=str),
+            ptr=ptr,
+            starts=np.concatenate(starts)[order] if starts else np.zeros(0, dtype=np.uint64),
+            ends=np.concatenate(ends)[order] if ends else np.zeros(0, dtype=np.uint64),
+            bam=np.array([stat['size'], stat['mtime_ns']], dtype=np.int64))
+    for shard_fpath in shard_fpaths:
+        os.remove(shard_fpath)
+
+
+class CellIndex:
+    """
+    Virtual offset ranges of the reads of each cell barcode of a coordinate sorted bam file, in
+    file order, stored next to the bam file. Covers the reads of the counting shards, i.e. all
+    reads placed on a reference.
+    """
+    def __init__(self, bam_fpath):
+        self.bam_fpath = bam_fpath
+        self.fpath = cell_index_fpath(bam_fpath)
+        self._arrays = None
+        self._idx_given_bc = None
+
+    def _load(self):
+        if self._arrays is None:
+            with np.load(self.fpath) as npz:
+                self._arrays = {key: npz[key] for key in npz.files}
+        return self._arrays
+
+    def is_current(self):
+        """Whether the index exists and was built for the bam file as it is now."""
+        if not os.path.exists(self.fpath) or not os.path.exists(self.bam_fpath):
+            return False
+        stat = misc.file_stat(self.bam_fpath)
+        return self._load()['bam'].tolist() == [stat['size'], stat['mtime_ns']]
+
+    @property
+    def barcodes(self):
+        return self._load()['barcodes'].tolist()
+
+    def ranges(self, cbs):
+        """
+        Sorted, non-overlapping virtual offset ranges holding exactly the reads of the given cell
+        barcodes. Adjacent ranges of different cells are joined.
+        """
+        arrays = self._load()
+        if self._idx_given_bc is None:
+            self._idx_given_bc = {bc: j for j, bc in enumerate(self.barcodes)}
+        idxs = []
+        for cb in cbs:
+            if cb in self._idx_given_bc:
+                idxs.append(self._idx_given_bc[cb])
+            else:
+                log.warning(f'Cell barcode {cb} not found in {self.fpath}')
+        ptr = arrays['ptr']
+        range_idxs = np.concatenate([np.arange(ptr[j], ptr[j + 1]) for j in idxs] or [np.zeros(0, dtype=np.int64)])
+        starts, ends = arrays['starts'][range_idxs], arrays['ends'][range_idxs]
+        order = np.argsort(starts)
+        starts, ends = starts[order], ends[order]
+        if len(starts):
+            joined = np.append(True, starts[1:] != ends[:-1])
+            starts, ends = starts[joined], np.append(ends[np.flatnonzero(joined)[1:] - 1], ends[-1])
+        return starts, ends
+
+
+def fetch_ranges(bam, starts, ends):
+    """
+    Iterates the reads in the virtual offset ranges by seeking to the start of each range.
+    """
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        bam.seek(start)
+        reads = bam.fetch(until_eof=True)
+        while bam.tell() < end:
+            yield next(reads)
+
+
+def index_parallel_wrapper(args):
+    shard, input_bam_fpath, shard_index_fpath = args
+    t0 = time.time()
+    builder = CellIndexBuilder(Interner())
+    linear_index = misc.read_bai_linear_index(input_bam_fpath + '.bai')
+    with pysam.AlignmentFile(input_bam_fpath) as bam:
+        for read, start, end in misc.fetch_shard_with_offsets(bam, shard, linear_index):
+            builder.add(builder.cb_encoder.encode(read.get_tag('CB')), start, end)
+    builder.save(shard_index_fpath)
+    return shard, time.time() - t0
+
+
+def build_cell_index(input_bam_fpath, threads=1):
+    """
+    Writes the cell index of an indexed, coordinate sorted bam file with a sharded scan.
+    """
+    shards = misc.get_genomic_shards(input_bam_fpath, threads * misc.shards_per_thread)
+    with misc.worker_pool(threads) as pool, \
+            tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(input_bam_fpath))) as tmpdirname:
+        shard_index_fpaths = [os.path.join(tmpdirname, f'{i}.cbi.npz') for i in range(len(shards))]
+        for shard, elapsed in pool.imap(
+                index_parallel_wrapper,
+                zip(shards, itertools.repeat(input_bam_fpath), shard_index_fpaths)):
+            log.info(f'  {misc.shard_str(shard)} ({elapsed:.1f}s)')
+        merge_cell_indexes(shard_index_fpaths, input_bam_fpath)
+
+
+def iter_cell_reads(bam_fpath, cbs, threads=1):
+    """
+    Iterates the reads of the given cell barcodes in file order by seeking with the cell index of
+    the bam file, which is built first if it is missing or outdated.
+    """
+    index = CellIndex(bam_fpath)
+    if not index.is_current():
+        log.info(f'Building cell index {index.fpath}...')
+        build_cell_index(bam_fpath, threads)
+        index = CellIndex(bam_fpath)
+    starts, ends = index.ranges(cbs)
+    with pysam.AlignmentFile(bam_fpath) as bam:
+        yield from fetch_ranges(bam, starts, ends)
+
+
+def extract_cells(arguments):
+    """
+    Writes the reads of the given cell barcodes to a new bam file.
+    """
+    with pysam.AlignmentFile(arguments.SDR_bam_file) as bam_in, \
+            pysam.AlignmentFile(arguments.output_bam, 'wb', template=bam_in) as bam_out:
+        nreads = 0
+        for read in iter_cell_reads(arguments.SDR_bam_file, arguments.cell_barcodes, arguments.threads):
+            bam_out.write(read)
+            nreads += 1
+    log.info(f'{nreads:,d} reads of {len(arguments.cell_barcodes):,d} cell barcodes written to {arguments.output_bam}')
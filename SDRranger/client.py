@@ -0,0 +1,34 @@
+"""
+Thin client of the SDRranger service, see SDRranger serve. Takes the same arguments as SDRranger
+and runs the command in the service listening on the Unix socket given by SDRRANGER_SOCKET,
+printing its log messages as they come. Only the standard library is imported, so starting the
+client is fast.
+"""
+import os
+import sys
+import json
+import time
+import socket
+
+
+def main():
+    socket_fpath = os.environ.get('SDRRANGER_SOCKET')
+    if not socket_fpath:
+        sys.exit('SDRRANGER_SOCKET must be set to the socket of a running SDRranger service')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_fpath)
+        client.sendall((json.dumps({'argv': sys.argv[1:], 'cwd': os.getcwd()}) + '\n').encode())
+        for line in client.makefile('r'):
+            message = json.loads(line)
+            if 'log' in message:
+                timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(message['created']))
+                print(f'{timestamp}   {message["log"]}', file=sys.stderr, flush=True)
+            if 'exit' in message:
+                if message['output']:
+                    print(message['output'], file=sys.stderr if message['exit'] else sys.stdout)
+                sys.exit(message['exit'])
+    sys.exit('Connection to the SDRranger service lost before the job was done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import os
+import gzip
+import logging
+import shutil
+import threading
+import numpy as np
+from contextlib import contextmanager
+from . import misc
+from . import star
+from .aggregate import join_names
+from .RNAcount import process_RNA_fastqs
+from .gDNAcount import process_gDNA_fastqs
+
+log = logging.getLogger(__name__)
+
+
+modalities = ('RNA', 'gDNA')
+
+
+class PipelineThread(threading.Thread):
+    """
+    Runs the pipeline of one modality, keeping its exception to be raised once both are done. The
+    thread is a daemon, so that a terminated run does not wait for it.
+    """
+    def __init__(self, modality, func, *args):
+        super().__init__(name=modality, daemon=True)
+        self._func = func
+        self._args = args
+        self.exception = None
+
+    def run(self):
+        try:
+            self._func(*self._args)
+        except BaseException as e:
+            self.exception = e
+
+
+@contextmanager
+def modality_log_prefix():
+    """
+    Prefixes the log messages of the pipeline threads, and of the threads they start, with their
+    modality, as the lines of both pipelines interleave.
+    """
+    factory = logging.getLogRecordFactory()
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        modality = record.threadName.split('_')[0]
+        if modality in modalities:
+            record.msg = f'[{modality}] {record.msg}'
+        return record
+    logging.setLogRecordFactory(record_factory)
+    try:
+        yield
+    finally:
+        logging.setLogRecordFactory(factory)
+
+
+def write_joint_barcodes(output_dir):
+    """
+    Writes joint_barcodes.tsv.gz, listing each cell barcode of the RNA or gDNA read count matrix
+    with its number of RNA and gDNA reads.
+    """
+    bcs_given_modality, reads_given_modality = [], []
+    for modality in modalities:
+        M, bcs, features = misc.read_matrix(os.path.join(output_dir, modality, 'raw_reads_bc_matrix'))
+        bcs_given_modality.append(bcs)
+        reads_given_modality.append(np.asarray(M.sum(axis=0)).reshape(-1))
+    sorted_bcs, idxs_given_modality = join_names(bcs_given_modality)
+    reads = np.zeros((len(sorted_bcs), len(modalities)), dtype=np.int64)
+    for k, (idxs, nreads) in enumerate(zip(idxs_given_modality, reads_given_modality)):
+        reads[idxs, k] = nreads
+    log.info(f'{len(sorted_bcs):,d} barcodes, {int(np.count_nonzero(reads.all(axis=1))):,d} with reads of both modalities')
+    with gzip.open(os.path.join(output_dir, 'joint_barcodes.tsv.gz'), 'wt') as out:
+        out.write('\t'.join(['barcode'] + [f'{modality}_reads' for modality in modalities]) + '\n')
+        for bc, bc_reads in zip(sorted_bcs, reads):
+            out.write('\t'.join([bc] + [str(n) for n in bc_reads]) + '\n')
+
+
+def count_all(arguments, genome=None):
+    """
+    Runs count_RNA and count_gDNA on the fastqs of one experiment together, writing their outputs
+    to the RNA and gDNA subdirectories of the output directory, and a joint barcode list.
+
+    Both pipelines run at the same time with half of the threads each, and share one pool of
+    worker processes, one STAR genome in shared memory and the barcode decoders, which are built
+    once before the workers start so that the workers inherit them. A star.SharedGenome, e.g. of
+    the service, is used instead of loading one for this run. The log messages of each pipeline
+    start with its modality.
+    """
+    arguments_given_modality = {modality: arguments.for_modality(modality) for modality in modalities}
+    os.makedirs(arguments.output_dir, exist_ok=True)
+
+    log.info('Building barcode decoders')
+    for modality_arguments in arguments_given_modality.values():
+        misc.build_bc_decoders(modality_arguments.config)
+
+    genome = genome or star.SharedGenome(
+            arguments.star_ref_dir,
+            os.path.join(arguments.output_dir, 'STAR_files', 'genome_'))
+    pipelines = [
+        PipelineThread('RNA', process_RNA_fastqs, arguments_given_modality['RNA'], genome),
+        PipelineThread('gDNA', process_gDNA_fastqs, arguments_given_modality['gDNA'], genome),
+    ]
+    with genome, misc.shared_worker_pool(arguments.threads), modality_log_prefix():
+        for pipeline in pipelines:
+            pipeline.start()
+        for pipeline in pipelines:
+            pipeline.join()
+    star_out_dir = os.path.join(arguments.output_dir, 'STAR_files')
+    if os.path.exists(star_out_dir):
+        shutil.rmtree(star_out_dir)
+    for pipeline in pipelines:
+        if pipeline.exception is not None:
+            log.error(f'{pipeline.name} run failed')
+            raise pipeline.exception
+
+    log.info('Writing joint barcode list...')
+    write_joint_barcodes(arguments.output_dir)
+    log.info('Done')
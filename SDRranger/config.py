@@ -2,7 +2,7 @@ import logging
 import os
 import json
 
-from .misc import gzip_friendly_open
+from .misc import gzip_friendly_open, matrix_formats
 
 class CommandLineArguments:
     def __new__(cls, arguments):
@@ -15,10 +15,10 @@ class CommandLineArgumentsBase:
     def __init__(self, arguments):
         self._arguments = arguments
 
-        try:
+        if arguments.get("--config"):
             with gzip_friendly_open(arguments["--config"]) as f:
                 self._config = json.load(f)
-        except KeyError:
+        else:
             self._config = None
 
     def _comma_delimited_arg(self, key):
@@ -29,7 +29,7 @@ class CommandLineArgumentsBase:
     @property
     def command(self):
         # We have to do this weird loop to deal with the way docopt stores the command name
-        for possible_command in ('count_gDNA', 'preprocess_gDNA', 'count_RNA', 'count_matrix', 'simulate_reads'):
+        for possible_command in ('count_gDNA', 'preprocess_gDNA', 'count_RNA', 'count_all', 'scatter_RNA', 'scatter_gDNA', 'scatter_count', 'gather', 'serve', 'count_matrix', 'genotype_gDNA', 'aggregate', 'extract_cells', 'simulate_reads'):
             if self._arguments.get(possible_command):
                 return possible_command
     @property
@@ -56,10 +56,56 @@ class AnalysisCommandLineArguments(CommandLineArgumentsBase):
     def fastq_dir(self):
         return self._arguments['<fastq_dir>']
 
+    def updated(self, values):
+        """Arguments with the raw docopt values replaced by values."""
+        return AnalysisCommandLineArguments({**self._arguments, **values})
+
+    def for_modality(self, modality):
+        """
+        Arguments of the count_RNA or count_gDNA run of a count_all run: the fastqs and config of
+        the modality, the modality subdirectory of the output directory and half of the threads.
+        """
+        rna_threads = self.threads - self.threads // 2
+        return self.updated({
+            'count_all': False,
+            f'count_{modality}': True,
+            '<fastq_dir>': self._arguments[f'<{modality}_fastq_dir>'],
+            '--config': self._arguments[f'--{modality}-config'],
+            '--output-dir': os.path.join(self.output_dir, modality),
+            '--threads': str(rna_threads if modality == 'RNA' else max(1, self.threads - rna_threads))})
+
+    @property
+    def partial_dirs(self):
+        return self._arguments['<partial_dir>']
+
+    @property
+    def socket(self):
+        return self._arguments['--socket']
+
+    @property
+    def shard(self):
+        return int(self._arguments['--shard'])
+
+    @property
+    def nshards(self):
+        return int(self._arguments['--nshards'])
+
     @property
     def SDR_bam_file(self):
         return self._arguments['<SDR_bam_file>']
 
+    @property
+    def count_dirs(self):
+        return self._arguments['<count_dir>']
+
+    @property
+    def cell_barcodes(self):
+        return self._arguments['<cell_barcode>']
+
+    @property
+    def output_bam(self):
+        return self._arguments['--output-bam']
+
     @property
     def star_ref_dir(self):
         return self._arguments['--STAR-ref-dir']
@@ -68,6 +114,10 @@ class AnalysisCommandLineArguments(CommandLineArgumentsBase):
     def star_output_path(self):
         return self._arguments['--STAR-output']
 
+    @property
+    def stream_STAR(self):
+        return self._arguments['--stream-STAR']
+
     @property
     def threads(self):
         return int(self._arguments['--threads'])
@@ -76,6 +126,48 @@ class AnalysisCommandLineArguments(CommandLineArgumentsBase):
     def output_dir(self):
         return self._arguments['--output-dir']
 
+    @property
+    def cb_id_tag(self):
+        return self._arguments['--cb-id-tag']
+
+    @property
+    def cell_index(self):
+        return self._arguments['--cell-index']
+
+    @property
+    def dedup_bam(self):
+        return self._arguments['--dedup-bam']
+
+    @property
+    def amplicons(self):
+        return self._arguments['--amplicons']
+
+    @property
+    def sites(self):
+        return self._arguments['--sites']
+
+    @property
+    def min_mapq(self):
+        return int(self._arguments['--min-mapq'])
+
+    @property
+    def min_base_quality(self):
+        return int(self._arguments['--min-base-quality'])
+
+    @property
+    def umi_max_dist(self):
+        if self._arguments['--umi-max-dist'] is None:
+            return None
+        return int(self._arguments['--umi-max-dist'])
+
+    @property
+    def matrix_formats(self):
+        formats = self._comma_delimited_arg('--format')
+        for fmt in formats:
+            if fmt not in matrix_formats:
+                raise ValueError(f'Unknown matrix format {fmt}, must be one of {", ".join(matrix_formats)}')
+        return formats
+
 class SimulationCommandLineArguments(CommandLineArgumentsBase):
     def __init__(self, arguments):
         super().__init__(arguments)
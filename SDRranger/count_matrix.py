@@ -11,6 +11,8 @@ def build_count_matrices_from_bam(arguments):
         break
     if read.has_tag('UB'):
         log.info('Detected bam file with UMIs...')
+        if arguments.amplicons:
+            raise ValueError('--amplicons requires a gDNA bam file, RNA reads are counted per feature')
         RNA_count_matrix(arguments, arguments.SDR_bam_file)
     else:
         log.info('Detected bam file without UMIs...')
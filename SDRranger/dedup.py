@@ -0,0 +1,67 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+dedup_count_tag = 'XD'  # number of reads of the molecule, on the representative read in the deduplicated bam
+
+
+def read_rank(read):
+    """Representative reads have the highest mapping quality, then the highest mean base quality."""
+    quals = read.query_qualities
+    return read.mapping_quality, sum(quals) / len(quals) if quals else 0
+
+
+class MoleculeDeduplicator:
+    """
+    Writes one representative read per (cell, feature, umi) molecule of a shard of a coordinate
+    sorted bam file, tagged with the number of reads of the molecule. Reads are assigned to the
+    molecule of their first feature.
+
+    The representatives are picked while the umis are corrected: add is called with every read and
+    its raw umi, and finalize with the umi maps of each feature once it is final. Only the rank,
+    ordinal and read count of the best read of each raw and then corrected umi are kept, not the
+    reads. write is then called with the same reads in the same order, with corrected umis, and
+    writes the representatives, keeping the output coordinate sorted.
+    """
+    def __init__(self, bam_out):
+        self.bam_out = bam_out
+        self.nmolecules = 0
+        self._nadded = 0
+        self._nwritten = 0
+        self._molecules_given_feature_then_bc = {}
+        self._nreads_given_representative = {}
+
+    def add(self, read, bc_id, feature_id, umi):
+        molecules = self._molecules_given_feature_then_bc.setdefault(feature_id, {}).setdefault(bc_id, {})
+        rank = read_rank(read)
+        molecule = molecules.get(umi)
+        if molecule is None:
+            molecules[umi] = [rank, self._nadded, 1]
+        else:
+            molecule[2] += 1
+            if rank > molecule[0]:
+                molecule[0], molecule[1] = rank, self._nadded
+        self._nadded += 1
+
+    def finalize(self, feature_id, umi_map_given_bc):
+        for bc_id, molecules in self._molecules_given_feature_then_bc.pop(feature_id, {}).items():
+            umi_map = umi_map_given_bc[bc_id]
+            corrected_molecules = {}
+            for umi, (rank, ordinal, nreads) in molecules.items():
+                molecule = corrected_molecules.get(umi_map[umi])
+                if molecule is None:
+                    corrected_molecules[umi_map[umi]] = [rank, ordinal, nreads]
+                else:
+                    molecule[2] += nreads
+                    if (rank, -ordinal) > (molecule[0], -molecule[1]):
+                        molecule[0], molecule[1] = rank, ordinal
+            for rank, ordinal, nreads in corrected_molecules.values():
+                self._nreads_given_representative[ordinal] = nreads
+            self.nmolecules += len(corrected_molecules)
+
+    def write(self, read):
+        nreads = self._nreads_given_representative.pop(self._nwritten, None)
+        self._nwritten += 1
+        if nreads is not None:
+            read.set_tag(dedup_count_tag, nreads)
+            self.bam_out.write(read)
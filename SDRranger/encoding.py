@@ -0,0 +1,162 @@
+import logging
+import hashlib
+import numpy as np
+
+from .misc import gx_gn_tups_from_read
+
+log = logging.getLogger(__name__)
+
+cb_id_tag = 'XI'  # optional integer cell barcode id, see CBEncoder
+
+_umi_to_base4 = str.maketrans('ACGT', '0123')
+_base4_to_umi = str.maketrans('0123', 'ACGT')
+
+
+class Interner:
+    """
+    Assigns consecutive integer ids to hashable values in order of first appearance.
+    """
+    def __init__(self, values=()):
+        self.values = list(values)
+        self._id_given_value = {value: i for i, value in enumerate(self.values)}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        try:
+            return self._id_given_value[value]
+        except KeyError:
+            self._id_given_value[value] = len(self.values)
+            self.values.append(value)
+            return len(self.values) - 1
+
+    def decode(self, value_id):
+        return self.values[value_id]
+
+
+class UMIEncoder:
+    """
+    Packs umis of up to 31 bases into a uint64, two bits per base below a leading 1 bit that marks
+    the length. Umis that can not be packed, e.g. containing N or joined from several umi blocks with
+    '.', are interned and get ids with the highest bit set.
+    """
+    max_packed_len = 31
+    interned_bit = 1 << 63
+
+    def __init__(self, interned=()):
+        self._interner = Interner(interned)
+
+    @property
+    def interned(self):
+        """Umis that could not be packed, indexed by their id."""
+        return self._interner.values
+
+    def encode(self, umi):
+        if len(umi) <= self.max_packed_len and not umi.strip('ACGT'):
+            return (1 << 2 * len(umi)) | (int(umi.translate(_umi_to_base4), 4) if umi else 0)
+        return self.interned_bit | self._interner.encode(umi)
+
+    def decode(self, code):
+        if code & self.interned_bit:
+            return self._interner.decode(code ^ self.interned_bit)
+        return np.base_repr(code, 4)[1:].translate(_base4_to_umi)
+
+    def stable_code(self, code):
+        """
+        Code that does not depend on the encoder, for storing umis across runs. Interned umis are
+        replaced by a 63 bit hash of their sequence, with the highest bit set.
+        """
+        if code & self.interned_bit:
+            digest = hashlib.blake2b(self.decode(code).encode(), digest_size=8).digest()
+            return self.interned_bit | (int.from_bytes(digest, 'little') >> 1)
+        return code
+
+
+class CBEncoder:
+    """
+    Encodes cell barcodes made only of barcode list blocks as their index in the product of the
+    whitelists. The ids are the same in every process and every run with the same configuration.
+    """
+    def __init__(self, whitelists):
+        self.whitelists = whitelists
+        self._idx_given_bc = [{bc: i for i, bc in enumerate(whitelist)} for whitelist in whitelists]
+        self.size = int(np.prod([len(whitelist) for whitelist in whitelists], dtype=object))
+
+    @classmethod
+    def from_config(cls, config, include_random=True):
+        """
+        Returns None if the cell barcode contains random barcode blocks, which have no whitelist.
+        Random blocks only enter the RNA cell barcode, the gDNA one passes include_random=False.
+        """
+        whitelists = []
+        for block in config["barcode_struct_r1"]["blocks"]:
+            if block["blockfunction"] in ("discard", "UMI") or block["blocktype"] == "constantRegion":
+                continue
+            if block["blocktype"] == "barcodeList":
+                whitelists.append(block["sequence"])
+            elif include_random:
+                return None
+        return cls(whitelists)
+
+    def encode(self, cb):
+        cb_id = 0
+        for bc, idx_given_bc in zip(cb.split('.'), self._idx_given_bc):
+            cb_id = cb_id * len(idx_given_bc) + idx_given_bc[bc]
+        return cb_id
+
+    def decode(self, cb_id):
+        bcs = []
+        for whitelist in reversed(self.whitelists):
+            cb_id, idx = divmod(cb_id, len(whitelist))
+            bcs.append(whitelist[idx])
+        return '.'.join(reversed(bcs))
+
+
+def get_cb_id_encoder(config, include_random=True):
+    """CBEncoder for the optional cell barcode id tag, which must fit into an unsigned 32 bit tag."""
+    cb_encoder = CBEncoder.from_config(config, include_random=include_random)
+    if cb_encoder is None:
+        raise ValueError('Cell barcode id tag requires cell barcodes made only of barcode list blocks')
+    if cb_encoder.size > 1 << 32:
+        raise ValueError(f'Cell barcode id tag requires fewer than 2^32 possible cell barcodes, got {cb_encoder.size:,d}')
+    return cb_encoder
+
+
+class ReadEncoder:
+    """
+    Integer encodings of the cell barcode, umi and features of reads. Without a CBEncoder, cell
+    barcodes are interned. Ids are local to the encoder, results keyed by them are passed on
+    together with the encoder for decoding.
+    """
+    def __init__(self, cb_encoder=None):
+        self.cb = cb_encoder if cb_encoder is not None else Interner()
+        self.umi = UMIEncoder()
+        self.feature = Interner()
+        self._feature_ids_given_tags = {}
+
+    def cb_id(self, read):
+        return self.cb.encode(read.get_tag('CB'))
+
+    def umi_code(self, read, tag='UR'):
+        return self.umi.encode(read.get_tag(tag))
+
+    def feature_ids(self, read):
+        try:
+            tags = (read.get_tag('GX'), read.get_tag('GN'))
+        except KeyError:
+            return []
+        try:
+            return self._feature_ids_given_tags[tags]
+        except KeyError:
+            feature_ids = [self.feature.encode(gx_gn_tup) for gx_gn_tup in gx_gn_tups_from_read(read)]
+            self._feature_ids_given_tags[tags] = feature_ids
+            return feature_ids
+
+
+def id_pair_arrays(id_pairs):
+    """
+    Splits (bc_id, feature_id) keys into a bc id and a feature id array.
+    """
+    id_pairs = np.array(list(id_pairs), dtype=np.int64).reshape(-1, 2)
+    return id_pairs[:, 0], id_pairs[:, 1]
@@ -8,13 +8,19 @@ import numpy as np
 import pickle
 import subprocess
 import shutil
+import time
 import scipy
 from . import misc
+from . import encoding
+from . import read_table
+from . import cell_index
+from . import amplicon
+from . import genotype
+from . import manifest
+from . import star
 from Bio import SeqIO
-from collections import defaultdict, Counter
+from collections import Counter
 from glob import glob
-from multiprocessing import Pool
-from scipy.sparse import lil_matrix
 from .bc_decoders import BCDecoder, SBCDecoder
 
 
@@ -24,7 +30,29 @@ pysam.set_verbosity(0)
 
 n_first_seqs = 10000  # n seqs for finding score threshold
 
-def preprocess_gDNA_fastqs(arguments):
+def gDNA_run_manifest(arguments, paired_fpaths):
+    return manifest.RunManifest(
+            arguments.output_dir,
+            'gDNA',
+            [fpath for fpaths in paired_fpaths for fpath in fpaths] + list(arguments.star_output_path or []),
+            manifest.config_hash(arguments, ['cb_id_tag']))
+
+
+def preprocess_gDNA_fastqs(arguments, run_manifest=None):
+    paired_align_fqs_and_tags_fpaths = []
+    namepairidxs = []
+    for align_fqs_and_tags_fpaths, namepairidx in iter_preprocessed_gDNA_lanes(arguments, run_manifest):
+        paired_align_fqs_and_tags_fpaths.append(align_fqs_and_tags_fpaths)
+        namepairidxs.append(namepairidx)
+    return paired_align_fqs_and_tags_fpaths, namepairidxs
+
+
+def iter_preprocessed_gDNA_lanes(arguments, run_manifest=None, threads=None):
+    """
+    Finds barcodes of each lane, yielding the fastqs to align and the tags file of the lane and
+    its name pair index as soon as the lane is done.
+    """
+    threads = threads or arguments.threads
     if not os.path.exists(arguments.output_dir):
         os.makedirs(arguments.output_dir)
 
@@ -35,14 +63,12 @@ def preprocess_gDNA_fastqs(arguments):
         log.info(f'  {fpath2}')
         if i < len(paired_fpaths)-1:
             log.info('  -')
-
-    paired_align_fqs_and_tags_fpaths = []
-    namepairidxs = []
+    if run_manifest is None:
+        run_manifest = gDNA_run_manifest(arguments, paired_fpaths)
 
     bc_fq_idx, paired_fq_idx = misc.determine_bc_and_paired_fastq_idxs(paired_fpaths, arguments.config)
     log.info(f'Detected barcodes in read{bc_fq_idx+1} files')
 
-    process_fastqs_func = serial_process_gDNA_fastqs if arguments.threads == 1 else parallel_process_gDNA_fastqs
     for fpath_tup in paired_fpaths:
         bc_fq_fpath = fpath_tup[bc_fq_idx]
         paired_fq_fpath = fpath_tup[paired_fq_idx]
@@ -54,9 +80,9 @@ def preprocess_gDNA_fastqs(arguments):
         namepairidx_fname = f'namepairidx_{misc.file_prefix_from_fpath(bc_fq_fpath)}.pkl'
         tags_fpath = os.path.join(arguments.output_dir, tags_fname)
         if bc_fq_idx == 0:
-            paired_align_fqs_and_tags_fpaths.append((sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath))
+            align_fqs_and_tags_fpaths = (sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath)
         else:
-            paired_align_fqs_and_tags_fpaths.append((sans_bc_paired_fq_fpath, sans_bc_fq_fpath, tags_fpath))
+            align_fqs_and_tags_fpaths = (sans_bc_paired_fq_fpath, sans_bc_fq_fpath, tags_fpath)
 
         log.info('Processing files:')
         log.info(f'  barcode fastq: {bc_fq_fpath}')
@@ -66,62 +92,107 @@ def preprocess_gDNA_fastqs(arguments):
         log.info(f'  tags file:     {tags_fpath}')
 
         namepairidx = misc.get_namepair_index(bc_fq_fpath, paired_fq_fpath)
-        namepairidxs.append(namepairidx)
         with open(namepairidx_fname, "wb") as pkl:
             pickle.dump(namepairidx, pkl)
 
-        if all(os.path.exists(fpath) for fpath in [sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath]):
+        stage = f'barcodes:{tags_fname}'
+        if run_manifest.is_done(stage, [sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath]):
             log.info('Barcode output found. Skipping barcode detection')
-        else:
-            process_fastqs_func(
+        elif arguments.threads == 1:
+            serial_process_gDNA_fastqs(
                     arguments,
                     bc_fq_fpath,
                     paired_fq_fpath,
                     sans_bc_fq_fpath,
                     sans_bc_paired_fq_fpath,
                     tags_fpath)
+            run_manifest.mark_done(stage, [sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath])
+        else:
+            parallel_process_gDNA_fastqs(
+                    arguments,
+                    bc_fq_fpath,
+                    paired_fq_fpath,
+                    sans_bc_fq_fpath,
+                    sans_bc_paired_fq_fpath,
+                    tags_fpath,
+                    run_manifest,
+                    stage,
+                    threads)
+            run_manifest.mark_done(stage, [sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath])
 
-    return paired_align_fqs_and_tags_fpaths, namepairidxs
+        yield align_fqs_and_tags_fpaths, namepairidx
 
-def process_gDNA_fastqs(arguments):
+def process_gDNA_fastqs(arguments, genome=None, count=True):
     """
     Output single file with parsed bcs from bc_fastq in read names and seqs from paired_fastq.
+
+    With a star.SharedGenome, the lanes are aligned with that genome, as in count_all, instead of
+    one loaded for this run. Without count, the run stops at the sorted bam, as in scatter_gDNA.
     """
     star_w_bc_fpath = os.path.join(arguments.output_dir, 'gDNA_with_bc.bam')
     star_w_bc_sorted_fpath = os.path.join(arguments.output_dir, 'gDNA_with_bc.sorted.bam')
-    if os.path.exists(star_w_bc_sorted_fpath):
+    if not os.path.exists(arguments.output_dir):
+        os.makedirs(arguments.output_dir)
+
+    paired_fpaths = misc.find_paired_fastqs_in_dir(arguments.fastq_dir)
+    run_manifest = gDNA_run_manifest(arguments, paired_fpaths)
+    if run_manifest.is_done('sort', [star_w_bc_sorted_fpath, star_w_bc_sorted_fpath + '.bai']):
         log.info('Sorted STAR results found. Skipping ahead...')
         completed = 2
-    elif os.path.exists(star_w_bc_fpath):
+    elif run_manifest.is_done('barcodes', [star_w_bc_fpath]):
         log.info('STAR results found. Skipping ahead...')
         completed = 1
     else:
         completed = 0
 
-    if not os.path.exists(arguments.output_dir):
-        os.makedirs(arguments.output_dir)
     # find barcodes, write to file, remove from reads before mapping
     # map reads
     # Add barcodes etc to bam file
     # Sort, index
-    if completed < 1:
+    unsorted_fpath = star_w_bc_fpath
+    if completed < 1 and arguments.stream_STAR:
+        log.info('Writing output to:')
+        log.info(f'  {star_w_bc_sorted_fpath}')
+        # Tagged reads go straight into the sorter, without an unsorted bam file
+        with manifest.atomic_output(star_w_bc_sorted_fpath) as tmp_sorted_fpath:
+            with misc.bam_sorter(tmp_sorted_fpath, arguments.threads) as fifo_fpath:
+                paired_align_fqs_and_tags_fpaths = stream_STAR_and_tag_gDNA(arguments, run_manifest, len(paired_fpaths), fifo_fpath, genome)
+        unsorted_fpath = None
+        for fpaths in paired_align_fqs_and_tags_fpaths:
+            for fpath in fpaths:
+                os.remove(fpath)
+        star_out_dir = os.path.join(arguments.output_dir, 'STAR_files')
+        if os.path.exists(star_out_dir):
+            shutil.rmtree(star_out_dir)  # clean up intermediate STAR files
+    elif completed < 1:
         log.info('Writing output to:')
         log.info(f'  {star_w_bc_fpath}')
     
         if not arguments.star_output_path:
-            paired_align_fqs_and_tags_fpaths, namepairidxs = preprocess_gDNA_fastqs(arguments)
-
-            log.info(f'Running STAR alignment...')
+            # STAR aligns each lane in the background as soon as its barcodes are found, while
+            # the barcodes of the next lane are found, each with part of the threads.
+            star_threads, parse_threads, overlap = misc.lane_threads(arguments.threads, len(paired_fpaths))
+            if overlap:
+                log.info(f'Aligning with {star_threads} threads while finding barcodes with {parse_threads}')
+            paired_align_fqs_and_tags_fpaths = []
+            namepairidxs = []
+            def iter_star_args():
+                for align_fqs_and_tags_fpaths, namepairidx in iter_preprocessed_gDNA_lanes(arguments, run_manifest, parse_threads):
+                    paired_align_fqs_and_tags_fpaths.append(align_fqs_and_tags_fpaths)
+                    namepairidxs.append(namepairidx)
+                    yield arguments, align_fqs_and_tags_fpaths, run_manifest, star_threads, genome
+
+            # Lanes aligned in this run share one genome loaded into shared memory
+            genome = genome or star.SharedGenome(
+                    arguments.star_ref_dir,
+                    os.path.join(arguments.output_dir, 'STAR_files', 'genome_'),
+                    enabled=len(paired_fpaths) > 1)
             star_out_dirs = set()
             star_bam_and_tags_fpaths = []
-            for R1_fpath, R2_fpath, tags_fpath in paired_align_fqs_and_tags_fpaths:
-                log.info(f'  {R1_fpath}')
-                log.info(f'  {R2_fpath}')
-                if R1_fpath != paired_align_fqs_and_tags_fpaths[-1][0]:
-                    log.info('  -')
-                star_out_dir, star_out_fpath = run_STAR_gDNA(arguments, R1_fpath, R2_fpath)
-                star_out_dirs.add(star_out_dir)
-                star_bam_and_tags_fpaths.append((star_out_fpath, tags_fpath))
+            with genome, misc.lane_worker_pool(parse_threads, arguments.config, overlap):
+                for star_out_dir, star_out_fpath, tags_fpath in misc.background_imap(STAR_gDNA_wrapper, iter_star_args(), overlap):
+                    star_out_dirs.add(star_out_dir)
+                    star_bam_and_tags_fpaths.append((star_out_fpath, tags_fpath))
         else:
             log.info(f'Using STAR results from {arguments.star_output_path}')
             tag_fpaths = glob(os.path.join(arguments.fastq_dir, "rec_names_and_tags_*.txt"))
@@ -132,44 +203,59 @@ def process_gDNA_fastqs(arguments):
 
         log.info('Adding barcode tags to mapped reads...')
         template_bam_fpath = star_bam_and_tags_fpaths[0][0]
-        with pysam.AlignmentFile(star_w_bc_fpath, 'wb', template=pysam.AlignmentFile(template_bam_fpath)) as bam_out:
-            for (star_out_fpath, tags_fpath), namepairidx in zip(star_bam_and_tags_fpaths, namepairidxs):
-                if arguments.threads == 1 and not arguments.star_output_path:
-                    readsiter = iter(serial_gDNA_add_tags_to_reads(tags_fpath, star_out_fpath))
-                else:
-                    readsiter = iter(parallel_gDNA_add_tags_to_reads(tags_fpath, star_out_fpath, namepairidx, arguments.threads))
-                for read in readsiter:
-                    bam_out.write(read)
+        with manifest.atomic_output(star_w_bc_fpath) as tmp_star_w_bc_fpath:
+            with pysam.AlignmentFile(tmp_star_w_bc_fpath, 'wb', template=pysam.AlignmentFile(template_bam_fpath)) as bam_out:
+                for (star_out_fpath, tags_fpath), namepairidx in zip(star_bam_and_tags_fpaths, namepairidxs):
+                    if arguments.threads == 1 and not arguments.star_output_path:
+                        readsiter = iter(serial_gDNA_add_tags_to_reads(tags_fpath, star_out_fpath))
+                    else:
+                        readsiter = iter(parallel_gDNA_add_tags_to_reads(tags_fpath, star_out_fpath, namepairidx, arguments.threads))
+                    for read in readsiter:
+                        bam_out.write(read)
+        run_manifest.mark_done('barcodes', [star_w_bc_fpath])
 
-        for fpaths in paired_align_fqs_and_tags_fpaths:
-            for fpath in fpaths:
-                os.remove(fpath)
-        for star_out_dir in star_out_dirs:
-            shutil.rmtree(star_out_dir)  # clean up intermediate STAR files
+        if not arguments.star_output_path:
+            for fpaths in paired_align_fqs_and_tags_fpaths:
+                for fpath in fpaths:
+                    os.remove(fpath)
+            for star_out_dir in star_out_dirs:
+                shutil.rmtree(star_out_dir)  # clean up intermediate STAR files
     
     if completed < 2:
-        log.info('Sorting bam...')
-        pysam.sort('-@', str(arguments.threads), '-o', star_w_bc_sorted_fpath, star_w_bc_fpath)
-        os.remove(star_w_bc_fpath)  #clean up unsorted bam
+        if unsorted_fpath:
+            log.info('Sorting bam...')
+            with manifest.atomic_output(star_w_bc_sorted_fpath) as tmp_sorted_fpath:
+                pysam.sort('-@', str(arguments.threads), '-o', tmp_sorted_fpath, unsorted_fpath)
         log.info('Indexing bam...')
-        pysam.index(star_w_bc_sorted_fpath)
-
-    gDNA_count_matrix(arguments, star_w_bc_sorted_fpath)
+        manifest.index_bam(star_w_bc_sorted_fpath)
+        run_manifest.mark_done('sort', [star_w_bc_sorted_fpath, star_w_bc_sorted_fpath + '.bai'])
+        if unsorted_fpath:
+            os.remove(unsorted_fpath)  #clean up unsorted bam
+
+    if not count:
+        log.info('Done')
+        return
+
+    gDNA_count_matrix(arguments, star_w_bc_sorted_fpath, with_read_table=True, with_cell_index=arguments.cell_index)
+    if arguments.cell_index and not cell_index.CellIndex(star_w_bc_sorted_fpath).is_current():
+        log.info('Building cell index...')
+        cell_index.build_cell_index(star_w_bc_sorted_fpath, arguments.threads)
+    if arguments.sites:
+        log.info('Genotyping target sites...')
+        genotype.genotype_gDNA(arguments, star_w_bc_sorted_fpath)
     log.info('Done')
 
 
-def run_STAR_gDNA(arguments, R1_fpath, R2_fpath):
-    """
-    Run STAR aligner for gDNA files.
+def STAR_gDNA_wrapper(args):
+    arguments, (R1_fpath, R2_fpath, tags_fpath), run_manifest, threads, genome = args
+    star_out_dir, star_out_fpath = run_STAR_gDNA(arguments, R1_fpath, R2_fpath, run_manifest, threads, genome)
+    return star_out_dir, star_out_fpath, tags_fpath
 
-    Returns STAR output directory and bam path.
-    """
-    star_out_dir = os.path.join(arguments.output_dir, 'STAR_files')
-    R1_bname = misc.file_prefix_from_fpath(R1_fpath)
-    out_prefix = os.path.join(star_out_dir, f'{R1_bname}_')
+
+def STAR_gDNA_cmd(arguments, R1_fpath, R2_fpath, out_prefix, threads=None):
     cmd_star = [
         'STAR',
-        f'--runThreadN {arguments.threads}',
+        f'--runThreadN {threads or arguments.threads}',
         f'--genomeDir {arguments.star_ref_dir}',
         f'--readFilesIn {R1_fpath} {R2_fpath}',
         f'--outFileNamePrefix {out_prefix}',
@@ -181,17 +267,92 @@ def run_STAR_gDNA(arguments, R1_fpath, R2_fpath):
         if not R2_fpath.endswith('.gz'):
             raise ValueError('Paired read files must be both zipped or both unzipped')
         cmd_star.append('--readFilesCommand zcat')
+    return cmd_star
+
+
+def run_STAR_gDNA(arguments, R1_fpath, R2_fpath, run_manifest=None, threads=None, genome=None):
+    """
+    Run STAR aligner for gDNA files. With a run manifest, earlier results are only reused if
+    the alignment completed with the same genome. With a star.SharedGenome, the genome is
+    attached from shared memory.
+
+    Returns STAR output directory and bam path.
+    """
+    star_out_dir = os.path.join(arguments.output_dir, 'STAR_files')
+    R1_bname = misc.file_prefix_from_fpath(R1_fpath)
+    out_prefix = os.path.join(star_out_dir, f'{R1_bname}_')
+    cmd_star = STAR_gDNA_cmd(arguments, R1_fpath, R2_fpath, out_prefix, threads)
     star_out_fpath = f'{out_prefix}Aligned.out.bam'
-    if os.path.exists(star_out_fpath):
+    stage, params = f'STAR:{R1_bname}', {'star_ref_dir': arguments.star_ref_dir}
+    if run_manifest.is_done(stage, [star_out_fpath], params) if run_manifest else os.path.exists(star_out_fpath):
         log.info("STAR results found. Skipping alignment")
     else:
+        if genome:
+            cmd_star.extend(genome.star_options())
+        log.info(f'Running STAR alignment of {R1_fpath} and {R2_fpath}...')
         subprocess.run(cmd_star, check=True)
+        if run_manifest:
+            run_manifest.mark_done(stage, [star_out_fpath], params)
     return star_out_dir, star_out_fpath
 
 
-def process_bc_rec(config, bc_rec, aligners, decoders):
+def stream_STAR_gDNA(arguments, R1_fpath, R2_fpath, threads=None, genome=None):
+    """
+    Runs STAR for gDNA files with streamed output, see star.stream. No alignment file is written.
+    """
+    out_prefix = os.path.join(arguments.output_dir, 'STAR_files', f'{misc.file_prefix_from_fpath(R1_fpath)}_')
+    cmd_star = STAR_gDNA_cmd(arguments, R1_fpath, R2_fpath, out_prefix, threads)
+    if genome:
+        cmd_star.extend(genome.star_options())
+    log.info(f'Running STAR alignment of {R1_fpath} and {R2_fpath}, tagging its output...')
+    return star.stream(cmd_star)
+
+
+def stream_STAR_and_tag_gDNA(arguments, run_manifest, nlanes, out_bam_fpath, genome=None):
+    """
+    Aligns each lane in the background as soon as its barcodes are found, adding the barcode tags
+    to the reads as STAR outputs them, in the order of the tags file. The tagged reads of all
+    lanes are written to out_bam_fpath, which may be a named pipe. Lanes are aligned with genome
+    if given, or else with one loaded for this run.
+
+    returns
+        :list: fastqs to align and tags file of each lane
     """
-    Find barcodes etc in bc_rec 
+    star_threads, parse_threads, overlap = misc.lane_threads(arguments.threads, nlanes)
+    if overlap:
+        log.info(f'Aligning with {star_threads} threads while finding barcodes with {parse_threads}')
+    genome = genome or star.SharedGenome(
+            arguments.star_ref_dir,
+            os.path.join(arguments.output_dir, 'STAR_files', 'genome_'),
+            enabled=nlanes > 1)
+    paired_align_fqs_and_tags_fpaths = []
+    def iter_lanes():
+        for align_fqs_and_tags_fpaths, namepairidx in iter_preprocessed_gDNA_lanes(arguments, run_manifest, parse_threads):
+            paired_align_fqs_and_tags_fpaths.append(align_fqs_and_tags_fpaths)
+            yield align_fqs_and_tags_fpaths
+
+    bam_outs = []  # opened with the header of the first STAR output
+    def tag_streamed_lane(align_fqs_and_tags_fpaths):
+        R1_fpath, R2_fpath, tags_fpath = align_fqs_and_tags_fpaths
+        with stream_STAR_gDNA(arguments, R1_fpath, R2_fpath, star_threads, genome) as star_bam:
+            if not bam_outs:
+                bam_outs.append(pysam.AlignmentFile(out_bam_fpath, 'wbu', template=star_bam))
+            for read in serial_gDNA_add_tags_to_reads(tags_fpath, star_bam):
+                bam_outs[0].write(read)
+
+    try:
+        with genome, misc.lane_worker_pool(parse_threads, arguments.config, overlap):
+            for _ in misc.background_imap(tag_streamed_lane, iter_lanes(), overlap):
+                pass
+    finally:
+        for bam_out in bam_outs:
+            bam_out.close()
+    return paired_align_fqs_and_tags_fpaths
+
+
+def process_bc_rec(config, bc_rec, aligners, decoders, cb_encoder=None):
+    """
+    Find barcodes etc in bc_rec. With a cb_encoder, the integer cell barcode id is added to the tags.
     """
     blocks = config["barcode_struct_r1"]["blocks"]
     bc_seq = str(bc_rec.seq)
@@ -226,6 +387,8 @@ def process_bc_rec(config, bc_rec, aligners, decoders):
     # Cell barcode
     tags.append(('CB', '.'.join(bam_bcs)))
     tags.append(('CR', '.'.join(bam_raw_bcs)))
+    if cb_encoder is not None:
+        tags.append((encoding.cb_id_tag, cb_encoder.encode('.'.join(bam_bcs))))
     # Filler sequences
     tags.append(('FL', sum(len(seq) for seq in bam_commonseqs)))
 
@@ -244,13 +407,16 @@ def build_tags_iter(tags_fpath):
         yield read_name, tags
 
 
-def serial_gDNA_add_tags_to_reads(tags_fpath, bam_fpath):
+def serial_gDNA_add_tags_to_reads(tags_fpath, bam):
     """
-    Iterates bam reads and matching tags records and adds tags to reads.
+    Iterates bam reads and matching tags records and adds tags to reads. The bam file may be open
+    already, like streamed STAR output.
     """
     tags_iter = build_tags_iter(tags_fpath)
     read_name = 'Lorem ipsum'
-    for read in pysam.AlignmentFile(bam_fpath).fetch(until_eof=True):
+    if not isinstance(bam, pysam.AlignmentFile):
+        bam = pysam.AlignmentFile(bam)
+    for read in bam.fetch(until_eof=True):
         while not misc.names_pair(read_name, str(read.query_name)):
             read_name, tags = next(tags_iter)
         for name, val in tags:
@@ -270,7 +436,7 @@ def parallel_gDNA_add_tags_to_reads(tags_fpath, bam_fpath, namepairidx, threads)
                 for name, val in tags:
                     read.set_tag(name, val)
                 yield read
-    os.remove(sortedbampath)
+    misc.remove_readname_bam(bamidx)
 
 def tag_type_from_val(val):
     if isinstance(val, str):
@@ -298,11 +464,12 @@ def serial_process_gDNA_fastqs(arguments, bc_fq_fpath, paired_fq_fpath, sans_bc_
     log.info('Building aligners and barcode decoders')
     aligners = misc.build_bc_aligners(arguments.config)
     decoders = misc.build_bc_decoders(arguments.config)
+    cb_encoder = encoding.get_cb_id_encoder(arguments.config, include_random=False) if arguments.cb_id_tag else None
 
     log.info(f'Processing first {n_first_seqs:,d} for score threshold...')
     first_scores_recs_tags = []
     for i, bc_rec in enumerate(SeqIO.parse(misc.gzip_friendly_open(bc_fq_fpath), 'fastq')):
-        first_scores_recs_tags.append(process_bc_rec(arguments.config, bc_rec, aligners, decoders))
+        first_scores_recs_tags.append(process_bc_rec(arguments.config, bc_rec, aligners, decoders, cb_encoder))
         if i >= n_first_seqs:
             break
 
@@ -311,21 +478,24 @@ def serial_process_gDNA_fastqs(arguments, bc_fq_fpath, paired_fq_fpath, sans_bc_
     log.info(f'Score threshold: {thresh:.2f}')
 
     total_out = 0
-    with open(sans_bc_fq_fpath, 'w') as bc_fq_fh, \
-            open(sans_bc_paired_fq_fpath, 'w') as paired_fq_fh, \
-            open(tags_fpath, 'w') as tag_fh:
+    out_fpaths = [sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath]
+    with open(manifest.partial_fpath(sans_bc_fq_fpath), 'w') as bc_fq_fh, \
+            open(manifest.partial_fpath(sans_bc_paired_fq_fpath), 'w') as paired_fq_fh, \
+            open(manifest.partial_fpath(tags_fpath), 'w') as tag_fh:
         log.info('Continuing...')
         for i, (bc_rec, paired_rec) in enumerate(zip(
             SeqIO.parse(misc.gzip_friendly_open(bc_fq_fpath), 'fastq'),
             SeqIO.parse(misc.gzip_friendly_open(paired_fq_fpath), 'fastq'))):
             if i % 100000 == 0 and i > 0:
                 log.info(f'  {i:,d}')
-            score, sans_bc_rec, tags = process_bc_rec(arguments.config, bc_rec, aligners, decoders)
+            score, sans_bc_rec, tags = process_bc_rec(arguments.config, bc_rec, aligners, decoders, cb_encoder)
             if score >= thresh and sans_bc_rec:
                 total_out += 1
                 SeqIO.write(sans_bc_rec, bc_fq_fh, 'fastq')
                 SeqIO.write(paired_rec, paired_fq_fh, 'fastq')
                 output_rec_name_and_tags(sans_bc_rec, tags, tag_fh)
+    for fpath in out_fpaths:
+        os.replace(manifest.partial_fpath(fpath), fpath)
     log.info(f'{i+1:,d} barcode records processed')
     log.info(f'{total_out:,d} pairs of records output')
 
@@ -351,28 +521,31 @@ def write_chunk(arguments, tmpdirname, template_bam_fpath, i, bc_chunk, p_chunk)
             template_bam_fpath)
 
 
-def chunked_gDNA_paired_recs_tmp_files_iterator(arguments, thresh, bc_fq_fpath, paired_fq_fpath, tmpdirname, chunksize):
+def chunked_gDNA_paired_recs_tmp_files_iterator(arguments, thresh, cb_encoder, bc_fq_fpath, paired_fq_fpath, tmpdirname, chunksize, skip=0):
     """
-    Breaks pairs into chunks and writes to files.
+    Breaks pairs into chunks and writes to files. The first skip chunks are not written.
     """
     bc_chunk, p_chunk = [], []
+    nchunks = 0
     for i, (bc_rec, paired_rec) in enumerate(zip(
         SeqIO.parse(misc.gzip_friendly_open(bc_fq_fpath), 'fastq'),
         SeqIO.parse(misc.gzip_friendly_open(paired_fq_fpath), 'fastq'))):
         bc_chunk.append(bc_rec)
         p_chunk.append(paired_rec)
         if i % chunksize == 0 and i > 0:
-            yield arguments, thresh, write_chunk(arguments, tmpdirname, paired_fq_fpath, i, bc_chunk, p_chunk)
+            if nchunks >= skip:
+                yield arguments, thresh, cb_encoder, write_chunk(arguments, tmpdirname, paired_fq_fpath, i, bc_chunk, p_chunk)
+            nchunks += 1
             bc_chunk, p_chunk = [], []
-    if i % chunksize:
-        yield arguments, thresh, write_chunk(arguments, tmpdirname, paired_fq_fpath, i, bc_chunk, p_chunk)
+    if i % chunksize and nchunks >= skip:
+        yield arguments, thresh, cb_encoder, write_chunk(arguments, tmpdirname, paired_fq_fpath, i, bc_chunk, p_chunk)
 
 
 def process_chunk_of_reads(args_and_fpaths):
     """
     Processing chunks of reads. Required to build aligners in each parallel process.
     """
-    config, thresh, (tmp_bc_fq_fpath,
+    config, thresh, cb_encoder, (tmp_bc_fq_fpath,
             tmp_paired_fq_fpath,
             tmp_out_bc_fq_fpath,
             tmp_out_paired_fq_fpath,
@@ -386,7 +559,7 @@ def process_chunk_of_reads(args_and_fpaths):
         for i, (bc_rec, paired_rec) in enumerate(zip(
             SeqIO.parse(misc.gzip_friendly_open(tmp_bc_fq_fpath), 'fastq'),
             SeqIO.parse(misc.gzip_friendly_open(tmp_paired_fq_fpath), 'fastq'))):
-            score, sans_bc_rec, tags = process_bc_rec(config, bc_rec, aligners, decoders)
+            score, sans_bc_rec, tags = process_bc_rec(config, bc_rec, aligners, decoders, cb_encoder)
             if score >= thresh and sans_bc_rec:
                 SeqIO.write(sans_bc_rec, bc_fq_fh, 'fastq')
                 SeqIO.write(paired_rec, paired_fq_fh, 'fastq')
@@ -395,19 +568,25 @@ def process_chunk_of_reads(args_and_fpaths):
     os.remove(tmp_paired_fq_fpath)
     return tmp_out_bc_fq_fpath, tmp_out_paired_fq_fpath, tmp_out_tags_fpath
 
-def parallel_process_gDNA_fastqs(arguments, bc_fq_fpath, paired_fq_fpath, sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath):
+def parallel_process_gDNA_fastqs(arguments, bc_fq_fpath, paired_fq_fpath, sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath, run_manifest=None, stage=None, threads=None):
     """
-    Parallel version of serial process.
+    Parallel version of serial process. Each processed chunk is recorded in the run manifest, so
+    a rerun resumes after the last completed chunk.
     """
     chunksize=100000
+    threads = threads or arguments.threads
+    out_fpaths = [sans_bc_fq_fpath, sans_bc_paired_fq_fpath, tags_fpath]
+    tmp_out_fpaths = [manifest.partial_fpath(fpath) for fpath in out_fpaths]
+    nskip = manifest.resume_chunks(run_manifest, stage, tmp_out_fpaths)
     aligners = misc.build_bc_aligners(arguments.config)
     decoders = misc.build_bc_decoders(arguments.config)
-    with Pool(arguments.threads) as pool, \
+    cb_encoder = encoding.get_cb_id_encoder(arguments.config, include_random=False) if arguments.cb_id_tag else None
+    with misc.worker_pool(threads) as pool, \
             tempfile.TemporaryDirectory(prefix='/dev/shm/') as tmpdirname:
         log.info(f'Processing first {n_first_seqs:,d} for score threshold...')
         first_scores_recs_tags = []
         for i, bc_rec in enumerate(SeqIO.parse(misc.gzip_friendly_open(bc_fq_fpath), 'fastq')):
-            first_scores_recs_tags.append(process_bc_rec(arguments.config, bc_rec, aligners, decoders))
+            first_scores_recs_tags.append(process_bc_rec(arguments.config, bc_rec, aligners, decoders, cb_encoder))
             if i >= n_first_seqs:
                 break
 
@@ -424,23 +603,26 @@ def parallel_process_gDNA_fastqs(arguments, bc_fq_fpath, paired_fq_fpath, sans_b
         chunk_iter = chunked_gDNA_paired_recs_tmp_files_iterator(
                 arguments.config,
                 thresh,
+                cb_encoder,
                 bc_fq_fpath,
                 paired_fq_fpath,
                 tmpdirname,
-                chunksize=chunksize)
+                chunksize=chunksize,
+                skip=nskip)
 
-        with open(sans_bc_fq_fpath, 'w') as sans_bc_fh, \
-                open(sans_bc_paired_fq_fpath, 'w') as sans_bc_paired_fh, \
-                open(tags_fpath, 'w') as tags_fh:
+        tmp_out_bc_fq_fpath = None
+        with open(tmp_out_fpaths[0], 'a') as sans_bc_fh, \
+                open(tmp_out_fpaths[1], 'a') as sans_bc_paired_fh, \
+                open(tmp_out_fpaths[2], 'a') as tags_fh:
             i = 0
             while True:
-                chunk_of_args_and_fpaths = list(itertools.islice(chunk_iter, arguments.threads))
+                chunk_of_args_and_fpaths = list(itertools.islice(chunk_iter, threads))
                 if not chunk_of_args_and_fpaths:
                     break
                 for j, (tmp_out_bc_fq_fpath, tmp_out_paired_fq_fpath, tmp_out_tags_fpath) in enumerate(pool.imap(
                     process_chunk_of_reads,
                     chunk_of_args_and_fpaths)):
-                    it_idx = i*arguments.threads+j
+                    it_idx = nskip+i*threads+j
                     log.info(f'  {it_idx*chunksize:,d}-{(it_idx+1)*chunksize:,d}')
                     SeqIO.write(SeqIO.parse(tmp_out_bc_fq_fpath, 'fastq'), sans_bc_fh, 'fastq')
                     SeqIO.write(SeqIO.parse(tmp_out_paired_fq_fpath, 'fastq'), sans_bc_paired_fh, 'fastq')
@@ -449,27 +631,121 @@ def parallel_process_gDNA_fastqs(arguments, bc_fq_fpath, paired_fq_fpath, sans_b
                         total_out += 1
                     for fpath in (tmp_out_bc_fq_fpath, tmp_out_paired_fq_fpath, tmp_out_tags_fpath):
                         os.remove(fpath)
+                    if run_manifest:
+                        sizes = []
+                        for fh in (sans_bc_fh, sans_bc_paired_fh, tags_fh):
+                            fh.flush()
+                            os.fsync(fh.fileno())
+                            sizes.append(fh.tell())
+                        run_manifest.mark_chunk(stage, sizes)
                 i += 1
+    for tmp_out_fpath, out_fpath in zip(tmp_out_fpaths, out_fpaths):
+        os.replace(tmp_out_fpath, out_fpath)
     
-    nrecs = int(misc.file_prefix_from_fpath(tmp_out_bc_fq_fpath).split('_')[0]) 
-    log.info(f'{nrecs:,d} barcode records processed')
+    if tmp_out_bc_fq_fpath:
+        nrecs = int(misc.file_prefix_from_fpath(tmp_out_bc_fq_fpath).split('_')[0]) 
+        log.info(f'{nrecs:,d} barcode records processed')
     log.info(f'{total_out:,d} pairs of records output')
 
 
-def count_parallel_wrapper(ref_and_input_bam_fpath):
-    ref, input_bam_fpath = ref_and_input_bam_fpath
-    read_count_given_bc_then_feature = defaultdict(Counter)
-    for read in pysam.AlignmentFile(input_bam_fpath).fetch(ref):
-        if read.is_read1 or (read.is_read2 and read.mate_is_unmapped):
-            for gx_gn_tup in misc.gx_gn_tups_from_read(read): # count read toward all compatible genes
-                read_count_given_bc_then_feature[read.get_tag('CB')][gx_gn_tup] += 1
-    read_count_given_bc_then_feature = dict(read_count_given_bc_then_feature)
-    return ref, read_count_given_bc_then_feature
-
-def gDNA_count_matrix(arguments, input_bam_fpath):
+def count_parallel_wrapper(args):
+    shard, input_bam_fpath, shard_table_dir, shard_index_fpath = args
+    t0 = time.time()
+    encoder = encoding.ReadEncoder()
+    table_builder = read_table.ReadTableBuilder(encoder, with_umis=False) if shard_table_dir else None
+    index_builder = cell_index.CellIndexBuilder(encoder.cb) if shard_index_fpath else None
+    read_count_given_bc_and_feature = Counter()
+    with pysam.AlignmentFile(input_bam_fpath) as bam:
+        if index_builder:
+            reads = misc.fetch_shard_with_offsets(bam, shard, misc.read_bai_linear_index(input_bam_fpath + '.bai'))
+        else:
+            reads = ((read, None, None) for read in misc.fetch_shard(bam, shard))
+        for read, start, end in reads:
+            bc_id = encoder.cb_id(read) # barcodes of reads without counts are still listed
+            feature_ids = encoder.feature_ids(read)
+            if table_builder:
+                table_builder.add(read, bc_id, feature_ids)
+            if index_builder:
+                index_builder.add(bc_id, start, end)
+            if is_counted(read):
+                for feature_id in feature_ids: # count read toward all compatible genes
+                    read_count_given_bc_and_feature[bc_id, feature_id] += 1
+    if table_builder:
+        table_builder.save(shard_table_dir)
+    if index_builder:
+        index_builder.save(shard_index_fpath)
+    bc_ids, feature_ids = encoding.id_pair_arrays(read_count_given_bc_and_feature.keys())
+    read_counts = np.fromiter(read_count_given_bc_and_feature.values(), dtype=np.int64)
+    return shard, (encoder.cb.values, encoder.feature.values, bc_ids, feature_ids, read_counts), time.time() - t0
+
+def amplicon_count_parallel_wrapper(args):
+    regions, input_bam_fpath, interval_index = args
+    t0 = time.time()
+    cb_interner = encoding.Interner()
+    read_count_given_bc_and_amplicon = Counter()
+    with pysam.AlignmentFile(input_bam_fpath) as bam:
+        for ref, start, end, first, last in regions:
+            for read in bam.fetch(ref, start, end):
+                if read.is_unmapped or not is_counted(read):
+                    continue
+                # reads overlapping several regions are counted by the region of their amplicon
+                amplicon_idx = interval_index.best_overlap(ref, read.reference_start, read.reference_end)
+                if first <= amplicon_idx < last:
+                    read_count_given_bc_and_amplicon[cb_interner.encode(read.get_tag('CB')), amplicon_idx] += 1
+    bc_ids, amplicon_idxs = encoding.id_pair_arrays(read_count_given_bc_and_amplicon.keys())
+    read_counts = np.fromiter(read_count_given_bc_and_amplicon.values(), dtype=np.int64)
+    return regions, (cb_interner.values, bc_ids, amplicon_idxs, read_counts), time.time() - t0
+
+def amplicon_count_matrix(arguments, input_bam_fpath, out_dir):
+    """
+    Counts the reads of each cell in the amplicons of arguments.amplicons and writes an amplicon
+    by barcode matrix. Each read is assigned to the amplicon it overlaps most, independent of
+    GX/GN tags, and only the amplicon regions of the bam file are read.
+    """
+    with pysam.AlignmentFile(input_bam_fpath) as bam:
+        references = bam.references
+    amplicons = amplicon.load_amplicons(arguments.amplicons, references)
+    interval_index = amplicon.IntervalIndex(amplicons)
+    tasks = amplicon.amplicon_tasks(input_bam_fpath, amplicons, arguments.threads * misc.shards_per_thread)
+    log.info(f'Counting reads in {len(amplicons):,d} amplicons in {len(tasks):,d} tasks...')
+    shard_counts = []
+    with misc.worker_pool(arguments.threads) as pool:
+        for regions, counts, elapsed in pool.imap(
+                amplicon_count_parallel_wrapper,
+                zip(tasks, itertools.repeat(input_bam_fpath), itertools.repeat(interval_index))):
+            log.info(f'  {misc.shard_str(regions[0][:3])} and {len(regions) - 1:,d} more amplicon regions ({elapsed:.1f}s)')
+            shard_counts.append(counts)
+
+    sorted_complete_bcs = sorted(set(bc for bcs, *_ in shard_counts for bc in bcs))
+    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
+    M_reads = misc.sparse_count_matrix(
+            [amplicon_idxs for bcs, bc_ids, amplicon_idxs, read_counts in shard_counts],
+            [misc.remap_ids(bc_ids, bcs, j_given_complete_bc) for bcs, bc_ids, amplicon_idxs, read_counts in shard_counts],
+            [read_counts for bcs, bc_ids, amplicon_idxs, read_counts in shard_counts],
+            (len(amplicons), len(sorted_complete_bcs)))
+    log.info('Writing amplicon read count matrix...')
+    misc.write_matrix(M_reads, sorted_complete_bcs, amplicon.amplicon_features(amplicons), out_dir, arguments.matrix_formats, arguments.threads, feature_type='Amplicon')
+
+def is_counted(read):
+    """Pairs are counted once, by read 1 or by read 2 if read 1 is unmapped."""
+    return read.is_read1 or (read.is_read2 and read.mate_is_unmapped)
+
+def is_counted_given_flag(flags):
+    """Vectorized is_counted for the flag column of a read table."""
+    return ((flags & 0x40) != 0) | (((flags & 0x80) != 0) & ((flags & 0x8) != 0))
+
+def gDNA_count_matrix(arguments, input_bam_fpath, with_read_table=False, with_cell_index=False, region_shard=None):
     """
     Counts the reads from the input bam file and outputs a sparse matrix of read counts.
+
+    With arguments.amplicons, reads are counted per amplicon instead of per feature, see
+    amplicon_count_matrix. Otherwise, if the bam file has a current read table, counts are computed
+    from the table, or else the bam file is counted, writing its read table and its cell index on
+    the way if with_read_table and with_cell_index. With region_shard, a (shard, nshards) tuple as
+    in scatter_count, only the slice of the genomic shards of that region shard is counted.
     """
+    if arguments.umi_max_dist is not None:
+        raise ValueError('--umi-max-dist requires a bam file with UMIs')
     raw_reads_output_dir = os.path.join(arguments.output_dir, 'raw_reads_bc_matrix')
     if os.path.exists(raw_reads_output_dir):
         log.info('Matrix output folder exists. Skipping count matrix build')
@@ -477,30 +753,39 @@ def gDNA_count_matrix(arguments, input_bam_fpath):
     else:
         os.makedirs(raw_reads_output_dir)
 
-    log.info('Finding all barcodes present...')
-    sorted_complete_bcs, sorted_features = misc.get_bcs_and_features_from_bam(
-            input_bam_fpath,
-            arguments.threads-1
-            )
-    i_given_feature = {feat: i for i, feat in enumerate(sorted_features)}
-    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
+    if arguments.amplicons:
+        amplicon_count_matrix(arguments, input_bam_fpath, raw_reads_output_dir)
+        return
 
-
-    with pysam.AlignmentFile(input_bam_fpath) as bamfile:
-        reference_names = bamfile.references
-    reference_names_with_input_bam = [(ref, input_bam_fpath) for ref in reference_names]
-
-    log.info('Counting reads...')
-    M_reads = lil_matrix((len(sorted_features), len(sorted_complete_bcs)), dtype=int)
-    with Pool(arguments.threads) as pool:
-        for ref, read_count_given_bc_then_feature in pool.imap_unordered(
-                count_parallel_wrapper,
-                reference_names_with_input_bam):
-            for comp_bc, read_count_given_feature in read_count_given_bc_then_feature.items():
-                j = j_given_complete_bc[comp_bc]
-                for gx_gn_tup, read_count in read_count_given_feature.items():
-                    i = i_given_feature[gx_gn_tup]
-                    M_reads[i, j] += read_count
+    table = read_table.ReadTable(input_bam_fpath)
+    if table.is_current() and region_shard is None:
+        log.info('Counting reads from read table...')
+        sorted_complete_bcs, sorted_features, (M_reads,), _ = read_table.count_matrices(
+                table,
+                read_mask=is_counted_given_flag(np.asarray(table['flag'])))
+    else:
+        log.info('Counting reads...')
+        shard_counts = []
+        if region_shard is None:
+            shards = misc.get_genomic_shards(input_bam_fpath, arguments.threads * misc.shards_per_thread)
+        else:
+            shards = misc.region_shard_slice(misc.get_genomic_shards(input_bam_fpath, region_shard[1] * misc.shards_per_region), *region_shard)
+        with misc.worker_pool(arguments.threads) as pool, \
+                tempfile.TemporaryDirectory(dir=arguments.output_dir) as tmpdirname:
+            shard_table_dirs = [os.path.join(tmpdirname, f'{i}.reads') if with_read_table else None for i in range(len(shards))]
+            shard_index_fpaths = [os.path.join(tmpdirname, f'{i}.cbi.npz') if with_cell_index else None for i in range(len(shards))]
+            for shard, counts, elapsed in pool.imap(
+                    count_parallel_wrapper,
+                    zip(shards, itertools.repeat(input_bam_fpath), shard_table_dirs, shard_index_fpaths)):
+                log.info(f'  {misc.shard_str(shard)} ({elapsed:.1f}s)')
+                shard_counts.append(counts)
+            if with_read_table:
+                log.info('Writing read table...')
+                read_table.merge_read_tables(shard_table_dirs, input_bam_fpath)
+            if with_cell_index:
+                log.info('Writing cell index...')
+                cell_index.merge_cell_indexes(shard_index_fpaths, input_bam_fpath)
+        sorted_complete_bcs, sorted_features, (M_reads,) = misc.build_count_matrices(shard_counts, 1)
 
     log.info('Writing raw read count matrix...')
-    misc.write_matrix(M_reads, sorted_complete_bcs, sorted_features, raw_reads_output_dir)
+    misc.write_matrix(M_reads, sorted_complete_bcs, sorted_features, raw_reads_output_dir, arguments.matrix_formats, arguments.threads)
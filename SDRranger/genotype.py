@@ -0,0 +1,200 @@
+import os
+import time
+import logging
+import pysam
+import scipy
+import numpy as np
+from bisect import bisect_left
+from heapq import heappush, heappop
+from collections import Counter
+from . import misc
+from .encoding import Interner
+
+log = logging.getLogger(__name__)
+
+
+bases = 'ACGT'
+_base_idx = {base: i for i, base in enumerate(bases)}
+skip_flags = 0x4 | 0x100 | 0x200 | 0x400 | 0x800  # unmapped, secondary, qc fail, duplicate, supplementary
+genotype_dirnames = ('ref_allele_bc_matrix', 'alt_allele_bc_matrix')
+
+
+def load_sites(fpath):
+    """
+    Reads SNV target sites from a VCF file, or every position of the intervals of a BED file.
+    Multiallelic VCF records give one site per alternative allele, other variants are skipped.
+    BED sites have no alleles.
+
+    returns
+        :list: (chrom, 0-based pos, ref, alt, name) tuples, ref and alt are None for BED sites
+    """
+    sites = []
+    nskipped = 0
+    is_vcf = '.vcf' in os.path.basename(fpath)
+    with misc.gzip_friendly_open(fpath) as f:
+        for line in f:
+            if line.startswith('#') or line.startswith('track') or line.startswith('browser') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if is_vcf:
+                chrom, pos, site_id, ref, alts = fields[:5]
+                for alt in alts.split(','):
+                    if ref.upper() not in _base_idx or alt.upper() not in _base_idx:
+                        nskipped += 1
+                        continue
+                    name = site_id if site_id != '.' else f'{chrom}:{pos}:{ref}>{alt}'
+                    sites.append((chrom, int(pos) - 1, ref.upper(), alt.upper(), name))
+            else:
+                chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+                for pos in range(start, end):
+                    name = fields[3] if len(fields) > 3 and end - start == 1 else f'{chrom}:{pos+1}'
+                    sites.append((chrom, pos, None, None, name))
+    if nskipped:
+        log.info(f'Skipped {nskipped:,d} variants that are not SNVs')
+    return sites
+
+
+def pileup_parallel_wrapper(args):
+    (ref, start, end), input_bam_fpath, positions, first_locus, min_mapq, min_base_quality = args
+    t0 = time.time()
+    cb_interner = Interner()
+    count_given_locus_bc_and_base = Counter()
+    fragments_given_locus = {}  # names of read pairs counted at a locus, so overlapping mates count once
+    fragment_loci = []  # heap of the loci in fragments_given_locus, dropped once no read can reach them
+    with pysam.AlignmentFile(input_bam_fpath) as bam:
+        for read in bam.fetch(ref, start, end):
+            while fragment_loci and positions[fragment_loci[0]] < read.reference_start:
+                del fragments_given_locus[heappop(fragment_loci)]
+            if read.flag & skip_flags or read.mapping_quality < min_mapq:
+                continue
+            lo, hi = bisect_left(positions, read.reference_start), bisect_left(positions, read.reference_end)
+            if lo == hi:
+                continue
+            qpos_given_rpos = {rpos: qpos for qpos, rpos in read.get_aligned_pairs(matches_only=True)}
+            seq, quals = read.query_sequence, read.query_qualities
+            bc_id = cb_interner.encode(read.get_tag('CB'))
+            for i in range(lo, hi):
+                qpos = qpos_given_rpos.get(positions[i])
+                if qpos is None or (quals is not None and quals[qpos] < min_base_quality) or seq[qpos] not in _base_idx:
+                    continue
+                if read.is_paired:
+                    fragments = fragments_given_locus.get(i)
+                    if fragments is None:
+                        fragments = fragments_given_locus[i] = set()
+                        heappush(fragment_loci, i)
+                    elif read.query_name in fragments:
+                        fragments.remove(read.query_name)  # the mate was counted, no other read of the pair follows
+                        continue
+                    fragments.add(read.query_name)
+                count_given_locus_bc_and_base[first_locus + i, bc_id, _base_idx[seq[qpos]]] += 1
+
+    keys = np.array(list(count_given_locus_bc_and_base.keys()), dtype=np.int64).reshape(-1, 3)
+    counts = np.fromiter(count_given_locus_bc_and_base.values(), dtype=np.int64)
+    return (ref, start, end), (cb_interner.values, keys[:, 0], keys[:, 1], keys[:, 2], counts), time.time() - t0
+
+
+def count_bases(input_bam_fpath, loci, threads=1, min_mapq=0, min_base_quality=13):
+    """
+    Counts the bases of the reads of each cell barcode at the (ref, pos) loci, which are grouped by
+    reference and sorted by position, with a pileup over genomic shards of the coordinate sorted
+    bam file. Each locus is counted by the shard it lies in, from all reads overlapping the shard.
+
+    returns
+        :tuple: (sorted_complete_bcs, list of locus by barcode matrices for each of ACGT)
+    """
+    shards = misc.get_genomic_shards(input_bam_fpath, threads * misc.shards_per_thread)
+    locus_positions = [pos for ref, pos in loci]
+    bounds_given_ref = {}
+    for i, (ref, pos) in enumerate(loci):
+        bounds_given_ref[ref] = (bounds_given_ref.get(ref, (i, i))[0], i + 1)
+    shard_args = []
+    for ref, start, end in shards:
+        ref_lo, ref_hi = bounds_given_ref.get(ref, (0, 0))
+        lo = bisect_left(locus_positions, start, ref_lo, ref_hi)
+        hi = bisect_left(locus_positions, end, lo, ref_hi)
+        if lo < hi:
+            shard_args.append(((ref, start, end), input_bam_fpath, locus_positions[lo:hi], lo, min_mapq, min_base_quality))
+
+    log.info(f'Piling up {len(loci):,d} loci in {len(shard_args):,d} shards')
+    shard_counts = []
+    with misc.worker_pool(threads) as pool:
+        for shard, counts, elapsed in pool.imap(pileup_parallel_wrapper, shard_args):
+            log.info(f'  {misc.shard_str(shard)} ({elapsed:.1f}s)')
+            shard_counts.append(counts)
+
+    sorted_complete_bcs = sorted(set(bc for bcs, *_ in shard_counts for bc in bcs))
+    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
+    Ms = []
+    for b in range(len(bases)):
+        rows, cols, vals = [], [], []
+        for bcs, locus_idxs, bc_ids, base_idxs, counts in shard_counts:
+            is_base = base_idxs == b
+            rows.append(locus_idxs[is_base])
+            cols.append(misc.remap_ids(bc_ids[is_base], bcs, j_given_complete_bc))
+            vals.append(counts[is_base])
+        Ms.append(misc.sparse_count_matrix(rows, cols, vals, (len(loci), len(sorted_complete_bcs))))
+    return sorted_complete_bcs, Ms
+
+
+def allele_matrices(sites, locus_idxs, base_Ms):
+    """
+    Selects the ref and alt base counts of each site from the base count matrices of its locus.
+    Sites without alleles take the most and second most frequent base over all cells.
+
+    returns
+        :tuple: (M_ref, M_alt, list of (ref, alt) of each site)
+    """
+    totals = np.stack([np.asarray(M.sum(axis=1)).ravel() for M in base_Ms], axis=1)[locus_idxs]
+    alleles = []
+    for (chrom, pos, ref, alt, name), total in zip(sites, totals):
+        if ref is None:
+            major, minor = np.argsort(-total, kind='stable')[:2]
+            ref, alt = bases[major], bases[minor]
+        alleles.append((ref, alt))
+    Ms = []
+    for which in range(2):
+        allele_idxs = np.array([_base_idx[site_alleles[which]] for site_alleles in alleles], dtype=np.int64)
+        M = sum(scipy.sparse.diags((allele_idxs == b).astype(np.int64)) @ M[locus_idxs] for b, M in enumerate(base_Ms))
+        Ms.append(scipy.sparse.csr_matrix(M, dtype=np.int64))
+    return Ms[0], Ms[1], alleles
+
+
+def genotype_gDNA(arguments, input_bam_fpath):
+    """
+    Counts the ref and alt alleles of each cell at the target sites and writes site by barcode
+    matrices.
+    """
+    out_dirs = [os.path.join(arguments.output_dir, dirname) for dirname in genotype_dirnames]
+    if any(os.path.exists(out_dir) for out_dir in out_dirs):
+        log.info('Genotype output folder exists. Skipping genotyping')
+        return
+
+    with pysam.AlignmentFile(input_bam_fpath) as bam:
+        tid_given_ref = {ref: tid for tid, ref in enumerate(bam.references)}
+    sites = load_sites(arguments.sites)
+    missing = set(chrom for chrom, *_ in sites if chrom not in tid_given_ref)
+    if missing:
+        log.warning(f'Skipping sites on references missing from the bam file: {", ".join(sorted(missing))}')
+        sites = [site for site in sites if site[0] not in missing]
+    sites.sort(key=lambda site: (tid_given_ref[site[0]], site[1]))
+    loci = sorted(set((chrom, pos) for chrom, pos, *_ in sites), key=lambda locus: (tid_given_ref[locus[0]], locus[1]))
+    locus_idx_given_locus = {locus: i for i, locus in enumerate(loci)}
+    locus_idxs = np.array([locus_idx_given_locus[chrom, pos] for chrom, pos, *_ in sites], dtype=np.int64)
+
+    sorted_complete_bcs, base_Ms = count_bases(
+            input_bam_fpath,
+            loci,
+            arguments.threads,
+            arguments.min_mapq,
+            arguments.min_base_quality)
+    M_ref, M_alt, alleles = allele_matrices(sites, locus_idxs, base_Ms)
+    site_features = [(f'{chrom}:{pos+1}:{ref}>{alt}', name) for (chrom, pos, _, _, name), (ref, alt) in zip(sites, alleles)]
+
+    log.info(f'Writing allele count matrices of {len(sites):,d} sites and {len(sorted_complete_bcs):,d} barcodes...')
+    for out_dir, M in zip(out_dirs, (M_ref, M_alt)):
+        os.makedirs(out_dir)
+        misc.write_matrix(M, sorted_complete_bcs, site_features, out_dir, arguments.matrix_formats, arguments.threads, feature_type='Variant Site')
+
+
+def genotype_gDNA_bam(arguments):
+    genotype_gDNA(arguments, arguments.SDR_bam_file)
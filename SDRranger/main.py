@@ -2,10 +2,19 @@
 SDRranger: Process SDR-seq data 
 
 Usage:
-  SDRranger count_RNA        <fastq_dir> (--STAR-ref-dir=<> | --STAR-output=<>...) --config=<> [--output-dir=<>] [--threads=<>] [-v | -vv | -vvv]
-  SDRranger count_gDNA       <fastq_dir> (--STAR-ref-dir=<> | --STAR-output=<>...) --config=<> [--output-dir=<>] [--threads=<>] [-v | -vv | -vvv]
-  SDRranger preprocess_gDNA  <fastq_dir> --config=<> [--output-dir=<>] [--threads=<>] [-v | -vv | -vvv]
-  SDRranger count_matrix       <SDR_bam_file> --output-dir=<> [--threads=<>] [-v | -vv | -vvv]
+  SDRranger count_RNA        <fastq_dir> (--STAR-ref-dir=<> [--stream-STAR] | --STAR-output=<>...) --config=<> [--output-dir=<>] [--threads=<>] [--cb-id-tag] [--cell-index] [--dedup-bam] [--format=<>] [-v | -vv | -vvv]
+  SDRranger count_gDNA       <fastq_dir> (--STAR-ref-dir=<> [--stream-STAR] | --STAR-output=<>...) --config=<> [--output-dir=<>] [--threads=<>] [--cb-id-tag] [--cell-index] [--format=<>] [--amplicons=<>] [--sites=<>] [-v | -vv | -vvv]
+  SDRranger count_all        <RNA_fastq_dir> <gDNA_fastq_dir> --STAR-ref-dir=<> [--stream-STAR] --RNA-config=<> --gDNA-config=<> [--output-dir=<>] [--threads=<>] [--cb-id-tag] [--cell-index] [--dedup-bam] [--format=<>] [--amplicons=<>] [--sites=<>] [-v | -vv | -vvv]
+  SDRranger preprocess_gDNA  <fastq_dir> --config=<> [--output-dir=<>] [--threads=<>] [--cb-id-tag] [-v | -vv | -vvv]
+  SDRranger scatter_RNA      <fastq_dir> --STAR-ref-dir=<> [--stream-STAR] --config=<> --shard=<> --nshards=<> [--output-dir=<>] [--threads=<>] [--cb-id-tag] [-v | -vv | -vvv]
+  SDRranger scatter_gDNA     <fastq_dir> --STAR-ref-dir=<> [--stream-STAR] --config=<> --shard=<> --nshards=<> [--output-dir=<>] [--threads=<>] [--cb-id-tag] [-v | -vv | -vvv]
+  SDRranger scatter_count    <SDR_bam_file> --shard=<> --nshards=<> --output-dir=<> [--threads=<>] [--format=<>] [-v | -vv | -vvv]
+  SDRranger gather           <partial_dir>... --output-dir=<> [--threads=<>] [--format=<>] [-v | -vv | -vvv]
+  SDRranger count_matrix       <SDR_bam_file> --output-dir=<> [--threads=<>] [--format=<>] [--umi-max-dist=<>] [--amplicons=<>] [-v | -vv | -vvv]
+  SDRranger genotype_gDNA    <SDR_bam_file> --sites=<> --output-dir=<> [--threads=<>] [--format=<>] [--min-mapq=<>] [--min-base-quality=<>] [-v | -vv | -vvv]
+  SDRranger aggregate        <count_dir>... --output-dir=<> [--threads=<>] [--format=<>] [-v | -vv | -vvv]
+  SDRranger extract_cells    <SDR_bam_file> <cell_barcode>... --output-bam=<> [--threads=<>] [-v | -vv | -vvv]
+  SDRranger serve            --socket=<> [--threads=<>] [-v | -vv | -vvv]
   SDRranger simulate_reads   --config=<> --fastq-prefix=<> --nreads=<> [--unique-umis=<>] [--seed=<>] [--error-probability=<>] [--substitution-probability=<>] [--insertion-probability=<>] [-v | -vv | -vvv]
 
 Options:
@@ -13,10 +22,36 @@ Options:
   --STAR-output=<>:               Path to STAR output file (BAM/SAM). Can be repeated multiple times,
                                     in which case the order must correspond to the lexicographic ordering
                                     of paired FASTQ files in <fastq_dir>.
+  --stream-STAR:                  Read the STAR output while STAR runs instead of from its BAM file, and sort
+                                    the tagged reads as they are written.
   --config=<>:                    Path to JSON configuration.
+  --RNA-config=<>:                Path to JSON configuration of the RNA reads.
+  --gDNA-config=<>:               Path to JSON configuration of the gDNA reads.
   --output-dir=<>:                Path to output directory [default: .].
   --threads=<>:                   Number of threads [default: 1].
+  --cb-id-tag:                    Also tag reads with the integer id of their cell barcode (XI). Requires
+                                    cell barcodes made only of barcode list blocks.
+  --cell-index:                   Also write an index of the reads of each cell barcode next to the final bam
+                                    file, for fast extract_cells.
+  --dedup-bam:                    Also write a bam file with one read per (cell, feature, UMI) molecule, the one with
+                                    the highest mapping quality and then mean base quality, tagged with the number of
+                                    reads of the molecule (XD).
+  --shard=<>:                     Index of the shard to process, from 0.
+  --nshards=<>:                   Number of shards the fastq files or the bam file are split into.
+  --output-bam=<>:                Path to output BAM file, - for standard output.
+  --format=<>:                    Comma-separated count matrix formats: mtx (Matrix Market), h5 (10x Genomics
+                                    HDF5, requires h5py), npz (scipy.sparse) [default: mtx].
+  --umi-max-dist=<>:              Correct the raw UMIs again with this maximum distance before counting.
+                                    Requires the read table written next to the bam file. RNA bam files only.
+  --amplicons=<>:                 BED file of amplicons. gDNA reads are counted per amplicon they overlap most
+                                    instead of per GX/GN feature. gDNA bam files only.
+  --sites=<>:                     VCF file of target SNVs, or BED file of target positions, at which the ref and alt
+                                    alleles of each cell are counted. BED positions take the most and second most
+                                    frequent base as ref and alt.
+  --min-mapq=<>:                  Minimum mapping quality of reads counted at target sites [default: 0].
+  --min-base-quality=<>:          Minimum base quality of bases counted at target sites [default: 13].
   -v:                             Verbose output.
+  --socket=<>:                    Path of the Unix socket the service listens on.
   --fastq-prefix=<>:              Prefix for output FASTQ files.
   --nreads=<>:                    Number of reads to simulate.
   --unique-umis=<>:               Fraction of all reads that have unique UMIs [default: 0.5].
@@ -32,7 +67,17 @@ Commands:
   preprocess_gDNA  Preprocess Genomic gDNA files such that STAR can be run on the output
   count_gDNA       Process and count Genomic gDNA files
   count_RNA        Process and count Transcriptomic RNA files
+  count_all        Process and count the RNA and gDNA files of one experiment together
+  scatter_RNA      Process a shard of the reads of Transcriptomic RNA files into a sorted bam file
+  scatter_gDNA     Process a shard of the reads of Genomic gDNA files into a sorted bam file
+  scatter_count    Count a shard of the genomic regions of a bam file gathered from scatter_RNA or scatter_gDNA
+  gather           Merge the outputs of all shards of a scatter command
   count_matrix     Build a count matrix (or matrices) from an existing bam file
+  genotype_gDNA    Count the alleles of each cell at target sites in a gDNA bam file
+  aggregate        Merge the count matrices in the output directories of several runs
+  extract_cells    Extract the reads of cell barcodes from a bam file, using or building its cell index
+  serve            Run commands sent by SDRranger-client, keeping worker processes, barcode decoders and STAR genomes loaded.
+                   Jobs share the --threads worker processes of the service, whatever their own --threads
   simulate_reads   Generate synthetic sequencing reads given a barcode configuration
 """
 import logging
@@ -42,11 +87,37 @@ from .__init__ import __version__
 from .config import CommandLineArguments
 from .RNAcount import process_RNA_fastqs
 from .gDNAcount import process_gDNA_fastqs, preprocess_gDNA_fastqs
+from .combined import count_all
+from .scatter import scatter_reads, scatter_count, gather
 from .count_matrix import build_count_matrices_from_bam
+from .genotype import genotype_gDNA_bam
+from .aggregate import aggregate_count_matrices
+from .cell_index import extract_cells
 from .simulate import simulate_reads
+from .service import serve
+
+commands = {
+    'count_RNA': process_RNA_fastqs,
+    'count_gDNA': process_gDNA_fastqs,
+    'count_all': count_all,
+    'scatter_RNA': scatter_reads,
+    'scatter_gDNA': scatter_reads,
+    'scatter_count': scatter_count,
+    'gather': gather,
+    'preprocess_gDNA': preprocess_gDNA_fastqs,
+    'count_matrix': build_count_matrices_from_bam,
+    'genotype_gDNA': genotype_gDNA_bam,
+    'aggregate': aggregate_count_matrices,
+    'extract_cells': extract_cells,
+    'simulate_reads': simulate_reads,
+    'serve': serve
+}
+
+def parse_docopt_args(argv=None):
+    return docopt(__doc__, argv=argv, version=__version__)
 
 def main(**kwargs):
-    docopt_args = docopt(__doc__, version=__version__)
+    docopt_args = parse_docopt_args()
     arguments = CommandLineArguments(docopt_args)
 
     log = logging.getLogger()
@@ -57,16 +128,7 @@ def main(**kwargs):
     log.setLevel(arguments.log_level)
     log.debug(docopt_args)
 
-    commands = {
-        'count_RNA': process_RNA_fastqs,
-        'count_gDNA': process_gDNA_fastqs,
-        'preprocess_gDNA': preprocess_gDNA_fastqs,
-        'count_matrix': build_count_matrices_from_bam,
-        'simulate_reads': simulate_reads
-    }
-
     commands[arguments.command](arguments)
 
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import threading
+import logging
+import pysam
+from contextlib import contextmanager
+from . import misc
+
+log = logging.getLogger(__name__)
+
+
+manifest_fname = 'run_manifest.json'
+hash_bytes = 1 << 20  # bytes hashed at each end of an input file
+
+
+def partial_fpath(fpath):
+    """Name an output is written under until it is complete, keeping its extension."""
+    root, ext = os.path.splitext(fpath)
+    return f'{root}.partial{ext}'
+
+
+@contextmanager
+def atomic_output(fpath):
+    """
+    Yields the partial path to write fpath to, which is renamed to fpath only if the block
+    completes. An interrupted write never leaves a file under the final name.
+    """
+    tmp_fpath = partial_fpath(fpath)
+    yield tmp_fpath
+    os.replace(tmp_fpath, fpath)
+
+
+def write_json_atomic(obj, fpath):
+    with atomic_output(fpath) as tmp_fpath:
+        with open(tmp_fpath, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+
+def index_bam(bam_fpath):
+    """Indexes a bam file, writing the index atomically."""
+    with atomic_output(bam_fpath + '.bai') as tmp_fpath:
+        pysam.index(bam_fpath, tmp_fpath)
+
+
+def input_hash(fpath):
+    """
+    SHA-256 of the size and the first and last MB of a file. Inputs are large fastq files, so
+    together with size and mtime this stands in for a hash of the whole file.
+    """
+    size = os.path.getsize(fpath)
+    h = hashlib.sha256(str(size).encode())
+    with open(fpath, 'rb') as f:
+        h.update(f.read(hash_bytes))
+        if size > hash_bytes:
+            f.seek(max(hash_bytes, size - hash_bytes))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def config_hash(arguments, keys):
+    """SHA-256 of the barcode configuration and the given arguments."""
+    settings = {'config': arguments.config, **{key: getattr(arguments, key) for key in keys}}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RunManifest:
+    """
+    JSON record of a pipeline run in its output directory: the inputs and configuration it was
+    started with, the completed stages with the stats of their outputs and the completed chunks
+    of stages in progress. Every update is written atomically.
+
+    A rerun with changed inputs or configuration is refused rather than mixing stale outputs
+    with new ones. A stage counts as done only if its outputs are unchanged since it completed.
+    Outputs of an output directory without a manifest, from earlier versions, are adopted if
+    they exist. Updates may come from several threads.
+    """
+    def __init__(self, output_dir, pipeline, input_fpaths, config_hash):
+        self.fpath = os.path.join(output_dir, manifest_fname)
+        self._lock = threading.RLock()
+        inputs = {os.path.abspath(fpath): {**misc.file_stat(fpath), 'hash': input_hash(fpath)} for fpath in input_fpaths}
+        self.adopt = not os.path.exists(self.fpath)
+        if self.adopt:
+            self.manifest = {
+                    'pipeline': pipeline,
+                    'config_hash': config_hash,
+                    'inputs': inputs,
+                    'stage': None,
+                    'stages': {},
+                    'chunks': {}}
+            os.makedirs(output_dir, exist_ok=True)
+            self.save()
+            return
+
+        with open(self.fpath) as f:
+            self.manifest = json.load(f)
+        if self.manifest['pipeline'] != pipeline:
+            raise ValueError(f'{output_dir} holds a {self.manifest["pipeline"]} run, not {pipeline}')
+        if self.manifest['config_hash'] != config_hash:
+            raise ValueError(f'Configuration differs from the run in {output_dir}. Use a new output directory')
+        changed = sorted(set(inputs) ^ set(self.manifest['inputs'])
+                         | set(fpath for fpath in inputs if inputs[fpath]['hash'] != self.manifest['inputs'].get(fpath, {}).get('hash')))
+        if changed:
+            raise ValueError(f'Outputs in {output_dir} are stale, inputs changed since the run started:\n' + '\n'.join(changed))
+        self.manifest['inputs'] = inputs  # same content, possibly touched
+        self.save()
+
+    def save(self):
+        with self._lock:
+            write_json_atomic(self.manifest, self.fpath)
+
+    def is_done(self, stage, fpaths, params=None):
+        """
+        Whether the stage completed with the given params and its outputs are unchanged since.
+        """
+        record = self.manifest['stages'].get(stage)
+        if record is None:
+            if self.adopt and all(os.path.exists(fpath) for fpath in fpaths):
+                log.info(f'Adopting outputs of stage {stage} found without a run manifest')
+                self.mark_done(stage, fpaths, params)
+                return True
+            return False
+        if record['params'] != params:
+            log.info(f'Stage {stage} ran with other parameters. Redoing')
+            return False
+        for fpath, stat in record['outputs'].items():
+            if not os.path.exists(fpath) or misc.file_stat(fpath) != stat:
+                log.info(f'Output {fpath} of stage {stage} is missing or changed. Redoing')
+                return False
+        return True
+
+    def mark_done(self, stage, fpaths, params=None):
+        with self._lock:
+            self.manifest['stage'] = stage
+            self.manifest['stages'][stage] = {
+                    'params': params,
+                    'outputs': {fpath: misc.file_stat(fpath) for fpath in fpaths}}
+            self.manifest['chunks'].pop(stage, None)
+            self.save()
+
+    def done_chunks(self, stage):
+        """Output file sizes after each completed chunk of the stage, in order."""
+        return self.manifest['chunks'].get(stage, [])
+
+    def mark_chunk(self, stage, sizes):
+        with self._lock:
+            self.manifest['chunks'].setdefault(stage, []).append(sizes)
+            self.save()
+
+    def reset_chunks(self, stage):
+        with self._lock:
+            self.manifest['chunks'].pop(stage, None)
+            self.save()
+
+
+def resume_chunks(manifest, stage, fpaths):
+    """
+    Truncates the partial outputs of a chunked stage to their sizes after its last completed
+    chunk. Outputs are reset if they are shorter than recorded.
+
+    returns
+        :int: number of completed chunks to skip
+    """
+    chunks = manifest.done_chunks(stage) if manifest else []
+    if chunks and all(os.path.exists(fpath) and os.path.getsize(fpath) >= size for fpath, size in zip(fpaths, chunks[-1])):
+        for fpath, size in zip(fpaths, chunks[-1]):
+            with open(fpath, 'r+b') as f:
+                f.truncate(size)
+        log.info(f'Resuming {stage} after {len(chunks):,d} completed chunks')
+        return len(chunks)
+    if chunks:
+        manifest.reset_chunks(stage)
+    for fpath in fpaths:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+    return 0
@@ -1,11 +1,21 @@
 import os
 import gzip
+import errno
 import glob
 import logging
 import pysam
 import json
-from itertools import product
-from bisect import bisect
+import struct
+import tempfile
+import threading
+import multiprocessing
+from itertools import product, islice
+from contextlib import contextmanager
+from bisect import bisect_right
+from functools import partial
+from collections import Counter, defaultdict
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
 
 import scipy
 import numpy as np
@@ -106,6 +116,95 @@ def get_namepair_index(R1_fpath, R2_fpath):
     return namepair_differences(r1.id, r2.id)
 
 
+def lane_threads(threads, nlanes, streamed=False):
+    """
+    Threads for STAR and for barcode parsing. With several lanes, STAR aligns one lane while the
+    barcodes of another are parsed, so the threads are split between the two. Streamed STAR
+    output is parsed while STAR runs, so the threads are split even with one lane.
+
+    returns
+        :tuple: (star_threads, parse_threads, overlap)
+    """
+    if (nlanes < 2 and not streamed) or threads < 2:
+        return threads, threads, False
+    star_threads = threads // 2
+    return star_threads, threads - star_threads, True
+
+
+def background_imap(func, iterable, background=True):
+    """
+    Like Pool.imap with a single worker thread: func runs on the items one after another, in
+    order, while the caller handles earlier results. The iterable is consumed by the caller, so
+    work it does, like parsing the lane a worker item comes from, also overlaps with func. Items
+    not yet started are cancelled if the caller stops early or fails.
+    """
+    if not background:
+        yield from map(func, iterable)
+        return
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=threading.current_thread().name)
+    try:
+        futures = []
+        for item in iterable:
+            for future in futures:
+                if future.done() and future.exception():
+                    future.result()  # fail fast
+            futures.append(executor.submit(func, item))
+        for future in futures:
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+_shared_pool = None
+
+@contextmanager
+def shared_worker_pool(threads):
+    """
+    Makes worker_pool hand out one pool of threads worker processes while active, so that the
+    pipelines of a combined run share their workers instead of each starting its own pools.
+    Within an active shared pool, like that of the service, that pool is kept.
+    """
+    global _shared_pool
+    if _shared_pool is not None:
+        yield _shared_pool
+        return
+    with multiprocessing.Pool(threads) as pool:
+        _shared_pool = pool
+        try:
+            yield pool
+        finally:
+            _shared_pool = None
+
+
+@contextmanager
+def lane_worker_pool(threads, config, background):
+    """
+    With STAR running in a background thread, the lanes are parsed by a shared_worker_pool
+    started before the thread, since a process forked while other threads run can deadlock on a
+    lock one of them held, like that of a log handler. The barcode decoders are built first, so
+    that the workers inherit them.
+    """
+    if not background:
+        yield
+        return
+    build_bc_decoders(config)
+    with shared_worker_pool(threads):
+        yield
+
+
+@contextmanager
+def worker_pool(threads):
+    """
+    A pool of threads worker processes, or the pool of an active shared_worker_pool, which is left
+    running on exit.
+    """
+    if _shared_pool is not None:
+        yield _shared_pool
+        return
+    with multiprocessing.Pool(threads) as pool:
+        yield pool
+
+
 def file_prefix_from_fpath(fpath):
     """Strip away directories and extentions from file path"""
     bname = os.path.splitext(fpath[:-3] if fpath.endswith('.gz') else fpath)[0]
@@ -146,6 +245,21 @@ def build_bc_aligners(config):
         aligners.append(CustomBCAligner(*prefixes, unknown_read_orientation=config["unknown_read_orientation"]))
     return aligners
 
+_decoders = {}
+_decoders_lock = threading.Lock()
+
+def cached_decoder(decoder_class, whitelist, *params):
+    """
+    Returns the decoder of decoder_class for the whitelist and params, building it only on first
+    use in this process. Worker processes forked afterwards inherit it, and configs with the same
+    barcode list, like the RNA and gDNA configs of one experiment, share it.
+    """
+    key = (decoder_class.__name__, tuple(whitelist), *params)
+    with _decoders_lock:
+        if key not in _decoders:
+            _decoders[key] = decoder_class(whitelist, *params)
+        return _decoders[key]
+
 def build_bc_decoders(config):
     from .bc_decoders import BCDecoder, SBCDecoder
 
@@ -156,14 +270,14 @@ def build_bc_decoders(config):
     for i, block in enumerate(blocks):
         if block["blocktype"] == "barcodeList":
             if lastblock is not None:
-                decoders.append(BCDecoder(lastblock["sequence"], lastblock["maxerrors"]))
+                decoders.append(cached_decoder(BCDecoder, lastblock["sequence"], lastblock["maxerrors"]))
             lastblock = block
             lastblockidx = i
     if lastblock is not None:
         if lastblockidx == len(blocks) - 1 or blocks[lastblockidx + 1]["blocktype"] == "randomBarcode":
-            decoders.append(SBCDecoder(lastblock["sequence"], lastblock["maxerrors"], 0)) # TODO: expose max_reject_delta?
+            decoders.append(cached_decoder(SBCDecoder, lastblock["sequence"], lastblock["maxerrors"], 0)) # TODO: expose max_reject_delta?
         else:
-            decoders.append(BCDecoder(lastblock["sequence"], lastblock["maxerrors"]))
+            decoders.append(cached_decoder(BCDecoder, lastblock["sequence"], lastblock["maxerrors"]))
     return decoders
 
 def average_align_score_of_first_recs(fastq_fpath, config, n_seqs=500):
@@ -188,68 +302,733 @@ def gx_gn_tups_from_read(read):
         return []
 
 
-def get_bcs_and_features_from_bam(input_bam_fpath, threads=1):
-    complete_bcs, features = set(), set()
-    for read in pysam.AlignmentFile(input_bam_fpath, threads=threads).fetch():
-        complete_bcs.add(read.get_tag('CB'))
-        features.update(gx_gn_tups_from_read(read))
-    sorted_complete_bcs = sorted(complete_bcs)
-    sorted_features = sorted(features)
-    return sorted_complete_bcs, sorted_features
+shards_per_thread = 4  # more shards than workers, such that a single slow shard does not idle the pool
+shards_per_region = 32  # genomic shards per region shard of scatter_count, independent of the threads of its node
+bai_window_size = 1 << 14  # width of the linear index windows of a .bai file
 
 
-def write_matrix(M, bcs, features, out_dir):
-    matrix_fpath = os.path.join(out_dir, 'matrix.mtx.gz')
-    with gzip.open(matrix_fpath, 'wb') as out:
-        scipy.io.mmwrite(out, M)
+def read_bai_linear_index(bai_fpath):
+    """
+    Parses the linear index of a .bai file.
 
-    rows_fpath = os.path.join(out_dir, 'barcodes.tsv.gz')
-    with gzip.open(rows_fpath, 'wt') as out:
-        out.write('\n'.join(bcs))
+    returns
+        :list: (ioffsets, ref_end) for each reference, where ioffsets are the virtual offsets of the
+               16kb windows and ref_end is the virtual offset past the last read of the reference
+               (None if the reference has no reads).
+    """
+    with open(bai_fpath, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'BAI\1':
+        raise ValueError(f'{bai_fpath} is not a BAI index')
+    n_ref, = struct.unpack_from('<i', data, 4)
+    pos = 8
+    linear_index = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        ref_end = None
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+            if bin_id == 37450:  # pseudo-bin holding the offsets spanned by the reference
+                ref_end = struct.unpack_from('<QQ', data, pos)[1]
+            pos += 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        ioffsets = np.frombuffer(data, dtype='<u8', count=n_intv, offset=pos)
+        pos += 8 * n_intv
+        linear_index.append((ioffsets, ref_end))
+    return linear_index
 
-    cols_fpath = os.path.join(out_dir, 'features.tsv.gz')
-    with gzip.open(cols_fpath, 'wt') as out:
-        out.write('\n'.join([f'{gx}\t{gn}\tGene Expression' for gx, gn in features]))
 
-def sort_and_index_readname_bam(input_bam_fpath, output_bam_fpath, namepairidx, threads=1):
-    pysam.sort("-N", "-@", str(threads), "-o", output_bam_fpath, input_bam_fpath)
-    with pysam.AlignmentFile(output_bam_fpath, "r", threads=threads) as bam:
-        i_readnames = []
-        i_offsets = []
-        lastblock = -1
-        offset = bam.tell()
-        lastreadname = ""
-        lastreadoffset = offset
-        for read in bam.fetch(until_eof=True):
-            block = offset >> 16
-            readname = make_paired_name(read.query_name, namepairidx)
-            if block > lastblock:
-                i_readnames.append(readname)
-                i_offsets.append(offset if readname != lastreadname else lastreadoffset)
-                lastblock = block
-            if readname != lastreadname:
-                lastreadname = readname
-                lastreadoffset = offset
+def get_window_read_estimates(bam_fpath):
+    """
+    Estimates the number of mapped reads in each linear index window of each reference.
+
+    The mapped read counts from the index statistics are distributed over the windows of a
+    reference proportionally to the compressed bytes between consecutive window offsets. Without a
+    .bai index, every reference is a single window.
+    """
+    with pysam.AlignmentFile(bam_fpath) as bam:
+        mapped = {stat.contig: stat.mapped for stat in bam.get_index_statistics()}
+        references = list(zip(bam.references, bam.lengths))
+    bai_fpath = bam_fpath + '.bai'
+    linear_index = read_bai_linear_index(bai_fpath) if os.path.exists(bai_fpath) else None
+
+    estimates = {}
+    for tid, (ref, length) in enumerate(references):
+        nreads = mapped.get(ref, 0)
+        if linear_index is None or linear_index[tid][1] is None or not len(linear_index[tid][0]):
+            estimates[ref] = np.array([nreads], dtype=float)
+            continue
+        ioffsets, ref_end = linear_index[tid]
+        boundaries = np.append(ioffsets >> 16, ref_end >> 16).astype(np.int64)
+        nbytes = np.maximum(np.diff(boundaries), 0).astype(float)
+        if nbytes.sum() > 0:
+            estimates[ref] = nreads * nbytes / nbytes.sum()
+        else:
+            estimates[ref] = np.full(len(nbytes), nreads / len(nbytes))
+    return estimates, dict(references)
+
+
+def get_genomic_shards(bam_fpath, nshards):
+    """
+    Splits the mapped reads of an indexed, coordinate sorted bam file into about nshards regions
+    with similar numbers of reads, using only the bam index.
+
+    returns
+        :list: (ref, start, end) tuples in header order. References without mapped reads are skipped.
+    """
+    estimates, lengths = get_window_read_estimates(bam_fpath)
+    target = max(sum(est.sum() for est in estimates.values()) / max(nshards, 1), 1)
+    shards = []
+    for ref, est in estimates.items():
+        if est.sum() == 0:
+            continue
+        nsplits = int(round(est.sum() / target))
+        cuts = []
+        if nsplits > 1 and len(est) > 1:
+            cumulative = np.cumsum(est)
+            windows = np.searchsorted(cumulative, est.sum() * np.arange(1, nsplits) / nsplits) + 1
+            cuts = sorted(set(int(w) * bai_window_size for w in windows if 0 < w < len(est)))
+        bounds = [0] + cuts + [lengths[ref]]
+        shards.extend((ref, start, end) for start, end in zip(bounds[:-1], bounds[1:]))
+    return shards
+
+
+def region_shard_slice(shards, shard, nshards):
+    """
+    The contiguous slice of shards, in order, of region shard `shard` of nshards. The shards must
+    be computed the same way by every region shard, so that the slices partition them. With more
+    region shards than shards, some slices are empty.
+    """
+    return shards[shard * len(shards) // nshards:(shard + 1) * len(shards) // nshards]
+
+
+def fetch_shard(bam, shard):
+    """
+    Iterates the reads starting in the shard.
+
+    Reads overlapping the start of the shard belong to the previous shard, so that every read is
+    returned by exactly one shard and concatenating the shards preserves the coordinate order.
+    """
+    ref, start, end = shard
+    for read in bam.fetch(ref, start, end):
+        if read.reference_start >= start:
+            yield read
+
+
+def fetch_shard_with_offsets(bam, shard, linear_index):
+    """
+    Iterates the reads starting in the shard like fetch_shard, together with the virtual offsets
+    of the start and the end of each read.
+
+    Offsets are only known between consecutive reads, so the bam is read sequentially from the
+    linear index offset of the window of the shard start instead of through an index query.
+    """
+    ref, start, end = shard
+    tid = bam.get_tid(ref)
+    ioffsets, ref_end = linear_index[tid]
+    if not len(ioffsets):
+        raise ValueError(f'No linear index for {ref}')
+    window = min(start // bai_window_size, len(ioffsets) - 1)
+    bam.seek(int(ioffsets[:window + 1].max()))
+    offset = bam.tell()
+    for read in bam.fetch(until_eof=True):
+        next_offset = bam.tell()
+        if read.reference_id != tid:
+            if read.reference_id > tid or read.reference_id < 0:
+                break
+        elif read.reference_start >= end:
+            break
+        elif read.reference_start >= start:
+            yield read, offset, next_offset
+        offset = next_offset
+
+
+bgzf_eof = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+sorter_poll_interval = 0.1  # seconds between checks that a bam_sorter process is still starting
+
+
+def bam_data_range(fpath):
+    """
+    Compressed offsets of the first and end BGZF blocks of the reads of a bam file, between the
+    header and the end of file marker.
+    """
+    with pysam.AlignmentFile(fpath) as bam:
+        data_start = bam.tell()
+    if data_start & 0xffff:
+        raise ValueError(f'{fpath}: header does not end at a BGZF block boundary')
+    data_end = os.path.getsize(fpath) - len(bgzf_eof)
+    with open(fpath, 'rb') as f:
+        f.seek(data_end)
+        if f.read() != bgzf_eof:
+            raise ValueError(f'{fpath}: missing BGZF end of file marker')
+    return data_start >> 16, data_end
+
+
+def copy_bam_blocks(in_fpath, out, with_header=False, bufsize=1 << 20):
+    """
+    Appends the compressed BGZF blocks of the reads of a bam file, and optionally its header, to
+    the binary file object out, without the end of file marker.
+
+    returns
+        :int: shift of the compressed offsets of the copied blocks, None if out is a pipe
+    """
+    data_start, data_end = bam_data_range(in_fpath)
+    if with_header:
+        data_start = 0
+    shift = out.tell() - data_start if out.seekable() else None
+    with open(in_fpath, 'rb') as f:
+        f.seek(data_start)
+        remaining = data_end - data_start
+        while remaining:
+            buf = f.read(min(bufsize, remaining))
+            out.write(buf)
+            remaining -= len(buf)
+    return shift
+
+
+def concatenate_bams(in_fpaths, out_fpath, template_fpath=None, bufsize=1 << 20):
+    """
+    Concatenates bam files with the same header by copying their compressed BGZF blocks, keeping
+    the header of the first file. Unlike samtools cat, no block is recompressed, so the virtual
+    offset of a read in an input file maps into the output by shifting its compressed offset.
+    Without input files, a bam file with only the header of template_fpath is written.
+
+    returns
+        :list: shift of the compressed offsets of each input file
+    """
+    if not in_fpaths:
+        if template_fpath is None:
+            raise ValueError(f'No bam files to concatenate into {out_fpath}')
+        with pysam.AlignmentFile(template_fpath) as template:
+            pysam.AlignmentFile(out_fpath, 'wb', template=template).close()
+        return []
+    with open(out_fpath, 'wb') as out:
+        shifts = [copy_bam_blocks(in_fpath, out, i == 0, bufsize) for i, in_fpath in enumerate(in_fpaths)]
+        out.write(bgzf_eof)
+    return shifts
+
+
+@contextmanager
+def bam_sorter(out_fpath, threads=1):
+    """
+    Yields the path of a named pipe to write an unsorted bam file to, which a separate process
+    sorts into out_fpath as it is written. The unsorted bam file is never stored. The sorter is
+    started by a fork server rather than forked, as other threads may be running.
+
+    The pipe is only yielded once the sorter has opened it, holding a write end until the
+    caller is done, so that opening it cannot block forever on a sorter that failed to start.
+    """
+    with tempfile.TemporaryDirectory(prefix='sort_', dir=os.path.dirname(os.path.abspath(out_fpath))) as tmpdirname:
+        fifo_fpath = os.path.join(tmpdirname, 'unsorted.bam')
+        os.mkfifo(fifo_fpath)
+        sorter = multiprocessing.get_context('forkserver').Process(
+                target=pysam.sort,
+                args=('-@', str(threads), '-T', os.path.join(tmpdirname, 'sort'), '-o', out_fpath, fifo_fpath))
+        sorter.start()
+        fifo_fd = None
+        try:
+            while fifo_fd is None:
+                try:
+                    fifo_fd = os.open(fifo_fpath, os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    if not sorter.is_alive():
+                        raise RuntimeError(f'Sorting into {out_fpath} failed to start')
+                    sorter.join(sorter_poll_interval)
+            yield fifo_fpath
+        except BaseException:
+            sorter.terminate()
+            raise
+        finally:
+            if fifo_fd is not None:
+                os.close(fifo_fd)
+            sorter.join()
+        if sorter.exitcode:
+            raise RuntimeError(f'Sorting into {out_fpath} failed')
+
+
+def file_stat(fpath):
+    """Size and modification time of a file, for checking that sidecar files are current."""
+    stat = os.stat(fpath)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def shard_str(shard):
+    ref, start, end = shard
+    return f'{ref}:{start+1:,d}-{end:,d}'
+
+
+def feature_extents_parallel_wrapper(shard_and_input_bam_fpath):
+    shard, input_bam_fpath = shard_and_input_bam_fpath
+    extents = {}
+    with pysam.AlignmentFile(input_bam_fpath) as bam:
+        for read in fetch_shard(bam, shard):
+            for gx_gn_tup in gx_gn_tups_from_read(read):
+                first, last = extents.get(gx_gn_tup, (read.reference_start, None))
+                extents[gx_gn_tup] = (first, read.reference_start)
+    return shard, extents
+
+
+def get_feature_extents(input_bam_fpath, shards, pool):
+    """
+    Scans the shards for the first and last read start of every feature.
+
+    returns
+        :dict: ref -> {(GX, GN): (first_start, last_start)}
+    """
+    extents_given_ref = defaultdict(dict)
+    for (ref, start, end), extents in pool.imap(
+            feature_extents_parallel_wrapper,
+            [(shard, input_bam_fpath) for shard in shards]):
+        ref_extents = extents_given_ref[ref]
+        for feature, (first, last) in extents.items():
+            if feature in ref_extents:
+                first = min(first, ref_extents[feature][0])
+                last = max(last, ref_extents[feature][1])
+            ref_extents[feature] = (first, last)
+    return dict(extents_given_ref)
+
+
+def make_shards_feature_safe(shards, extents_given_ref):
+    """
+    Moves shard boundaries such that the reads of every feature fall into a single shard.
+
+    A boundary is moved to the nearest position outside of any feature's extent, or dropped if the
+    move would collide with a neighboring boundary.
+    """
+    shards_given_ref = defaultdict(list)
+    for shard in shards:
+        shards_given_ref[shard[0]].append(shard)
+
+    safe_shards = []
+    for ref, ref_shards in shards_given_ref.items():
+        if len(ref_shards) == 1:
+            safe_shards.extend(ref_shards)
+            continue
+        # a boundary at pos is unsafe if first < pos <= last for some feature
+        zones = []
+        for first, last in sorted(extents_given_ref.get(ref, {}).values()):
+            if last <= first:
+                continue
+            if zones and first <= zones[-1][1]:
+                zones[-1][1] = max(zones[-1][1], last)
+            else:
+                zones.append([first, last])
+        zone_starts = [zone[0] for zone in zones]
+
+        ref_start, ref_end = ref_shards[0][1], ref_shards[-1][2]
+        cuts = []
+        for _, cut, _ in ref_shards[1:]:
+            zi = bisect_right(zone_starts, cut - 1) - 1
+            if zi >= 0 and zones[zi][0] < cut <= zones[zi][1]:
+                before, after = zones[zi][0], zones[zi][1] + 1
+                cut = before if cut - before <= after - cut else after
+            if ref_start < cut < ref_end and (not cuts or cut > cuts[-1]):
+                cuts.append(cut)
+        bounds = [ref_start] + cuts + [ref_end]
+        safe_shards.extend((ref, start, end) for start, end in zip(bounds[:-1], bounds[1:]))
+    return safe_shards
+
+
+def get_feature_safe_genomic_shards(input_bam_fpath, nshards, pool, with_extents=False, extents_given_ref=None):
+    """
+    Load balanced shards for tasks that need all reads of a (cell, feature) together, such as UMI
+    correction and UMI counting. Feature extents are only scanned on references with more than
+    one shard, unless with_extents is set, in which case all shards are scanned and the extents
+    are returned as well. Known extents, e.g. recorded while writing the bam, skip the scan.
+    """
+    shards = get_genomic_shards(input_bam_fpath, nshards)
+    split_refs = {ref for ref, count in Counter(ref for ref, start, end in shards).items() if count > 1}
+    if extents_given_ref is None:
+        if not split_refs and not with_extents:
+            return shards
+        log.info('Scanning feature extents...')
+        scanned_shards = shards if with_extents else [shard for shard in shards if shard[0] in split_refs]
+        extents_given_ref = get_feature_extents(input_bam_fpath, scanned_shards, pool)
+    shards = make_shards_feature_safe(shards, extents_given_ref)
+    return (shards, extents_given_ref) if with_extents else shards
+
+
+class FeatureExtentRecorder:
+    """
+    Wraps an output bam file and records the first and last read start of every feature written.
+    Reads written elsewhere are added with record.
+
+    Saved next to the coordinate sorted bam, the extents spare the feature extents scan.
+    """
+    def __init__(self, bam_out=None, extents_given_ref=None):
+        self._bam_out = bam_out
+        self.extents_given_ref = defaultdict(dict) if extents_given_ref is None else extents_given_ref
+
+    def write(self, read):
+        self._bam_out.write(read)
+        self.record(read)
+
+    def record(self, read):
+        if read.is_unmapped:
+            return
+        pos = read.reference_start
+        extents = self.extents_given_ref[read.reference_name]
+        for gx_gn_tup in gx_gn_tups_from_read(read):
+            if gx_gn_tup in extents:
+                first, last = extents[gx_gn_tup]
+                extents[gx_gn_tup] = (min(first, pos), max(last, pos))
+            else:
+                extents[gx_gn_tup] = (pos, pos)
+
+    def save(self, fpath):
+        with open(fpath, 'w') as out:
+            json.dump({ref: [[gx, gn, first, last] for (gx, gn), (first, last) in extents.items()]
+                       for ref, extents in self.extents_given_ref.items()}, out)
+
+
+def feature_extents_fpath(bam_fpath):
+    return bam_fpath + '.extents.json'
+
+
+def load_feature_extents(fpath):
+    with open(fpath) as f:
+        return {ref: {(gx, gn): (first, last) for gx, gn, first, last in extents}
+                for ref, extents in json.load(f).items()}
+
+
+def remap_ids(local_ids, local_values, idx_given_value):
+    """
+    Maps ids into local_values to indices of the same values in a global ordering.
+    """
+    idx_given_local_id = np.array([idx_given_value[value] for value in local_values], dtype=np.int64)
+    return idx_given_local_id[local_ids]
+
+
+def sparse_count_matrix(rows, cols, vals, shape):
+    """
+    Builds a CSR matrix from lists of row, column and value arrays, summing duplicate entries.
+    """
+    if not rows:
+        return scipy.sparse.csr_matrix(shape, dtype=np.int64)
+    M = scipy.sparse.coo_matrix(
+            (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+            shape=shape,
+            dtype=np.int64)
+    M.sum_duplicates()
+    return M.tocsr()
+
+
+def build_count_matrices(shard_counts, nmatrices):
+    """
+    Builds nmatrices feature by barcode count matrices from the local results of counting workers.
+
+    Each element of shard_counts holds the barcodes and features seen by one worker, the local
+    ids of its nonzero entries and one array of counts per matrix. Barcodes and features are
+    discovered by the workers, so the global sorted lists are the union of the local ones.
+    Without any shard counts, the matrices are empty.
+
+    returns
+        :tuple: (sorted_complete_bcs, sorted_features, list of matrices)
+    """
+    sorted_complete_bcs = sorted(set(bc for bcs, *_ in shard_counts for bc in bcs))
+    sorted_features = sorted(set(feature for bcs, features, *_ in shard_counts for feature in features))
+    i_given_feature = {feat: i for i, feat in enumerate(sorted_features)}
+    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
+    rows, cols = [], []
+    for bcs, features, bc_ids, feature_ids, *_ in shard_counts:
+        rows.append(remap_ids(feature_ids, features, i_given_feature))
+        cols.append(remap_ids(bc_ids, bcs, j_given_complete_bc))
+    shape = (len(sorted_features), len(sorted_complete_bcs))
+    Ms = [sparse_count_matrix(rows, cols, [counts[4 + k] for counts in shard_counts], shape) for k in range(nmatrices)]
+    return sorted_complete_bcs, sorted_features, Ms
+
+
+def build_umi_matrix(shard_counts, shard_umi_codes, sorted_complete_bcs, sorted_features):
+    """
+    Builds the umi count matrix and its sidecar from the stable umi codes returned by the counting
+    workers. A feature with reads on several references is counted by several workers, so a umi
+    seen by more than one worker for the same barcode and feature is counted once, as in the
+    read table and when merging runs. The sidecar orders the umis like the entries of the CSR
+    matrix, with the umis of each entry sorted. The umis of the nonzero entry k of the matrix are
+    then the next M.data[k] codes.
+
+    returns
+        :tuple: (M, umis sidecar of M)
+    """
+    i_given_feature = {feat: i for i, feat in enumerate(sorted_features)}
+    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
+    shape = (len(sorted_features), len(sorted_complete_bcs))
+    rows, cols = [], []
+    for (bcs, features, bc_ids, feature_ids, nreads, numis), umi_codes in zip(shard_counts, shard_umi_codes):
+        rows.append(np.repeat(remap_ids(feature_ids, features, i_given_feature), numis))
+        cols.append(np.repeat(remap_ids(bc_ids, bcs, j_given_complete_bc), numis))
+    if not rows:
+        return sparse_count_matrix([], [], [], shape), np.zeros(0, dtype=np.uint64)
+    rows, cols, umis = np.concatenate(rows), np.concatenate(cols), np.concatenate(shard_umi_codes)
+    order = np.lexsort((umis, cols, rows))
+    rows, cols, umis = rows[order], cols[order], umis[order]
+    first = np.ones(len(umis), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]) | (umis[1:] != umis[:-1])
+    M = sparse_count_matrix([rows[first]], [cols[first]], [np.ones(int(first.sum()), dtype=np.int64)], shape)
+    return M, umis[first]
+
+
+def umi_sidecar_fpath(out_dir):
+    return os.path.join(out_dir, 'umis.npy')
+
+
+def write_umi_sidecar(umis, out_dir):
+    np.save(umi_sidecar_fpath(out_dir), umis)
+
+
+def load_umi_sidecar(out_dir):
+    return np.load(umi_sidecar_fpath(out_dir))
+
+
+matrix_formats = ('mtx', 'h5', 'npz')
+mtx_chunk_nnz = 1 << 20  # nonzero entries per independently compressed gzip member
+mtx_compresslevel = 6  # within 0.2% of the size of level 9 on count matrices, at a quarter of the time
+
+
+def mtx_gz_chunks(M):
+    """
+    Yields the Matrix Market text of M in chunks of mtx_chunk_nnz entries, header first.
+    """
+    M = M.tocsr().tocoo()
+    yield f'%%MatrixMarket matrix coordinate integer general\n%\n{M.shape[0]} {M.shape[1]} {M.nnz}\n'.encode()
+    for start in range(0, M.nnz, mtx_chunk_nnz):
+        end = start + mtx_chunk_nnz
+        yield ''.join(map('{} {} {}\n'.format,
+                          (M.row[start:end] + 1).tolist(),
+                          (M.col[start:end] + 1).tolist(),
+                          M.data[start:end].tolist())).encode()
+
+
+def write_mtx_gz(M, fpath, threads=1):
+    """
+    Writes M as gzipped Matrix Market file. Chunks are compressed in parallel as separate gzip
+    members, which concatenate to a valid gzip file.
+    """
+    chunk_iter = mtx_gz_chunks(M)
+    with open(fpath, 'wb') as out, ThreadPool(threads) as pool:
+        while True:
+            chunks = list(islice(chunk_iter, threads))
+            if not chunks:
+                break
+            for block in pool.imap(partial(gzip.compress, compresslevel=mtx_compresslevel), chunks):
+                out.write(block)
+
+
+def write_h5(M, bcs, features, fpath, feature_type='Gene Expression'):
+    """
+    Writes M in the HDF5 layout of 10x Genomics feature-barcode matrices. Requires h5py.
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('HDF5 matrix output requires h5py')
+    M = M.tocsc()
+    M.sort_indices()
+    with h5py.File(fpath, 'w') as f:
+        f.attrs['filetype'] = 'matrix'
+        f.attrs['version'] = 2
+        matrix = f.create_group('matrix')
+        matrix.create_dataset('barcodes', data=np.array(bcs, dtype='S'), compression='gzip')
+        matrix.create_dataset('data', data=M.data.astype(np.int32), compression='gzip')
+        matrix.create_dataset('indices', data=M.indices.astype(np.int64), compression='gzip')
+        matrix.create_dataset('indptr', data=M.indptr.astype(np.int64), compression='gzip')
+        matrix.create_dataset('shape', data=np.array(M.shape, dtype=np.int32))
+        feats = matrix.create_group('features')
+        feats.create_dataset('_all_tag_keys', data=np.array(['genome'], dtype='S'))
+        feats.create_dataset('id', data=np.array([gx for gx, gn in features], dtype='S'), compression='gzip')
+        feats.create_dataset('name', data=np.array([gn for gx, gn in features], dtype='S'), compression='gzip')
+        feats.create_dataset('feature_type', data=np.array([feature_type] * len(features), dtype='S'), compression='gzip')
+        feats.create_dataset('genome', data=np.array([''] * len(features), dtype='S'), compression='gzip')
+
+
+def write_matrix(M, bcs, features, out_dir, formats=('mtx',), threads=1, feature_type='Gene Expression'):
+    """
+    Writes the feature by barcode matrix M to out_dir in each of the given formats: matrix.mtx.gz,
+    matrix.h5 (10x Genomics HDF5) or matrix.npz (scipy.sparse.save_npz). The Matrix Market and
+    NumPy formats come with barcodes.tsv.gz and features.tsv.gz.
+    """
+    for fmt in formats:
+        if fmt not in matrix_formats:
+            raise ValueError(f'Unknown matrix format {fmt}, must be one of {", ".join(matrix_formats)}')
+
+    if 'mtx' in formats:
+        write_mtx_gz(M, os.path.join(out_dir, 'matrix.mtx.gz'), threads)
+    if 'npz' in formats:
+        scipy.sparse.save_npz(os.path.join(out_dir, 'matrix.npz'), M.tocsr())
+    if 'h5' in formats:
+        write_h5(M, bcs, features, os.path.join(out_dir, 'matrix.h5'), feature_type)
+
+    if 'mtx' in formats or 'npz' in formats:
+        rows_fpath = os.path.join(out_dir, 'barcodes.tsv.gz')
+        with gzip.open(rows_fpath, 'wt') as out:
+            out.write('\n'.join(bcs))
+
+        cols_fpath = os.path.join(out_dir, 'features.tsv.gz')
+        with gzip.open(cols_fpath, 'wt') as out:
+            out.write('\n'.join([f'{gx}\t{gn}\t{feature_type}' for gx, gn in features]))
+
+def read_matrix(in_dir):
+    """
+    Reads a matrix written by write_matrix from whichever format is present, preferring npz, then
+    mtx, then h5.
+
+    returns
+        :tuple: (M as CSR matrix, bcs, features)
+    """
+    npz_fpath = os.path.join(in_dir, 'matrix.npz')
+    mtx_fpath = os.path.join(in_dir, 'matrix.mtx.gz')
+    if os.path.exists(npz_fpath):
+        M = scipy.sparse.load_npz(npz_fpath).tocsr()
+    elif os.path.exists(mtx_fpath):
+        with gzip.open(mtx_fpath, 'rb') as f:
+            M = scipy.sparse.csr_matrix(scipy.io.mmread(f))
+    else:
+        return read_h5(os.path.join(in_dir, 'matrix.h5'))
+    M.sum_duplicates()
+    with gzip.open(os.path.join(in_dir, 'barcodes.tsv.gz'), 'rt') as f:
+        bcs = f.read().split('\n') if M.shape[1] else []
+    with gzip.open(os.path.join(in_dir, 'features.tsv.gz'), 'rt') as f:
+        features = [tuple(line.split('\t')[:2]) for line in f.read().split('\n')] if M.shape[0] else []
+    return M, bcs, features
+
+
+def read_h5(fpath):
+    """
+    Reads a matrix in the HDF5 layout of 10x Genomics feature-barcode matrices. Requires h5py.
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('HDF5 matrix input requires h5py')
+    with h5py.File(fpath, 'r') as f:
+        matrix = f['matrix']
+        M = scipy.sparse.csc_matrix(
+                (matrix['data'][:], matrix['indices'][:], matrix['indptr'][:]),
+                shape=tuple(matrix['shape'][:])).tocsr()
+        bcs = [bc.decode() for bc in matrix['barcodes'][:]]
+        features = [(gx.decode(), gn.decode()) for gx, gn in zip(matrix['features/id'][:], matrix['features/name'][:])]
+    M.sum_duplicates()
+    return M, bcs, features
+
+
+class ReadNameIndex:
+    """
+    Sparse index of a read name sorted bam file.
+
+    Holds the first (paired) read name of every BGZF block and the virtual offset to start reading
+    from. Both are stored as fixed-width NumPy arrays in sidecar files next to the bam file and are
+    memory-mapped on first use. Pickling the index only transfers file paths, so worker processes
+    share the page cache instead of receiving a copy of the index with every task.
+    """
+    def __init__(self, bam_fpath, namepairidx):
+        self.bam_fpath = bam_fpath
+        self.namepairidx = namepairidx
+        self._names = None
+        self._offsets = None
+
+    @property
+    def names_fpath(self):
+        return f'{self.bam_fpath}.names.npy'
+
+    @property
+    def offsets_fpath(self):
+        return f'{self.bam_fpath}.offsets.npy'
+
+    @property
+    def meta_fpath(self):
+        return f'{self.bam_fpath}.nameidx.json'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_names'] = None
+        state['_offsets'] = None
+        return state
+
+    def _bam_stat(self):
+        stat = os.stat(self.bam_fpath)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'namepairidx': list(self.namepairidx)}
+
+    def is_current(self):
+        """Whether the sidecar files exist and were built from the bam file as it is now."""
+        if not all(os.path.exists(fpath) for fpath in (self.bam_fpath, self.names_fpath, self.offsets_fpath, self.meta_fpath)):
+            return False
+        with open(self.meta_fpath) as f:
+            return json.load(f) == self._bam_stat()
+
+    def build(self, threads=1):
+        with pysam.AlignmentFile(self.bam_fpath, "r", threads=threads) as bam:
+            i_readnames = []
+            i_offsets = []
+            lastblock = -1
             offset = bam.tell()
+            lastreadname = ""
+            lastreadoffset = offset
+            for read in bam.fetch(until_eof=True):
+                block = offset >> 16
+                readname = make_paired_name(read.query_name, self.namepairidx)
+                if block > lastblock:
+                    i_readnames.append(readname.encode())
+                    i_offsets.append(offset if readname != lastreadname else lastreadoffset)
+                    lastblock = block
+                if readname != lastreadname:
+                    lastreadname = readname
+                    lastreadoffset = offset
+                offset = bam.tell()
 
-    return i_readnames, i_offsets, namepairidx
+        np.save(self.names_fpath, np.array(i_readnames, dtype=np.bytes_))
+        np.save(self.offsets_fpath, np.array(i_offsets, dtype=np.int64))
+        # written last, such that an interrupted build is never mistaken for a finished one
+        with open(self.meta_fpath, 'w') as f:
+            json.dump(self._bam_stat(), f)
+        self._names = self._offsets = None
 
-def get_bam_read_by_name(name, bam, index, threads=1):
-    i_readnames, i_offsets, namepairidx = index
-    name = make_paired_name(name, namepairidx)
+    def offset(self, name):
+        """Virtual offset from which to scan for the (already paired) read name."""
+        if self._names is None:
+            self._names = np.load(self.names_fpath, mmap_mode='r')
+            self._offsets = np.load(self.offsets_fpath, mmap_mode='r')
+        idx = np.searchsorted(self._names, name.encode(), side='right') - 1
+        return int(self._offsets[max(idx, 0)])
+
+    def remove(self):
+        for fpath in (self.meta_fpath, self.names_fpath, self.offsets_fpath):
+            if os.path.exists(fpath):
+                os.remove(fpath)
 
-    idx = bisect(i_readnames, make_paired_name(name, namepairidx)) - 1
+
+def sort_and_index_readname_bam(input_bam_fpath, output_bam_fpath, namepairidx, threads=1):
+    index = ReadNameIndex(output_bam_fpath, namepairidx)
+    if index.is_current() and os.path.getmtime(output_bam_fpath) >= os.path.getmtime(input_bam_fpath):
+        log.info('Read name sorted bam and index found. Skipping sort')
+        return index
+    tmp_bam_fpath = output_bam_fpath + '.partial.bam'  # an interrupted sort must not be taken for a finished one
+    pysam.sort("-N", "-@", str(threads), "-o", tmp_bam_fpath, input_bam_fpath)
+    os.replace(tmp_bam_fpath, output_bam_fpath)
+    index.build(threads)
+    return index
+
+def remove_readname_bam(index):
+    index.remove()
+    os.remove(index.bam_fpath)
+
+def get_bam_read_by_name(name, bam, index, threads=1):
+    name = make_paired_name(name, index.namepairidx)
     needclose = False
     if not isinstance(bam, pysam.AlignmentFile):
         bam = pysam.AlignmentFile(bam, "r", threads=threads)
         needclose = True
-    bam.seek(i_offsets[idx])
+    bam.seek(index.offset(name))
     startblock = None
     haveread = False
     for bread in bam.fetch(until_eof=True):
         if startblock is None:
             startblock = bam.tell() >> 16
-        if make_paired_name(bread.query_name, namepairidx) == name:
+        if make_paired_name(bread.query_name, index.namepairidx) == name:
             haveread = True
             yield bread
         elif haveread or bam.tell() >> 16 > startblock:
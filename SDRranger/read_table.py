@@ -0,0 +1,312 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+from array import array
+from collections import Counter
+from . import misc
+from .encoding import UMIEncoder
+from .umi import get_umi_map_from_cntr
+
+log = logging.getLogger(__name__)
+
+
+# column name: dtype. Reads have nfeatures consecutive entries in the features column.
+column_dtypes = {
+    'name': np.bytes_,
+    'ref': np.int32,
+    'pos': np.int64,
+    'flag': np.uint16,
+    'mapq': np.uint8,
+    'fl': np.int32,
+    'cb': np.int32,
+    'nfeatures': np.uint16,
+    'features': np.int32,
+    'ur': np.uint64,
+    'ub': np.uint64,
+}
+umi_columns = ('ur', 'ub')
+# array typecodes of the columns collected by ReadTableBuilder, wide enough for their dtypes
+column_typecodes = {
+    'ref': 'i',
+    'pos': 'q',
+    'flag': 'H',
+    'mapq': 'B',
+    'fl': 'i',
+    'cb': 'i',
+    'nfeatures': 'H',
+    'features': 'i',
+    'ur': 'Q',
+    'ub': 'Q',
+}
+
+
+def read_table_dir(bam_fpath):
+    return bam_fpath + '.reads'
+
+
+class ReadTableBuilder:
+    """
+    Collects the columns of the reads of one shard, with cell barcodes, features and umis as ids
+    of the given ReadEncoder. Saved shards are merged into the table of the whole bam file by
+    merge_read_tables.
+
+    Numeric columns are collected in typed arrays and read names in one byte buffer, so a read
+    takes about as much memory as its row of the table.
+    """
+    def __init__(self, encoder, with_umis=True):
+        self.encoder = encoder
+        self.columns = {column: array(typecode) for column, typecode in column_typecodes.items() if with_umis or column not in umi_columns}
+        self.names = bytearray()
+        self.name_lengths = array('H')
+
+    def add(self, read, bc_id, feature_ids, ub=None):
+        columns = self.columns
+        name = read.query_name.encode()
+        self.names += name
+        self.name_lengths.append(len(name))
+        columns['ref'].append(read.reference_id)
+        columns['pos'].append(read.reference_start)
+        columns['flag'].append(read.flag)
+        columns['mapq'].append(read.mapping_quality)
+        columns['fl'].append(read.get_tag('FL') if read.has_tag('FL') else -1)
+        columns['cb'].append(bc_id)
+        columns['nfeatures'].append(len(feature_ids))
+        columns['features'].extend(feature_ids)
+        if 'ur' in columns:
+            columns['ur'].append(self.encoder.umi_code(read))
+            columns['ub'].append(ub if ub is not None else self.encoder.umi_code(read, 'UB'))
+
+    def save(self, shard_dir):
+        os.makedirs(shard_dir, exist_ok=True)
+        np.save(os.path.join(shard_dir, 'name.npy'), fixed_width_names(self.names, self.name_lengths))
+        for column, values in self.columns.items():
+            np.save(os.path.join(shard_dir, f'{column}.npy'), np.asarray(values).astype(column_dtypes[column], copy=False))
+        with open(os.path.join(shard_dir, 'local.json'), 'w') as f:
+            json.dump({'barcodes': self.encoder.cb.values,
+                       'features': self.encoder.feature.values,
+                       'interned_umis': self.encoder.umi.interned}, f)
+
+
+def fixed_width_names(names, name_lengths):
+    """
+    Converts names concatenated in a byte buffer to a fixed-width bytes array, as np.array of the
+    separate names would.
+    """
+    name_lengths = np.asarray(name_lengths, dtype=np.int64)
+    width = max(int(name_lengths.max()), 1) if len(name_lengths) else 1
+    starts = np.cumsum(name_lengths) - name_lengths
+    chars = np.zeros(len(name_lengths) * width, dtype=np.uint8)
+    chars[np.arange(len(names)) + np.repeat(np.arange(len(name_lengths)) * width - starts, name_lengths)] = np.frombuffer(names, dtype=np.uint8)
+    return chars.view(f'S{width}')
+
+
+def merge_read_tables(shard_dirs, bam_fpath):
+    """
+    Concatenates shard tables, in order, into the read table of bam_fpath, remapping local ids
+    to global ones. Barcodes and features are sorted like the count matrices. The shard
+    directories are removed.
+    """
+    table_dir = read_table_dir(bam_fpath)
+    if os.path.exists(table_dir):
+        shutil.rmtree(table_dir)
+    os.makedirs(table_dir)
+
+    local_given_shard = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, 'local.json')) as f:
+            local = json.load(f)
+        local['features'] = [tuple(feature) for feature in local['features']]
+        local_given_shard.append(local)
+    sorted_complete_bcs = sorted(set(bc for local in local_given_shard for bc in local['barcodes']))
+    sorted_features = sorted(set(feature for local in local_given_shard for feature in local['features']))
+    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
+    i_given_feature = {feat: i for i, feat in enumerate(sorted_features)}
+    interned_umis = [umi for local in local_given_shard for umi in local['interned_umis']]
+    interned_offsets = np.cumsum([0] + [len(local['interned_umis']) for local in local_given_shard])
+
+    columns = sorted(fname[:-4] for fname in os.listdir(shard_dirs[0]) if fname.endswith('.npy')) if shard_dirs else []
+    for column in columns:
+        shard_arrays = [np.load(os.path.join(shard_dir, f'{column}.npy'), mmap_mode='r') for shard_dir in shard_dirs]
+        dtype = max((shard_array.dtype for shard_array in shard_arrays), key=lambda dtype: dtype.itemsize)
+        out = np.lib.format.open_memmap(
+                os.path.join(table_dir, f'{column}.npy'),
+                mode='w+',
+                dtype=dtype,
+                shape=(sum(len(shard_array) for shard_array in shard_arrays),))
+        start = 0
+        for shard_array, local, interned_offset in zip(shard_arrays, local_given_shard, interned_offsets):
+            if column == 'cb':
+                shard_array = misc.remap_ids(shard_array, local['barcodes'], j_given_complete_bc)
+            elif column == 'features':
+                shard_array = misc.remap_ids(shard_array, local['features'], i_given_feature)
+            elif column in umi_columns:
+                shard_array = np.array(shard_array)
+                shard_array[(shard_array & np.uint64(UMIEncoder.interned_bit)) != 0] += np.uint64(interned_offset)
+            out[start:start + len(shard_array)] = shard_array
+            start += len(shard_array)
+        out.flush()
+        del out
+
+    # written last, such that an interrupted merge is never mistaken for a finished one
+    with open(os.path.join(table_dir, 'meta.json'), 'w') as f:
+        json.dump({'bam': misc.file_stat(bam_fpath),
+                   'columns': columns,
+                   'barcodes': sorted_complete_bcs,
+                   'features': sorted_features,
+                   'interned_umis': interned_umis}, f)
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+
+
+class ReadTable:
+    """
+    Columnar per-read table stored next to a bam file as one .npy file per column, which are
+    memory-mapped on access. Cell barcodes and features are indices into the sorted barcodes and
+    features, umis are UMIEncoder codes with interned umis listed in the table.
+    """
+    def __init__(self, bam_fpath):
+        self.bam_fpath = bam_fpath
+        self.table_dir = read_table_dir(bam_fpath)
+        self._meta = None
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            with open(os.path.join(self.table_dir, 'meta.json')) as f:
+                self._meta = json.load(f)
+        return self._meta
+
+    def is_current(self):
+        """Whether the table exists and was built for the bam file as it is now."""
+        if not os.path.exists(os.path.join(self.table_dir, 'meta.json')) or not os.path.exists(self.bam_fpath):
+            return False
+        return self.meta['bam'] == misc.file_stat(self.bam_fpath)
+
+    def __getitem__(self, column):
+        return np.load(os.path.join(self.table_dir, f'{column}.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self['ref'])
+
+    @property
+    def has_umis(self):
+        return 'ur' in self.meta['columns']
+
+    @property
+    def barcodes(self):
+        return self.meta['barcodes']
+
+    @property
+    def features(self):
+        return [tuple(feature) for feature in self.meta['features']]
+
+    def umi_encoder(self):
+        return UMIEncoder(self.meta['interned_umis'])
+
+    def feature_entries(self):
+        """
+        Read index of each entry of the features column, and the entry of the first feature of
+        each read (-1 for reads without features).
+        """
+        nfeatures = np.asarray(self['nfeatures'], dtype=np.int64)
+        read_idxs = np.repeat(np.arange(len(nfeatures)), nfeatures)
+        first_entries = np.where(nfeatures > 0, np.cumsum(nfeatures) - nfeatures, -1)
+        return read_idxs, first_entries
+
+
+def group_umis(rows, cols, umis):
+    """
+    Sorts (feature, barcode, umi) entries and finds the distinct ones.
+
+    returns
+        :tuple: (order of the entries, mask of distinct entries in sorted order)
+    """
+    order = np.lexsort((umis, cols, rows))
+    rows, cols, umis = rows[order], cols[order], umis[order]
+    distinct = np.ones(len(order), dtype=bool)
+    distinct[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]) | (umis[1:] != umis[:-1])
+    return order, distinct
+
+
+def correct_umis(table, max_dist=1, dist_type='freediv', connection_type='directional'):
+    """
+    Corrects the raw umis of the table like umi.get_encoded_umi_corrections: umis are
+    clustered per (barcode, feature) over the reads of the feature on one reference, and each read
+    takes the corrected umi of its first feature. Reads without features keep their raw umi. As
+    shards never span references, these are the umis corrected together when counting the bam.
+
+    returns
+        :array: corrected umi codes for each read
+    """
+    umi_encoder = table.umi_encoder()
+    read_idxs, first_entries = table.feature_entries()
+    rows = np.asarray(table['features'], dtype=np.int64)
+    refs = np.asarray(table['ref'], dtype=np.int64)[read_idxs]
+    nrefs = int(refs.max()) + 1 if len(refs) else 1
+    cols = np.asarray(table['cb'], dtype=np.int64)[read_idxs] * nrefs + refs  # (barcode, reference) groups
+    urs = np.asarray(table['ur'])
+    umis = urs[read_idxs]
+    order, distinct = group_umis(rows, cols, umis)
+    distinct_idx = np.cumsum(distinct) - 1  # index of the distinct entry of each sorted entry
+    distinct_pos = np.flatnonzero(distinct)
+    distinct_umis = umis[order][distinct_pos]
+    distinct_counts = np.diff(np.append(distinct_pos, len(order)))
+    sorted_rows, sorted_cols = rows[order][distinct_pos], cols[order][distinct_pos]
+    group_starts = np.flatnonzero(np.append(True, (sorted_rows[1:] != sorted_rows[:-1]) | (sorted_cols[1:] != sorted_cols[:-1])))
+    group_ends = np.append(group_starts[1:], len(distinct_pos))
+
+    # umis enter each counter in order of first appearance, as in the bam path, where it breaks ties
+    first_seen = order[distinct_pos]
+
+    corrected = distinct_umis.copy()
+    for start, end in zip(group_starts.tolist(), group_ends.tolist()):
+        if end - start < 2:
+            continue
+        seen_order = start + np.argsort(first_seen[start:end])
+        umi_cntr = Counter(dict(zip(distinct_umis[seen_order].tolist(), distinct_counts[seen_order].tolist())))
+        umi_map = get_umi_map_from_cntr(umi_cntr, max_dist=max_dist, dist_type=dist_type, connection_type=connection_type, umi_encoder=umi_encoder)
+        corrected[start:end] = [umi_map[umi] for umi in distinct_umis[start:end].tolist()]
+
+    corrected_given_entry = np.empty(len(order), dtype=np.uint64)
+    corrected_given_entry[order] = corrected[distinct_idx]
+    ubs = urs.copy()
+    has_features = first_entries >= 0
+    ubs[has_features] = corrected_given_entry[first_entries[has_features]]
+    return ubs
+
+
+def count_matrices(table, ubs=None, read_mask=None):
+    """
+    Counts reads, and umis if the table has them, per feature and barcode with vectorized
+    group-bys. ubs replaces the corrected umis of the table, read_mask restricts the counted reads.
+    A umi is counted once per feature and barcode, also if the feature has reads on several
+    references, as when counting the bam.
+
+    returns
+        :tuple: (sorted_complete_bcs, sorted_features, list of matrices, umi sidecar or None)
+    """
+    read_idxs, first_entries = table.feature_entries()
+    rows = np.asarray(table['features'], dtype=np.int64)
+    cols = np.asarray(table['cb'], dtype=np.int64)[read_idxs]
+    if read_mask is not None:
+        entry_mask = read_mask[read_idxs]
+        read_idxs, rows, cols = read_idxs[entry_mask], rows[entry_mask], cols[entry_mask]
+    shape = (len(table.features), len(table.barcodes))
+    Ms = [misc.sparse_count_matrix([rows], [cols], [np.ones(len(rows), dtype=np.int64)], shape)]
+    umis = None
+    if table.has_umis:
+        if ubs is None:
+            ubs = np.asarray(table['ub'])
+        entry_umis = ubs[read_idxs]
+        order, distinct = group_umis(rows, cols, entry_umis)
+        keep = order[distinct]
+        Ms.append(misc.sparse_count_matrix([rows[keep]], [cols[keep]], [np.ones(len(keep), dtype=np.int64)], shape))
+        umis = entry_umis[keep]
+        interned = (umis & np.uint64(UMIEncoder.interned_bit)) != 0
+        if interned.any():
+            umi_encoder = table.umi_encoder()
+            umis[interned] = [umi_encoder.stable_code(umi) for umi in umis[interned].tolist()]
+            umis = umis[np.lexsort((umis, cols[keep], rows[keep]))]
+    return table.barcodes, table.features, Ms, umis
@@ -0,0 +1,201 @@
+import os
+import json
+import zlib
+import logging
+import numpy as np
+from bisect import bisect_right
+from collections import Counter
+from . import misc
+from .read_table import group_umis
+
+log = logging.getLogger(__name__)
+
+
+# Subsampling fractions of the saturation report. A read is kept at fraction f if its hash is
+# below f * 2^32, so the reads kept at a fraction are kept at all larger fractions.
+fractions = tuple(i / 20 for i in range(1, 21))
+_thresholds = (np.array(fractions) * (1 << 32)).astype(np.uint64)
+_threshold_list = _thresholds.tolist()
+tally_names = ('reads', 'umis', 'genes')
+
+
+def read_hash(read):
+    """Deterministic 32 bit hash of the read name, shared by all alignments of a read."""
+    return zlib.crc32(read.query_name.encode())
+
+
+def fraction_idxs(hashes):
+    """Index of the smallest fraction at which each hash is kept."""
+    return np.searchsorted(_thresholds, np.asarray(hashes, dtype=np.uint64), side='right')
+
+
+def cumulative_counts(cols, idxs, ncols, weights=None):
+    """
+    Number of entries, or their summed weights, of each column kept at each fraction, as a
+    (ncols, nfractions) array.
+    """
+    counts = np.bincount(cols * len(fractions) + idxs, weights=weights, minlength=ncols * len(fractions)).astype(np.int64)
+    return np.cumsum(counts.reshape(ncols, len(fractions)), axis=1)
+
+
+def molecule_tally(read_cols, read_idxs, read_counts, rows, cols, idxs, ncols):
+    """
+    Tallies reads, umis and features per barcode at each subsampling fraction from the number of
+    read entries of each barcode at each fraction index, and from the (feature, barcode) and the
+    smallest fraction index of the reads of each umi. A feature is kept at the fractions that keep
+    any of its umis.
+
+    returns
+        :array: (3, ncols, nfractions) array of read, umi and feature counts
+    """
+    reads = cumulative_counts(np.asarray(read_cols, dtype=np.int64), np.asarray(read_idxs, dtype=np.int64), ncols, read_counts)
+    if not len(rows):
+        return np.stack([reads, reads, reads])
+    rows, cols, idxs = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64), np.asarray(idxs, dtype=np.int64)
+    order = np.lexsort((cols, rows))
+    rows, cols, idxs = rows[order], cols[order], idxs[order]
+    feature_starts = np.flatnonzero(np.append(True, (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])))
+    feature_idxs = np.minimum.reduceat(idxs, feature_starts)
+    return np.stack([
+        reads,
+        cumulative_counts(cols, idxs, ncols),
+        cumulative_counts(cols[feature_starts], feature_idxs, ncols)])
+
+
+def tally(rows, cols, umis, hashes, ncols):
+    """
+    Tallies reads, umis and features per barcode at each subsampling fraction from the
+    (feature, barcode, umi) entries of counted reads and the hashes of the reads. A umi is kept
+    at the fractions that keep any of its reads, see molecule_tally. Entries of all reads of a
+    (feature, barcode) must be tallied together.
+
+    returns
+        :array: (3, ncols, nfractions) array of read, umi and feature counts
+    """
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    umis, idxs = np.asarray(umis, dtype=np.uint64), fraction_idxs(hashes)
+    if not len(rows):
+        return molecule_tally(cols, idxs, None, rows, cols, idxs, ncols)
+    order, distinct = group_umis(rows, cols, umis)
+    umi_starts = np.flatnonzero(distinct)
+    umi_idxs = np.minimum.reduceat(idxs[order], umi_starts)
+    return molecule_tally(cols, idxs, None, rows[order][umi_starts], cols[order][umi_starts], umi_idxs, ncols)
+
+
+class SaturationEntries:
+    """
+    Collects what the tallies need of the counted reads of one shard, with ids of the counting
+    worker's encoder: the number of (read, feature) entries of each barcode at each fraction
+    index, and the smallest fraction index of the reads of each (barcode, feature, umi). Memory
+    thus grows with the molecules of the shard, not with its reads.
+    """
+    def __init__(self):
+        self.nentries_given_bc_and_idx = Counter()
+        self.min_idx_given_molecule = {}
+
+    def add(self, read, bc_id, feature_ids, umi):
+        idx = bisect_right(_threshold_list, read_hash(read))
+        self.nentries_given_bc_and_idx[bc_id, idx] += len(feature_ids)
+        min_idx_given_molecule = self.min_idx_given_molecule
+        for feature_id in feature_ids:
+            key = (bc_id, feature_id, umi)
+            if idx < min_idx_given_molecule.get(key, len(fractions)):
+                min_idx_given_molecule[key] = idx
+
+    def tally(self, ncols):
+        read_keys = np.array(list(self.nentries_given_bc_and_idx.keys()), dtype=np.int64).reshape(-1, 2)
+        read_counts = np.fromiter(self.nentries_given_bc_and_idx.values(), dtype=np.int64, count=len(read_keys))
+        molecules = np.array(list(self.min_idx_given_molecule.keys()), dtype=np.uint64).reshape(-1, 3)
+        idxs = np.fromiter(self.min_idx_given_molecule.values(), dtype=np.int64, count=len(molecules))
+        return molecule_tally(
+                read_keys[:, 0],
+                read_keys[:, 1],
+                read_counts,
+                molecules[:, 1].astype(np.int64),
+                molecules[:, 0].astype(np.int64),
+                idxs,
+                ncols)
+
+
+def merge_tallies(shard_tallies, shard_bcs, sorted_complete_bcs):
+    """
+    Sums the tallies of shards over the sorted barcodes. Shards must not split the (feature,
+    barcode) groups of a reference, as for the feature safe shards of umi counting. Features with
+    reads on several references are thus tallied once per reference.
+    """
+    j_given_complete_bc = {comp_bc: j for j, comp_bc in enumerate(sorted_complete_bcs)}
+    tallies = np.zeros((len(tally_names), len(sorted_complete_bcs), len(fractions)), dtype=np.int64)
+    for shard_tally, bcs in zip(shard_tallies, shard_bcs):
+        tallies[:, misc.remap_ids(np.arange(len(bcs)), bcs, j_given_complete_bc)] += shard_tally
+    return tallies
+
+
+def tallies_fpath(out_dir):
+    return os.path.join(out_dir, 'saturation_tallies.npz')
+
+
+def save_tallies(tallies, sorted_complete_bcs, out_dir):
+    """Saves the tallies of a region shard of scatter_count, which gather merges with merge_tallies."""
+    np.savez(tallies_fpath(out_dir), tallies=tallies, barcodes=np.array(sorted_complete_bcs, dtype=str))
+
+
+def load_tallies(out_dir):
+    """
+    returns
+        :tuple: (tallies, sorted barcodes)
+    """
+    with np.load(tallies_fpath(out_dir)) as f:
+        return f['tallies'], f['barcodes'].tolist()
+
+
+def table_tallies(table, ubs=None):
+    """
+    Tallies of the counted reads of a read table, see tally. Features are tallied once per
+    reference, as by the shards of merge_tallies.
+    """
+    read_idxs, _ = table.feature_entries()
+    hashes = np.fromiter((zlib.crc32(name) for name in table['name']), dtype=np.uint32, count=len(table))
+    ubs = np.asarray(table['ub']) if ubs is None else ubs
+    refs = np.asarray(table['ref'], dtype=np.int64)[read_idxs]
+    nrefs = int(refs.max()) + 1 if len(refs) else 1
+    return tally(
+            np.asarray(table['features'], dtype=np.int64) * nrefs + refs,  # (feature, reference) groups
+            np.asarray(table['cb'])[read_idxs],
+            ubs[read_idxs],
+            hashes[read_idxs],
+            len(table.barcodes))
+
+
+def saturation_report(tallies):
+    """
+    Summarizes the tallies per fraction. Per cell statistics are over the barcodes with counted
+    reads without subsampling. Sequencing saturation is the fraction of reads of already
+    observed umis, 1 - umis / reads.
+    """
+    reads, umis, genes = tallies
+    cells = reads[:, -1] > 0
+    rows = []
+    for k, fraction in enumerate(fractions):
+        nreads, numis = int(reads[:, k].sum()), int(umis[:, k].sum())
+        rows.append({
+            'fraction': fraction,
+            'reads': nreads,
+            'umis': numis,
+            'sequencing_saturation': 1 - numis / nreads if nreads else 0.0,
+            'mean_reads_per_cell': float(reads[cells, k].mean()) if cells.any() else 0.0,
+            'median_umis_per_cell': float(np.median(umis[cells, k])) if cells.any() else 0.0,
+            'median_genes_per_cell': float(np.median(genes[cells, k])) if cells.any() else 0.0})
+    return {'cells': int(cells.sum()), 'read_hash': 'crc32 of the read name', 'fractions': rows}
+
+
+def write_saturation_report(tallies, out_dir):
+    report = saturation_report(tallies)
+    with open(os.path.join(out_dir, 'saturation.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    columns = list(report['fractions'][0])
+    with open(os.path.join(out_dir, 'saturation.tsv'), 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for row in report['fractions']:
+            f.write('\t'.join(f'{row[column]:.4g}' if isinstance(row[column], float) else str(row[column]) for column in columns) + '\n')
+    full = report['fractions'][-1]
+    log.info(f'Sequencing saturation {full["sequencing_saturation"]:.1%} over {report["cells"]:,d} barcodes')
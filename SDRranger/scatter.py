@@ -0,0 +1,365 @@
+import os
+import gzip
+import json
+import zlib
+import shutil
+import logging
+import itertools
+import pysam
+from . import misc
+from . import manifest
+from . import saturation
+from .aggregate import sum_matrices, merge_umi_matrices
+from .RNAcount import process_RNA_fastqs, correct_UMIs_and_count
+from .gDNAcount import process_gDNA_fastqs, gDNA_count_matrix
+
+log = logging.getLogger(__name__)
+
+
+scatter_fname = 'scatter.json'
+sorted_bam_fnames = {'RNA': 'RNA_with_bc.sorted.bam', 'gDNA': 'gDNA_with_bc.sorted.bam'}
+umi_bam_fname = 'RNA_with_bc_umi.sorted.bam'
+
+
+class _Inflater:
+    """Decompresses gzip data fed in pieces, including files of several gzip members like bgzip."""
+    def __init__(self):
+        self._d = zlib.decompressobj(wbits=31)
+
+    def inflate(self, data):
+        out = []
+        while data:
+            out.append(self._d.decompress(data))
+            if not self._d.eof:
+                break
+            data = self._d.unused_data
+            self._d = zlib.decompressobj(wbits=31)
+        return b''.join(out)
+
+
+def is_gzipped(fpath):
+    with open(fpath, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def fastq_record_boundary(fpath, offset, bufsize=1 << 20):
+    """
+    Index of the first record of a gzipped fastq file starting at or after byte offset of the
+    compressed file. Records are counted in the data decompressed from the bytes before the
+    offset, so the boundary is resynced by counting the lines before it instead of parsing
+    records.
+    """
+    nlines = 0
+    last = b'\n'
+    inflater = _Inflater()
+    with open(fpath, 'rb') as f:
+        remaining = offset
+        while remaining:
+            buf = f.read(min(bufsize, remaining))
+            if not buf:
+                break
+            remaining -= len(buf)
+            buf = inflater.inflate(buf)
+            if buf:
+                nlines += buf.count(b'\n')
+                last = buf[-1:]
+    first_line = nlines if last == b'\n' else nlines + 1
+    return -(-first_line // 4)
+
+
+def fastq_record_start(f, offset):
+    """
+    Byte offset of the first record of an uncompressed fastq file object starting at or after
+    offset. The file is only read from the offset, resyncing on the record structure: a record
+    starts at a line starting with @ whose second next line starts with +, which a quality line
+    starting with @ is never followed by.
+    """
+    f.seek(max(offset - 1, 0))
+    if offset and f.read(1) != b'\n':
+        f.readline()
+    pos = f.tell()
+    lines = [f.readline() for _ in range(3)]
+    while lines[0] and not (lines[0].startswith(b'@') and lines[2].startswith(b'+')):
+        pos += len(lines[0])
+        lines = lines[1:] + [f.readline()]
+    return pos
+
+
+def fastq_record_name(f, pos):
+    """Name of the record of an uncompressed fastq file object starting at pos, None at the end."""
+    f.seek(pos)
+    header = f.readline()
+    return header[1:].split(maxsplit=1)[0].decode() if header else None
+
+
+def paired_fastq_record_start(f, size, name, namepairidx, estimate, width=1 << 20):
+    """
+    Byte offset of the record of an uncompressed fastq file object paired with the record name,
+    searched in windows of growing width around the estimated offset. Names pair if they are
+    equal but at the indices namepairidx, see misc.get_namepair_index. None pairs the end of the
+    file.
+    """
+    if name is None:
+        return size
+    paired_name = misc.make_paired_name(name, namepairidx)
+    while True:
+        lo, hi = max(estimate - width, 0), min(estimate + width, size)
+        pos = fastq_record_start(f, lo)
+        while pos < hi:
+            other = fastq_record_name(f, pos)
+            if len(other) == len(name) and misc.make_paired_name(other, namepairidx) == paired_name:
+                return pos
+            for _ in range(3):
+                f.readline()
+            pos = f.tell()
+        if lo == 0 and hi == size:
+            raise ValueError(f'No record of {f.name} pairs with {name}')
+        width *= 4
+
+
+def fastq_shard_ranges(fpath1, fpath2, shard, nshards):
+    """
+    Ranges of the records of read shard `shard` of nshards of a pair of fastq files, split at
+    equal byte offsets of the first file. Each read shard computes the same boundaries, so the
+    shards partition the records.
+
+    Uncompressed files are read only around the boundaries: the first file is resynced on the
+    record structure at the offset, and the record paired with its first record is searched in
+    the second file around the same relative offset. Records of gzipped files can only be
+    counted from the start.
+
+    returns
+        :tuple: (byte offsets or record indices, (start, end) of each file, end None for the end of file)
+    """
+    size1 = os.path.getsize(fpath1)
+    offsets = [size1 * shard // nshards if shard else 0, size1 * (shard + 1) // nshards if shard + 1 < nshards else None]
+    if is_gzipped(fpath1) or is_gzipped(fpath2):
+        start, end = [fastq_record_boundary(fpath1, offset) if offset else offset for offset in offsets]
+        return False, [(start, end), (start, end)]
+    size2 = os.path.getsize(fpath2)
+    namepairidx = misc.get_namepair_index(fpath1, fpath2)
+    ranges = [[0, None], [0, None]]
+    with open(fpath1, 'rb') as f1, open(fpath2, 'rb') as f2:
+        for i, offset in enumerate(offsets):
+            if offset:
+                ranges[0][i] = fastq_record_start(f1, offset)
+                name = fastq_record_name(f1, ranges[0][i])
+                ranges[1][i] = paired_fastq_record_start(f2, size2, name, namepairidx, ranges[0][i] * size2 // max(size1, 1))
+    return True, [tuple(r) for r in ranges]
+
+
+def write_fastq_records(in_fpath, out_fpath, start, end, by_offset=False, bufsize=1 << 20):
+    """
+    Writes records start to end of a, possibly gzipped, fastq file uncompressed to out_fpath.
+    With by_offset, start and end are byte offsets of an uncompressed file, which is copied
+    from start on without reading the records before.
+    """
+    if by_offset:
+        with open(in_fpath, 'rb') as f, open(out_fpath, 'wb') as out:
+            f.seek(start)
+            remaining = (os.path.getsize(in_fpath) if end is None else end) - start
+            while remaining > 0:
+                buf = f.read(min(bufsize, remaining))
+                if not buf:
+                    break
+                out.write(buf)
+                remaining -= len(buf)
+        return
+    with (gzip.open(in_fpath, 'rb') if is_gzipped(in_fpath) else open(in_fpath, 'rb')) as f, \
+            open(out_fpath, 'wb') as out:
+        out.writelines(itertools.islice(f, 4 * start, None if end is None else 4 * end))
+
+
+def check_shard(arguments):
+    if not 0 <= arguments.shard < arguments.nshards:
+        raise ValueError(f'Shard {arguments.shard} out of range for {arguments.nshards} shards')
+
+
+def read_scatter_record(partial_dir):
+    fpath = os.path.join(partial_dir, scatter_fname)
+    if not os.path.exists(fpath):
+        raise ValueError(f'{partial_dir} holds no completed scatter output')
+    with open(fpath) as f:
+        return json.load(f)
+
+
+def write_scatter_record(partial_dir, record):
+    manifest.write_json_atomic(record, os.path.join(partial_dir, scatter_fname))
+
+
+def scatter_reads(arguments):
+    """
+    Processes read shard arguments.shard of arguments.nshards of every lane pair into a sorted,
+    indexed bam file, like count_RNA or count_gDNA up to counting. The records of each read shard
+    are extracted into fastqs of the output directory, which are removed once the shard is done.
+    """
+    check_shard(arguments)
+    modality = 'RNA' if arguments.command == 'scatter_RNA' else 'gDNA'
+    record = {'stage': 'reads', 'modality': modality, 'shard': arguments.shard, 'nshards': arguments.nshards}
+    if os.path.exists(os.path.join(arguments.output_dir, scatter_fname)):
+        if read_scatter_record(arguments.output_dir) != record:
+            raise ValueError(f'{arguments.output_dir} holds the output of another scatter run')
+        log.info('Read shard already done')
+        return
+
+    fastq_dir = os.path.join(arguments.output_dir, 'fastqs')
+    os.makedirs(fastq_dir, exist_ok=True)
+    for fpath1, fpath2 in misc.find_paired_fastqs_in_dir(arguments.fastq_dir):
+        by_offset, ranges = fastq_shard_ranges(fpath1, fpath2, arguments.shard, arguments.nshards)
+        for fpath, (start, end) in zip((fpath1, fpath2), ranges):
+            log.info(f'Extracting {"bytes" if by_offset else "records"} {start:,d}-{"end" if end is None else f"{end:,d}"} of {fpath}')
+            out_fpath = os.path.join(fastq_dir, os.path.basename(fpath[:-3] if fpath.endswith('.gz') else fpath))
+            if not os.path.exists(out_fpath):
+                # not a partial_fpath, which would be picked up as a fastq by an interrupted run
+                write_fastq_records(fpath, out_fpath + '.partial', start, end, by_offset)
+                os.replace(out_fpath + '.partial', out_fpath)
+
+    shard_arguments = arguments.updated({'<fastq_dir>': fastq_dir})
+    if modality == 'RNA':
+        process_RNA_fastqs(shard_arguments, count=False)
+    else:
+        process_gDNA_fastqs(shard_arguments, count=False)
+    shutil.rmtree(fastq_dir)
+    write_scatter_record(arguments.output_dir, record)
+
+
+def scatter_count(arguments):
+    """
+    Counts region shard arguments.shard of arguments.nshards of a sorted bam file gathered from
+    read shards. The genomic shards of the bam file are computed the same way by every region
+    shard and split into contiguous slices, which never split a feature. RNA reads get their UMIs
+    corrected, and the corrected reads of the region shard are written to its own bam file. Region
+    shards without genomic shards write empty outputs. The path, size and modification time of
+    the bam file are recorded, so that gather refuses region shards of different bam files.
+    """
+    check_shard(arguments)
+    os.makedirs(arguments.output_dir, exist_ok=True)
+    with pysam.AlignmentFile(arguments.SDR_bam_file) as bam:
+        read = next(bam.fetch(until_eof=True))
+    modality = 'RNA' if read.has_tag('UR') else 'gDNA'
+    record = {'stage': 'count', 'modality': modality, 'shard': arguments.shard, 'nshards': arguments.nshards,
+              'input': {'path': os.path.abspath(arguments.SDR_bam_file), **misc.file_stat(arguments.SDR_bam_file)}}
+    if os.path.exists(os.path.join(arguments.output_dir, scatter_fname)):
+        if read_scatter_record(arguments.output_dir) != record:
+            raise ValueError(f'{arguments.output_dir} holds the output of another scatter run')
+        log.info('Region shard already done')
+        return
+
+    for dirname in ('raw_reads_bc_matrix', 'raw_umis_bc_matrix'):
+        out_dir = os.path.join(arguments.output_dir, dirname)
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)  # left by an interrupted run
+    log.info(f'Counting region shard {arguments.shard} of {arguments.nshards} of {modality} bam file...')
+    region_shard = (arguments.shard, arguments.nshards)
+    if modality == 'RNA':
+        correct_UMIs_and_count(
+                arguments,
+                arguments.SDR_bam_file,
+                os.path.join(arguments.output_dir, umi_bam_fname),
+                region_shard=region_shard)
+    else:
+        gDNA_count_matrix(arguments, arguments.SDR_bam_file, region_shard=region_shard)
+    write_scatter_record(arguments.output_dir, record)
+
+
+def check_partials(partial_dirs):
+    """
+    Checks that the partial outputs are all shards of one scatter run, of the same bam file for
+    region shards, and returns their scatter record and the directories in shard order.
+    """
+    records = [read_scatter_record(partial_dir) for partial_dir in partial_dirs]
+    stages = {(record['stage'], record['modality'], record['nshards']) for record in records}
+    if len(stages) != 1:
+        raise ValueError('Partial outputs come from different scatter runs: ' + ', '.join(f'{stage} {modality} of {nshards}' for stage, modality, nshards in sorted(stages)))
+    stage, modality, nshards = stages.pop()
+    inputs = {json.dumps(record.get('input'), sort_keys=True) for record in records}
+    if len(inputs) != 1:
+        raise ValueError('Partial outputs count different bam files: ' + ', '.join(sorted(inputs)))
+    shards = sorted(record['shard'] for record in records)
+    if shards != list(range(nshards)):
+        missing = sorted(set(range(nshards)) - set(shards))
+        raise ValueError(f'Expected each of {nshards} shards once, missing {missing}' if missing else 'Shards given more than once')
+    dir_given_shard = {record['shard']: partial_dir for record, partial_dir in zip(records, partial_dirs)}
+    return records[0], [dir_given_shard[shard] for shard in range(nshards)]
+
+
+def merge_feature_extents(extents_fpaths, out_fpath):
+    """Merges the feature extents of the sorted bam files of read shards."""
+    recorder = misc.FeatureExtentRecorder()
+    for fpath in extents_fpaths:
+        for ref, extents in misc.load_feature_extents(fpath).items():
+            ref_extents = recorder.extents_given_ref[ref]
+            for feature, (first, last) in extents.items():
+                if feature in ref_extents:
+                    first = min(first, ref_extents[feature][0])
+                    last = max(last, ref_extents[feature][1])
+                ref_extents[feature] = (first, last)
+    recorder.save(out_fpath)
+
+
+def gather_reads(arguments, modality, partial_dirs):
+    """
+    Merges the sorted bam files of the read shards into one sorted, indexed bam file, with the
+    merged feature extents if every read shard recorded them.
+    """
+    in_fpaths = [os.path.join(partial_dir, sorted_bam_fnames[modality]) for partial_dir in partial_dirs]
+    out_fpath = os.path.join(arguments.output_dir, sorted_bam_fnames[modality])
+    log.info(f'Merging {len(in_fpaths):,d} bam files...')
+    with manifest.atomic_output(out_fpath) as tmp_out_fpath:
+        pysam.merge('-f', '-@', str(arguments.threads), tmp_out_fpath, *in_fpaths)
+    log.info('Indexing bam...')
+    manifest.index_bam(out_fpath)
+    extents_fpaths = [misc.feature_extents_fpath(fpath) for fpath in in_fpaths]
+    if all(os.path.exists(fpath) for fpath in extents_fpaths):
+        merge_feature_extents(extents_fpaths, misc.feature_extents_fpath(out_fpath))
+
+
+def gather_counts(arguments, modality, partial_dirs):
+    """
+    Merges the outputs of the region shards. Region shards hold disjoint features, so matrices
+    are merged like aggregate does, and the saturation tallies are summed. The UMI-corrected bam
+    files of RNA region shards are concatenated in shard order, which is coordinate order.
+    """
+    if modality == 'RNA':
+        out_fpath = os.path.join(arguments.output_dir, umi_bam_fname)
+        log.info(f'Concatenating {len(partial_dirs):,d} bam files...')
+        with manifest.atomic_output(out_fpath) as tmp_out_fpath:
+            misc.concatenate_bams([os.path.join(partial_dir, umi_bam_fname) for partial_dir in partial_dirs], tmp_out_fpath)
+        log.info('Indexing bam...')
+        manifest.index_bam(out_fpath)
+
+    dirnames = ['raw_reads_bc_matrix', 'raw_umis_bc_matrix'] if modality == 'RNA' else ['raw_reads_bc_matrix']
+    for dirname in dirnames:
+        log.info(f'Merging {dirname}...')
+        in_dirs = [os.path.join(partial_dir, dirname) for partial_dir in partial_dirs]
+        runs = [misc.read_matrix(in_dir) for in_dir in in_dirs]
+        umis = None
+        if dirname == 'raw_umis_bc_matrix':
+            M, sorted_complete_bcs, sorted_features, umis = merge_umi_matrices(runs, [misc.load_umi_sidecar(in_dir) for in_dir in in_dirs])
+        else:
+            M, sorted_complete_bcs, sorted_features = sum_matrices(runs)
+        log.info(f'  {len(sorted_features):,d} features, {len(sorted_complete_bcs):,d} barcodes')
+        out_dir = os.path.join(arguments.output_dir, dirname)
+        os.makedirs(out_dir, exist_ok=True)
+        misc.write_matrix(M, sorted_complete_bcs, sorted_features, out_dir, arguments.matrix_formats, arguments.threads)
+        if umis is not None:
+            misc.write_umi_sidecar(umis, out_dir)
+
+    if modality == 'RNA':
+        shard_tallies, shard_bcs = zip(*(saturation.load_tallies(partial_dir) for partial_dir in partial_dirs))
+        sorted_complete_bcs = sorted(set(bc for bcs in shard_bcs for bc in bcs))
+        saturation.write_saturation_report(saturation.merge_tallies(shard_tallies, shard_bcs, sorted_complete_bcs), arguments.output_dir)
+
+
+def gather(arguments):
+    """
+    Merges the partial outputs of all shards of a scatter_RNA, scatter_gDNA or scatter_count run.
+    """
+    record, partial_dirs = check_partials(arguments.partial_dirs)
+    os.makedirs(arguments.output_dir, exist_ok=True)
+    log.info(f'Gathering {len(partial_dirs):,d} {record["modality"]} {record["stage"]} shards')
+    if record['stage'] == 'reads':
+        gather_reads(arguments, record['modality'], partial_dirs)
+    else:
+        gather_counts(arguments, record['modality'], partial_dirs)
+    log.info('Done')
@@ -0,0 +1,190 @@
+import io
+import os
+import sys
+import json
+import signal
+import socket
+import logging
+import tempfile
+import traceback
+import contextlib
+from . import misc
+from . import star
+from .config import CommandLineArguments
+
+log = logging.getLogger(__name__)
+
+
+# Arguments holding paths, which are relative to the working directory of the client
+path_arguments = (
+    '<fastq_dir>', '<RNA_fastq_dir>', '<gDNA_fastq_dir>', '<SDR_bam_file>', '<count_dir>', '<partial_dir>',
+    '--STAR-ref-dir', '--STAR-output', '--config', '--RNA-config', '--gDNA-config', '--output-dir',
+    '--output-bam', '--amplicons', '--sites', '--fastq-prefix')
+# Commands whose STAR runs use the genomes kept loaded by the service
+genome_commands = ('count_RNA', 'count_gDNA', 'count_all')
+
+
+def absolute_paths(docopt_args, cwd):
+    """Makes the path arguments absolute, such that the worker processes find them."""
+    for key in path_arguments:
+        value = docopt_args.get(key)
+        if isinstance(value, list):
+            docopt_args[key] = [os.path.join(cwd, v) for v in value]
+        elif value is not None:
+            docopt_args[key] = os.path.join(cwd, value)
+
+
+class ClientLogHandler(logging.Handler):
+    """Sends the log records of a job to its client."""
+    def __init__(self, send, level):
+        super().__init__(level)
+        self._send = send
+
+    def emit(self, record):
+        try:
+            self._send(log=record.getMessage(), created=record.created)
+        except Exception:
+            self.handleError(record)
+
+
+class Service:
+    """
+    Runs the jobs sent to a Unix socket by SDRranger-client, one at a time in the order they
+    connect. The state that every invocation of SDRranger would otherwise build again is kept
+    between jobs: the imported modules, a pool of worker processes, the barcode decoders of every
+    barcode list used, in the service and in each worker, and the STAR genomes in shared memory.
+
+    A request is a JSON line with the command line arguments and working directory of the client.
+    The service answers with JSON lines of the log messages of the job and a last line with its
+    exit code and output.
+    """
+    def __init__(self, socket_fpath, threads, state_dir, stack):
+        self.socket_fpath = socket_fpath
+        self.threads = threads
+        self.state_dir = state_dir
+        self._stack = stack
+        self._genomes = {}
+
+    def genome(self, star_ref_dir):
+        """The STAR genome of star_ref_dir, kept in shared memory until the service exits."""
+        star_ref_dir = os.path.realpath(star_ref_dir)
+        if star_ref_dir not in self._genomes:
+            out_prefix = os.path.join(self.state_dir, f'genome_{len(self._genomes)}_')
+            self._genomes[star_ref_dir] = self._stack.enter_context(star.SharedGenome(star_ref_dir, out_prefix))
+        return self._genomes[star_ref_dir]
+
+    def parse(self, request):
+        """
+        returns
+            :tuple: (arguments, or None if the job ends with parsing, exit code, output)
+        """
+        from .main import parse_docopt_args
+
+        stdout = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(stdout):
+                docopt_args = parse_docopt_args(request['argv'])
+        except SystemExit as e:
+            # --help and --version print and exit, usage errors exit with the usage
+            if isinstance(e.code, str):
+                return None, 1, e.code
+            return None, e.code or 0, stdout.getvalue().rstrip('\n')
+        if docopt_args.get('serve'):
+            return None, 1, 'The service cannot run serve'
+        if docopt_args.get('--output-bam') == '-':
+            return None, 1, 'The service cannot write to standard output'
+        absolute_paths(docopt_args, request['cwd'])
+        return CommandLineArguments(docopt_args), 0, ''
+
+    def run(self, arguments, send):
+        from .main import commands
+
+        root_log = logging.getLogger()
+        handler = ClientLogHandler(send, arguments.log_level)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        level = root_log.level
+        root_log.addHandler(handler)
+        root_log.setLevel(min(level, arguments.log_level))
+        if arguments.threads != self.threads:
+            log.warning(f'The job runs on the {self.threads} worker processes of the service, not on a pool of --threads={arguments.threads}')
+        try:
+            command = commands[arguments.command]
+            if arguments.command in genome_commands and arguments.star_ref_dir and not arguments.star_output_path:
+                command(arguments, genome=self.genome(arguments.star_ref_dir))
+            else:
+                command(arguments)
+            return 0, ''
+        except Exception:
+            log.error(f'{arguments.command} failed')
+            return 1, traceback.format_exc().rstrip('\n')
+        finally:
+            root_log.removeHandler(handler)
+            root_log.setLevel(level)
+
+    def handle(self, conn):
+        with conn, conn.makefile('r') as reader, conn.makefile('w') as writer:
+            def send(**message):
+                writer.write(json.dumps(message) + '\n')
+                writer.flush()
+
+            request = json.loads(reader.readline())
+            log.info(f'Job: SDRranger {" ".join(request["argv"])} in {request["cwd"]}')
+            arguments, code, output = self.parse(request)
+            if arguments is not None:
+                cwd = os.getcwd()
+                os.chdir(request['cwd'])
+                try:
+                    code, output = self.run(arguments, send)
+                finally:
+                    os.chdir(cwd)
+            log.info(f'Job done with exit code {code}')
+            try:
+                send(exit=code, output=output)
+            except OSError:
+                log.warning('Client disconnected before the job was done')
+
+    def serve_forever(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(self.socket_fpath)
+            try:
+                server.listen()
+                log.info(f'Listening on {self.socket_fpath} with {self.threads} worker processes')
+                while True:
+                    conn, _ = server.accept()
+                    try:
+                        self.handle(conn)
+                    except Exception:
+                        log.error(f'Job failed:\n{traceback.format_exc()}')
+            finally:
+                os.remove(self.socket_fpath)
+
+
+def check_socket_free(socket_fpath):
+    """Removes a socket left by a service that is not running anymore."""
+    if not os.path.exists(socket_fpath):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_fpath)
+        except ConnectionRefusedError:
+            os.remove(socket_fpath)
+            return
+    raise ValueError(f'A service is already listening on {socket_fpath}')
+
+
+def serve(arguments):
+    """
+    Runs the service on arguments.socket until it is terminated, with a pool of arguments.threads
+    worker processes shared by all jobs. Jobs get their log messages sent at their own verbosity,
+    and the service logs the jobs it runs at its own.
+    """
+    socket_fpath = os.path.abspath(arguments.socket)
+    check_socket_free(socket_fpath)
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(arguments.log_level)
+    with contextlib.ExitStack() as stack:
+        state_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='SDRranger_service_'))
+        stack.enter_context(misc.shared_worker_pool(arguments.threads))
+        # after the workers are started, which keep the default handler
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        Service(socket_fpath, arguments.threads, state_dir, stack).serve_forever()
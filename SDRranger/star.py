@@ -0,0 +1,129 @@
+import os
+import time
+import signal
+import logging
+import threading
+import subprocess
+import pysam
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+# Options of a STAR run whose alignments are read as they are produced: uncompressed bam on
+# standard output, in the order of the input reads
+stream_options = [
+    '--outStd BAM_Unsorted',
+    '--outBAMcompression 0',
+    '--outSAMorder PairedKeepInputOrder',
+]
+
+
+class SharedGenome:
+    """
+    Keeps the STAR genome of star_ref_dir in shared memory while in use, so that the STAR runs of
+    all lanes attach to one loaded genome (--genomeLoad LoadAndKeep) instead of each loading it.
+
+    The genome is loaded by the first run that asks for its options, so resumed runs with all
+    alignments done load nothing. If it cannot be loaded into shared memory, runs load it
+    themselves as before. On exit, also on failure or SIGTERM, the genome is removed from shared
+    memory and the loading time saved is logged. Uses may be nested, like the pipelines of a
+    combined run within the run, and the genome is kept until the outermost use exits.
+    """
+    def __init__(self, star_ref_dir, out_prefix, enabled=True):
+        self.star_ref_dir = star_ref_dir
+        self.out_prefix = out_prefix
+        self.enabled = enabled
+        self.loaded = False
+        self.load_time = 0.0
+        self.nruns = 0
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._sigterm_handler = None
+
+    def _run_STAR(self, genome_load):
+        cmd_star = [
+            'STAR',
+            f'--genomeDir {self.star_ref_dir}',
+            f'--genomeLoad {genome_load}',
+            f'--outFileNamePrefix {self.out_prefix}',
+        ]
+        return subprocess.run(cmd_star, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    def _load(self):
+        os.makedirs(os.path.dirname(self.out_prefix), exist_ok=True)
+        log.info(f'Loading STAR genome {self.star_ref_dir} into shared memory...')
+        t0 = time.time()
+        result = self._run_STAR('LoadAndExit')
+        if result.returncode:
+            log.warning(f'Could not load STAR genome into shared memory, each run loads it:\n{result.stdout.strip()}')
+            self.enabled = False
+            return
+        self.loaded = True
+        self.load_time = time.time() - t0
+        log.info(f'STAR genome loaded in {self.load_time:.1f}s')
+
+    def star_options(self):
+        """STAR options of a run using the genome."""
+        with self._lock:
+            if self.enabled and not self.loaded:
+                self._load()
+            if not self.loaded:
+                return []
+            self.nruns += 1
+            return ['--genomeLoad LoadAndKeep']
+
+    def remove(self):
+        with self._lock:
+            if not self.loaded:
+                return
+            result = self._run_STAR('Remove')
+            self.loaded = False
+            if result.returncode:
+                log.warning(f'Could not remove STAR genome from shared memory:\n{result.stdout.strip()}')
+            if self.nruns > 1:
+                log.info(f'STAR genome loaded once for {self.nruns} runs, saving about {(self.nruns - 1) * self.load_time:.0f}s of genome loading')
+
+    def __enter__(self):
+        with self._lock:
+            self._depth += 1
+            if self._depth > 1:
+                return self
+        if self.enabled and threading.current_thread() is threading.main_thread():
+            self._sigterm_handler = signal.signal(signal.SIGTERM, _raise_system_exit)
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self._depth -= 1
+            if self._depth:
+                return
+        self.remove()
+        if self._sigterm_handler is not None:
+            signal.signal(signal.SIGTERM, self._sigterm_handler)
+            self._sigterm_handler = None
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+@contextmanager
+def stream(cmd_star):
+    """
+    Runs STAR with stream_options, yielding its alignments as an open bam file that is read while
+    STAR runs. STAR is stopped if reading fails, and a failed STAR run raises once its output is
+    read.
+    """
+    proc = subprocess.Popen(cmd_star + stream_options, stdout=subprocess.PIPE)
+    try:
+        with pysam.AlignmentFile(proc.stdout) as bam:
+            yield bam
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd_star)
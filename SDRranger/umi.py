@@ -1,28 +1,41 @@
 import pysam
 import numpy as np
-from .misc import DistanceThresh, gx_gn_tups_from_read
+from .misc import DistanceThresh, fetch_shard
+from .encoding import ReadEncoder, UMIEncoder
 from Bio import SeqIO
 from typing import Tuple, Dict
 from collections import Counter, defaultdict
-from scipy.sparse import lil_matrix
-from scipy.sparse.csgraph import connected_components
+from itertools import combinations
+from functools import lru_cache
+from heapq import heappush, heappop
 
 
 def get_umi_map_from_cntr(
         umi_cntr: Counter, 
         max_dist: int = 1, 
         dist_type: str = 'freediv',
-        connection_type: str = 'directional'
+        connection_type: str = 'directional',
+        umi_encoder: UMIEncoder = None
         ) -> dict:
     """
     Builds a dict from observed umis to connected component umi with max count.
+
+    With an umi_encoder, umi_cntr is keyed by encoded umis, which are only decoded for the
+    distance computations.
     """
+    if len(umi_cntr) == 1:
+        return {umi: umi for umi in umi_cntr}
     umi_list = list(umi_cntr.keys())
+    if umi_encoder is None:
+        seq_list, seq_cntr = umi_list, umi_cntr
+    else:
+        seq_list = [umi_encoder.decode(umi) for umi in umi_list]
+        seq_cntr = dict(zip(seq_list, umi_cntr.values()))
     if connection_type == 'undirected':
-        n_vals, component_array = get_connected_components(umi_list, max_dist=max_dist, dist_type=dist_type)
+        n_vals, component_array = get_connected_components(seq_list, max_dist=max_dist, dist_type=dist_type)
     else:
         assert connection_type == 'directional', connection_type
-        n_vals, component_array = get_directional_connected_components(umi_list, umi_cntr, max_dist=max_dist, dist_type=dist_type)
+        n_vals, component_array = get_directional_connected_components(seq_list, seq_cntr, max_dist=max_dist, dist_type=dist_type)
     component_max_umi = [None for _ in range(n_vals)]
     for umi, component in zip(umi_list, component_array):
         if component_max_umi[component] is None or umi_cntr[umi] > umi_cntr[component_max_umi[component]]:
@@ -30,35 +43,205 @@ def get_umi_map_from_cntr(
     umi_map = {umi: component_max_umi[component] for umi, component in zip(umi_list, component_array)}
     return umi_map
 
-def get_umi_maps_from_bam_file(
-        bam_fpath: str,
-        chrm: str = None,
-        start: int = None,
-        end: int = None,
+def get_encoded_umi_corrections(
+        reads,
+        feature_last_starts: dict,
+        encoder: ReadEncoder,
         max_dist: int = 1,
         dist_type: str = 'freediv',
-        connection_type: str = 'directional'
-        ) -> Dict[str, Counter]:
+        connection_type: str = 'directional',
+        deduplicator=None
+        ) -> Dict[tuple, dict]:
     """
-    Builds umi_map_given_bc_then_feature for reads from (specified region of) a given file.
+    Streams coordinate sorted reads and builds the umi corrections of each (cell, feature) group.
+
+    feature_last_starts gives the start of the last read of each feature. Once the scan has passed
+    it, the (cell, feature) groups of the feature are final and their umi counters are replaced by
+    their maps. Memory for counters is thus bounded by the features active at once. Only umis
+    that are corrected to a different umi are kept, all others map to themselves. Cell barcodes,
+    features and umis are ids of the encoder.
+
+    With a dedup.MoleculeDeduplicator, the representative read of each molecule is picked on the
+    way.
 
     returns
-        :dict: umi_map_given_bc_then_feature
+        :dict: (feature_id, bc_id) -> {umi: corrected_umi}
+    """
+    umi_corrections = {}
+    umi_cntr_given_feature_then_bc = {}
+    feature_ends = []
+
+    def finalize(feature_id):
+        umi_map_given_bc = {}
+        for bc_id, umi_cntr in umi_cntr_given_feature_then_bc.pop(feature_id).items():
+            umi_map = get_umi_map_from_cntr(umi_cntr, max_dist=max_dist, dist_type=dist_type, connection_type=connection_type, umi_encoder=encoder.umi)
+            corrections = {umi: corrected_umi for umi, corrected_umi in umi_map.items() if umi != corrected_umi}
+            if corrections:
+                umi_corrections[feature_id, bc_id] = corrections
+            umi_map_given_bc[bc_id] = umi_map
+        if deduplicator:
+            deduplicator.finalize(feature_id, umi_map_given_bc)
+
+    for read in reads:
+        feature_ids = encoder.feature_ids(read)
+        if not feature_ids:
+            continue
+        pos = read.reference_start
+        while feature_ends and feature_ends[0][0] < pos:
+            finalize(heappop(feature_ends)[1])
+        bc_id = encoder.cb_id(read)
+        umi = encoder.umi_code(read)
+        for feature_id in feature_ids:
+            if feature_id not in umi_cntr_given_feature_then_bc:
+                umi_cntr_given_feature_then_bc[feature_id] = defaultdict(Counter)
+                feature_last_start = feature_last_starts.get(encoder.feature.decode(feature_id), float('inf'))
+                heappush(feature_ends, (feature_last_start, feature_id))
+            umi_cntr_given_feature_then_bc[feature_id][bc_id][umi] += 1
+        if deduplicator:
+            deduplicator.add(read, bc_id, feature_ids[0], umi)
+    while feature_ends:
+        finalize(heappop(feature_ends)[1])
+
+    return umi_corrections
+
+def iter_reads_with_corrected_umis(
+        bam: pysam.AlignmentFile,
+        shard: tuple,
+        feature_last_starts: dict,
+        encoder: ReadEncoder,
+        max_dist: int = 1,
+        dist_type: str = 'freediv',
+        connection_type: str = 'directional',
+        deduplicator=None
+        ):
+    """
+    Corrects umis of the reads of a shard of a coordinate sorted bam file.
+
+    The shard is read twice: first to build the umi corrections with get_encoded_umi_corrections,
+    then to yield the reads in input order with their corrected umis. Only the corrections are held
+    in memory between the passes, never the reads. Reads without features are skipped. Cell
+    barcodes, features and umis are yielded as ids of the encoder.
+
+    yields
+        :tuple: (read, bc_id, feature_ids, corrected_umi)
     """
-    umi_cntr_given_bc_then_feature = defaultdict(lambda: defaultdict(Counter))
-    for read in pysam.AlignmentFile(bam_fpath).fetch(chrm, start, end):
-        bc = read.get_tag('CB')
-        umi = read.get_tag('UR')
-        for gx_gn_tup in gx_gn_tups_from_read(read):
-            umi_cntr_given_bc_then_feature[bc][gx_gn_tup][umi] += 1
+    umi_corrections = get_encoded_umi_corrections(
+            fetch_shard(bam, shard),
+            feature_last_starts,
+            encoder,
+            max_dist=max_dist,
+            dist_type=dist_type,
+            connection_type=connection_type,
+            deduplicator=deduplicator)
+    no_corrections = {}
+    for read in fetch_shard(bam, shard):
+        feature_ids = encoder.feature_ids(read)
+        if not feature_ids:
+            continue
+        bc_id = encoder.cb_id(read)
+        umi = encoder.umi_code(read)
+        corrected_umi = umi_corrections.get((feature_ids[0], bc_id), no_corrections).get(umi, umi)
+        yield read, bc_id, feature_ids, corrected_umi
+
+@lru_cache(maxsize=None)
+def get_dist_func(dist_type: str, max_dist: int) -> DistanceThresh:
+    """Aligner construction dominates for tiny groups, so share one per distance setting."""
+    return DistanceThresh(dist_type, max_dist)
 
-    umi_map_given_bc_then_feature = defaultdict(dict)
-    for bc, umi_cntr_given_feature in umi_cntr_given_bc_then_feature.items():
-        for feature, umi_cntr in umi_cntr_given_feature.items():
-            umi_map_given_bc_then_feature[bc][feature] = get_umi_map_from_cntr(umi_cntr, max_dist=max_dist, dist_type=dist_type, connection_type=connection_type)
+all_pairs_max_umis = 24  # below this many umis, comparing all pairs is cheaper than a neighbor index
+
+def get_deletion_neighborhood(
+        umi: str,
+        max_dist: int = 1,
+        dist_type: str = 'freediv',
+        key_len: int = None
+        ) -> set:
+    """
+    Keys of all sequences obtained by deleting up to max_dist bases from umi.
 
-    umi_map_given_bc_then_feature = dict(umi_map_given_bc_then_feature)
-    return umi_map_given_bc_then_feature
+    Two umis within levenshtein distance max_dist always share a key. For hamming distance the
+    deleted positions are part of the key, which only matches substitutions at the same positions.
+    Freediv ignores unaligned sequence at the ends, so its keys are truncated to key_len, which must
+    be at most the length of the shortest umi compared minus max_dist.
+    """
+    keys = set()
+    for ndel in range(min(max_dist, len(umi)) + 1):
+        for positions in combinations(range(len(umi)), ndel):
+            deleted = ''.join(c for i, c in enumerate(umi) if i not in positions)
+            if dist_type == 'hamming':
+                keys.add((positions, deleted))
+            elif dist_type == 'freediv':
+                keys.add(deleted[:key_len])
+            else:
+                keys.add(deleted)
+    return keys
+
+def get_candidate_pairs(
+        umis: list,
+        max_dist: int = 1,
+        dist_type: str = 'freediv'
+        ) -> set:
+    """
+    Index pairs (i, j), i < j, of umis that share a deletion neighborhood key.
+
+    A superset of all pairs within max_dist, found without comparing all pairs.
+    """
+    key_len = max(min(len(umi) for umi in umis) - max_dist, 0) if umis else 0
+    idxs_given_key = defaultdict(list)
+    for i, umi in enumerate(umis):
+        for key in get_deletion_neighborhood(umi, max_dist, dist_type, key_len):
+            idxs_given_key[key].append(i)
+    candidates = set()
+    for idxs in idxs_given_key.values():
+        if len(idxs) > 1:
+            candidates.update(combinations(idxs, 2))
+    return candidates
+
+def get_adjacent_pairs(
+        umis: list,
+        max_dist: int = 1,
+        dist_type: str = 'freediv'
+        ) -> list:
+    """
+    Sorted index pairs (i, j), i < j, of umis within max_dist.
+
+    Small groups are compared pairwise, larger groups only verify the candidate pairs from the
+    deletion neighborhood index.
+    """
+    dist_func = get_dist_func(dist_type, max_dist)
+    if len(umis) <= all_pairs_max_umis:
+        candidates = combinations(range(len(umis)), 2)
+    else:
+        candidates = sorted(get_candidate_pairs(umis, max_dist=max_dist, dist_type=dist_type))
+    return [(i, j) for i, j in candidates if dist_func(umis[i], umis[j]) is not False]
+
+def get_components_from_edges(
+        n: int,
+        edges: list
+        ) -> Tuple[int, np.array]:
+    """
+    Union-find over n nodes. Components are numbered in order of their first node.
+
+    returns
+        :int:       n_vals
+        :int_array: component_array
+    """
+    parent = list(range(n))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in edges:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    component_given_root = {}
+    component_array = np.empty(n, dtype=np.int32)
+    for i in range(n):
+        component_array[i] = component_given_root.setdefault(find(i), len(component_given_root))
+    return len(component_given_root), component_array
 
 def get_connected_components(
         umis: list, 
@@ -66,22 +249,19 @@ def get_connected_components(
         dist_type: str = 'freediv'
         ) -> Tuple[int, np.array]:
     """
-    Builds adjacency matrix of umis given max_dist and calls connected_componenets
+    Connected components of umis within max_dist of each other
 
     returns
         :int:       n_vals
         :int_array: component_array
     """
-    dist_func = DistanceThresh(dist_type, max_dist)
-
-    adj_mat = lil_matrix((len(umis), len(umis)), dtype=np.uint8)
-    for i, umi_i in enumerate(umis):
-        for j in range(i+1, len(umis)):
-            umi_j = umis[j]
-            if dist_func(umi_i, umi_j) is not False:
-                adj_mat[i, j] = 1
-                adj_mat[j, i] = 1
-    return connected_components(adj_mat)
+    if len(umis) == 1:
+        return 1, np.zeros(1, dtype=np.int32)
+    if len(umis) == 2:
+        if get_dist_func(dist_type, max_dist)(umis[0], umis[1]) is not False:
+            return 1, np.zeros(2, dtype=np.int32)
+        return 2, np.arange(2, dtype=np.int32)
+    return get_components_from_edges(len(umis), get_adjacent_pairs(umis, max_dist=max_dist, dist_type=dist_type))
 
 def get_directional_connected_components(
         umis: list,
@@ -90,36 +270,35 @@ def get_directional_connected_components(
         dist_type: str = 'freediv'
         ) -> Tuple[int, np.array]:
     """
-    Builds adjacency matrix of umis given max_dist and calls connected_componenets
+    Connected components of umis given directional edges between umis within max_dist
 
     returns
         :int:       n_vals
         :int_array: component_array
     """
-    dist_func = DistanceThresh(dist_type, max_dist)
-
-    # Build direction-based adjacency matrix: i->j if cnt_i >= 2*cnt_j - 1 as in umitools
-    adj_mat = lil_matrix((len(umis), len(umis)), dtype=np.uint8)
-    nonzero_rows_given_col = defaultdict(list)
-    for i, umi_i in enumerate(umis):
-        umi_i_cnt = umi_cntr[umi_i]
-        for j in range(i+1, len(umis)):
-            umi_j = umis[j]
-            umi_j_cnt = umi_cntr[umi_j]
-            if dist_func(umi_i, umi_j) is not False:
-                if umi_i_cnt >= 2 * umi_j_cnt - 1:
-                    adj_mat[i, j] = 1
-                    nonzero_rows_given_col[j].append(i)
-                elif umi_j_cnt >= 2 * umi_i_cnt - 1:
-                    adj_mat[j, i] = 1
-                    nonzero_rows_given_col[i].append(j)
-
-    # Only allow one incoming edge per node. Keep max count or random if equal.
-    for j, i_list in nonzero_rows_given_col.items():
-        if len(i_list) > 1:
-            max_i = max(i_list, key=lambda i: umi_cntr[umis[i]])
-            for i in i_list:
-                if i != max_i:
-                    adj_mat[i, j] = 0
-
-    return connected_components(adj_mat)
+    if len(umis) == 1:
+        return 1, np.zeros(1, dtype=np.int32)
+    if len(umis) == 2:
+        umi_0_cnt, umi_1_cnt = umi_cntr[umis[0]], umi_cntr[umis[1]]
+        if (umi_0_cnt >= 2 * umi_1_cnt - 1 or umi_1_cnt >= 2 * umi_0_cnt - 1) \
+                and get_dist_func(dist_type, max_dist)(umis[0], umis[1]) is not False:
+            return 1, np.zeros(2, dtype=np.int32)
+        return 2, np.arange(2, dtype=np.int32)
+
+    # Directional edges: i->j if cnt_i >= 2*cnt_j - 1 as in umitools.
+    # Only allow one incoming edge per node. Keep max count or first if equal.
+    # Pairs are sorted, so sources of each node are seen in ascending order.
+    source_given_target = {}
+    for i, j in get_adjacent_pairs(umis, max_dist=max_dist, dist_type=dist_type):
+        umi_i_cnt = umi_cntr[umis[i]]
+        umi_j_cnt = umi_cntr[umis[j]]
+        if umi_i_cnt >= 2 * umi_j_cnt - 1:
+            source, target, source_cnt = i, j, umi_i_cnt
+        elif umi_j_cnt >= 2 * umi_i_cnt - 1:
+            source, target, source_cnt = j, i, umi_j_cnt
+        else:
+            continue
+        if target not in source_given_target or source_cnt > umi_cntr[umis[source_given_target[target]]]:
+            source_given_target[target] = source
+
+    return get_components_from_edges(len(umis), source_given_target.items())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark of UMI clustering of single (cell, feature) groups, comparing the deletion neighborhood
+index of SDRranger.umi with comparing all pairs of UMIs.
+
+Groups are made of random UMIs, each with a few reads, and of copies of them with one error in a
+fraction of the reads. Both methods must give identical UMI maps.
+
+Usage:
+  umi_clustering.py [--sizes=<>] [--all-pairs-max=<>] [--umi-length=<>] [--max-dist=<>] [--dist-type=<>] [--connection-type=<>] [--seed=<>]
+
+Options:
+  --sizes=<>            Comma-separated numbers of distinct true UMIs per group [default: 1000,3000,10000,30000,100000].
+  --all-pairs-max=<>    Largest group also clustered by comparing all pairs [default: 3000].
+  --umi-length=<>       UMI length [default: 10].
+  --max-dist=<>         Maximum distance of UMIs of one molecule [default: 1].
+  --dist-type=<>        hamming, levenshtein or freediv [default: freediv].
+  --connection-type=<>  directional or undirected [default: directional].
+  --seed=<>             Random seed [default: 42].
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+from docopt import docopt
+
+from SDRranger import umi
+
+alphabet = np.array(list('ACGT'))
+
+
+def simulate_umi_counter(nmolecules, umi_length, rng, error_fraction=0.1):
+    """Read counts of nmolecules random umis and of their single substitution or deletion errors."""
+    umi_cntr = Counter()
+    seqs = rng.choice(alphabet, size=(nmolecules, umi_length))
+    for seq, nreads in zip(seqs, rng.geometric(0.3, size=nmolecules)):
+        true_umi = ''.join(seq)
+        for _ in range(nreads):
+            read_umi = true_umi
+            if rng.random() < error_fraction:
+                pos = rng.integers(umi_length)
+                if rng.random() < 0.5:
+                    read_umi = true_umi[:pos] + rng.choice(alphabet) + true_umi[pos + 1:]
+                else:
+                    read_umi = true_umi[:pos] + true_umi[pos + 1:]
+            umi_cntr[read_umi] += 1
+    return umi_cntr
+
+
+@contextmanager
+def all_pairs():
+    all_pairs_max_umis = umi.all_pairs_max_umis
+    umi.all_pairs_max_umis = float('inf')
+    try:
+        yield
+    finally:
+        umi.all_pairs_max_umis = all_pairs_max_umis
+
+
+def timed_umi_map(umi_cntr, **kwargs):
+    start = time.perf_counter()
+    umi_map = umi.get_umi_map_from_cntr(umi_cntr, **kwargs)
+    return umi_map, time.perf_counter() - start
+
+
+def main():
+    arguments = docopt(__doc__)
+    rng = np.random.default_rng(int(arguments['--seed']))
+    kwargs = dict(
+            max_dist=int(arguments['--max-dist']),
+            dist_type=arguments['--dist-type'],
+            connection_type=arguments['--connection-type'])
+    all_pairs_max = int(arguments['--all-pairs-max'])
+
+    print(f'{"molecules":>10s} {"UMIs":>10s} {"all pairs":>10s} {"index":>10s}')
+    for size in map(int, arguments['--sizes'].split(',')):
+        umi_cntr = simulate_umi_counter(size, int(arguments['--umi-length']), rng)
+        index_map, index_time = timed_umi_map(umi_cntr, **kwargs)
+        all_pairs_str = '-'
+        if size <= all_pairs_max:
+            with all_pairs():
+                all_pairs_map, all_pairs_time = timed_umi_map(umi_cntr, **kwargs)
+            if all_pairs_map != index_map:
+                raise RuntimeError(f'UMI maps differ for {size:,d} molecules')
+            all_pairs_str = f'{all_pairs_time:.2f}s'
+        print(f'{size:>10,d} {len(umi_cntr):>10,d} {all_pairs_str:>10s} {index_time:>9.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -25,7 +25,8 @@ if __name__ == '__main__':
         version=get_version("SDRranger/__init__.py"),
         entry_points={
           'console_scripts': [
-              'SDRranger = SDRranger.main:main'
+              'SDRranger = SDRranger.main:main',
+              'SDRranger-client = SDRranger.client:main'
           ]
         },
         include_package_data=True,
@@ -39,6 +40,9 @@ if __name__ == '__main__':
             "freebarcodes>=3.1.0",
             "pywfa @ git+https://github.com/kcleal/pywfa.git@master"
             ],
+        extras_require={
+            "h5": ["h5py"],
+            },
         zip_safe=False,
         author='John Hawkins',
         author_email='hawkjo@gmail.com',
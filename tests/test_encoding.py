@@ -0,0 +1,44 @@
+import random
+from itertools import product
+from SDRranger.encoding import UMIEncoder, CBEncoder
+
+
+def test_umi_round_trip():
+    rng = random.Random(0)
+    packed = [''] + [''.join(rng.choice('ACGT') for _ in range(length)) for length in range(1, UMIEncoder.max_packed_len + 1) for _ in range(5)]
+    interned = ['ACGTN', 'ACGT.TTGA', 'A' * (UMIEncoder.max_packed_len + 1), 'NNNN']
+    encoder = UMIEncoder()
+    codes = [encoder.encode(umi) for umi in packed + interned]
+    assert [encoder.decode(code) for code in codes] == packed + interned
+    assert len(set(codes)) == len(set(packed + interned))  # lengths are kept apart, e.g. 'A' and 'AA'
+    assert all(code < UMIEncoder.interned_bit for code in codes[:len(packed)])
+    assert all(code & UMIEncoder.interned_bit for code in codes[len(packed):])
+    assert encoder.interned == interned
+    assert [encoder.encode(umi) for umi in interned] == codes[len(packed):]  # interned once
+
+
+def test_stable_code():
+    umis = ['ACGT', 'ACGTN', 'ACGT.TTGA', 'NNNN']
+    encoder, other_encoder = UMIEncoder(), UMIEncoder()
+    codes = [encoder.encode(umi) for umi in umis]
+    other_codes = [other_encoder.encode(umi) for umi in reversed(umis)][::-1]
+    assert codes[1:] != other_codes[1:]  # interned in a different order
+    stable_codes = [encoder.stable_code(code) for code in codes]
+    assert stable_codes == [other_encoder.stable_code(code) for code in other_codes]
+    assert stable_codes[0] == codes[0]  # packed umis are their own stable code
+    assert all(code & UMIEncoder.interned_bit for code in stable_codes[1:])
+    assert len(set(stable_codes)) == len(umis)
+
+    # an encoder built from the interned umis of another decodes its codes
+    restored = UMIEncoder(encoder.interned)
+    assert [restored.decode(code) for code in codes] == umis
+
+
+def test_cb_round_trip():
+    rng = random.Random(0)
+    whitelists = [[''.join(rng.choice('ACGT') for _ in range(8)) for _ in range(n)] for n in (3, 4, 5)]
+    encoder = CBEncoder(whitelists)
+    assert encoder.size == 3 * 4 * 5
+    cbs = ['.'.join(bcs) for bcs in product(*whitelists)]
+    assert [encoder.encode(cb) for cb in cbs] == list(range(encoder.size))
+    assert [encoder.decode(cb_id) for cb_id in range(encoder.size)] == cbs
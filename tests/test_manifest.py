@@ -0,0 +1,65 @@
+import os
+import pytest
+from SDRranger import manifest
+
+
+def read(fpath):
+    with open(fpath, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def run(tmp_path):
+    """A started run with two chunked outputs, of which two chunks completed and a third was cut off."""
+    input_fpath = tmp_path / 'R1.fq'
+    input_fpath.write_text('@r\nACGT\n+\nFFFF\n')
+    output_dir = tmp_path / 'out'
+    run_manifest = manifest.RunManifest(str(output_dir), 'RNA', [str(input_fpath)], 'config')
+    fpaths = [str(output_dir / 'lane.tags'), str(output_dir / 'lane.bam')]
+    for chunk in range(2):
+        for fpath in fpaths:
+            with open(fpath, 'ab') as f:
+                f.write(f'chunk {chunk} of {fpath}\n'.encode())
+        run_manifest.mark_chunk('barcodes_0', [os.path.getsize(fpath) for fpath in fpaths])
+    completed = [read(fpath) for fpath in fpaths]
+    for fpath in fpaths:
+        with open(fpath, 'ab') as f:
+            f.write(b'chunk 2, interrupted')
+    return input_fpath, output_dir, fpaths, completed
+
+
+def rerun(input_fpath, output_dir):
+    return manifest.RunManifest(str(output_dir), 'RNA', [str(input_fpath)], 'config')
+
+
+def test_resume_after_completed_chunks(run):
+    input_fpath, output_dir, fpaths, completed = run
+    run_manifest = rerun(input_fpath, output_dir)
+    assert manifest.resume_chunks(run_manifest, 'barcodes_0', fpaths) == 2
+    assert [read(fpath) for fpath in fpaths] == completed
+    assert len(rerun(input_fpath, output_dir).done_chunks('barcodes_0')) == 2
+
+
+def test_restart_with_truncated_outputs(run):
+    input_fpath, output_dir, fpaths, completed = run
+    with open(fpaths[1], 'r+b') as f:
+        f.truncate(len(completed[1]) - 1)
+    run_manifest = rerun(input_fpath, output_dir)
+    assert manifest.resume_chunks(run_manifest, 'barcodes_0', fpaths) == 0
+    assert not any(map(os.path.exists, fpaths))
+    assert rerun(input_fpath, output_dir).done_chunks('barcodes_0') == []
+
+
+def test_restart_without_manifest(run):
+    input_fpath, output_dir, fpaths, completed = run
+    assert manifest.resume_chunks(None, 'barcodes_0', fpaths) == 0
+    assert not any(map(os.path.exists, fpaths))
+
+
+def test_completed_stage_drops_chunks(run):
+    input_fpath, output_dir, fpaths, completed = run
+    run_manifest = rerun(input_fpath, output_dir)
+    manifest.resume_chunks(run_manifest, 'barcodes_0', fpaths)
+    run_manifest.mark_done('barcodes_0', fpaths)
+    assert rerun(input_fpath, output_dir).is_done('barcodes_0', fpaths)
+    assert rerun(input_fpath, output_dir).done_chunks('barcodes_0') == []
@@ -0,0 +1,90 @@
+import os
+import json
+import random
+import numpy as np
+import pysam
+from SDRranger import misc
+from SDRranger.config import CommandLineArguments
+from SDRranger.main import parse_docopt_args
+from SDRranger.RNAcount import RNA_count_matrix, correct_UMIs_and_count
+
+
+config_fpath = os.path.join(os.path.dirname(__file__), '..', 'examples', 'cDNA.json')
+
+
+def write_bam(fpath, with_ub=True, nreads=300, seed=0):
+    """A small coordinate sorted bam file of umi tagged reads, with a feature on both references."""
+    rng = random.Random(seed)
+    refs = [('chr1', 50000), ('chr2', 50000)]
+    features = [(0, 1000, 'G1'), (0, 20000, 'G2'), (1, 1000, 'G3'), (1, 20000, 'G1')]
+    cbs = [''.join(rng.choice('ACGT') for _ in range(8)) for _ in range(4)]
+    reads = []
+    for i in range(nreads):
+        tid, start, gx = rng.choice(features)
+        read = pysam.AlignedSegment()
+        read.query_name = f'r{i}'
+        read.query_sequence = 'A' * 50
+        read.reference_id = tid
+        read.reference_start = start + rng.randrange(1000)
+        read.mapping_quality = 255
+        read.cigarstring = '50M'
+        cb = rng.choice(cbs)
+        umi = ''.join(rng.choice('AC') for _ in range(3))
+        tags = [('CB', cb), ('CR', cb), ('GX', gx), ('GN', gx.lower()), ('UR', umi)]
+        if with_ub:
+            tags.append(('UB', umi))
+        read.set_tags(tags)
+        reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': ref, 'LN': length} for ref, length in refs]}
+    with pysam.AlignmentFile(fpath, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+    pysam.index(fpath)
+    return reads
+
+
+def count(bam_fpath, out_dir, with_read_table=False, umi_max_dist=None):
+    argv = ['count_matrix', bam_fpath, f'--output-dir={out_dir}', '--threads=1']
+    if umi_max_dist is not None:
+        argv.append(f'--umi-max-dist={umi_max_dist}')
+    arguments = CommandLineArguments(parse_docopt_args(argv))
+    RNA_count_matrix(arguments, bam_fpath, with_read_table=with_read_table)
+    return out_dir
+
+
+def assert_same_counts(out_dir, other_out_dir):
+    for dirname in ['raw_reads_bc_matrix', 'raw_umis_bc_matrix']:
+        M, bcs, features = misc.read_matrix(str(out_dir / dirname))
+        M_other, bcs_other, features_other = misc.read_matrix(str(other_out_dir / dirname))
+        assert (bcs, features) == (bcs_other, features_other)
+        assert (M != M_other).nnz == 0
+    assert np.array_equal(misc.load_umi_sidecar(str(out_dir / 'raw_umis_bc_matrix')), misc.load_umi_sidecar(str(other_out_dir / 'raw_umis_bc_matrix')))
+    assert json.loads((out_dir / 'saturation.json').read_text()) == json.loads((other_out_dir / 'saturation.json').read_text())
+
+
+def test_table_counts_match_bam_counts(tmp_path):
+    bam_fpath = str(tmp_path / 'in.bam')
+    reads = write_bam(bam_fpath)
+    from_bam = count(bam_fpath, tmp_path / 'bam', with_read_table=True)
+    from_table = count(bam_fpath, tmp_path / 'table')
+
+    assert_same_counts(from_bam, from_table)
+
+    # umis of G1 are counted once per barcode, although its reads are on both references
+    M, bcs, features = misc.read_matrix(str(from_bam / 'raw_umis_bc_matrix'))
+    molecules = {(read.get_tag('CB'), read.get_tag('GX'), read.get_tag('UB')) for read in reads}
+    i = [gx for gx, gn in features].index('G1')
+    for j, bc in enumerate(bcs):
+        assert M[i, j] == sum(1 for cb, gx, umi in molecules if (cb, gx) == (bc, 'G1'))
+
+
+def test_table_correction_matches_bam_correction(tmp_path):
+    bam_fpath = str(tmp_path / 'in.bam')
+    write_bam(bam_fpath, with_ub=False)
+    corrected_dir = tmp_path / 'corrected'
+    corrected_dir.mkdir()
+    arguments = CommandLineArguments(parse_docopt_args(['count_RNA', 'R1.fq', '--STAR-output=STAR', f'--config={config_fpath}', f'--output-dir={corrected_dir}', '--threads=1']))
+    out_bam_fpath = str(corrected_dir / 'out.bam')
+    correct_UMIs_and_count(arguments, bam_fpath, out_bam_fpath)
+    assert_same_counts(corrected_dir, count(out_bam_fpath, tmp_path / 'recorrected', umi_max_dist=1))
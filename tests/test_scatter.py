@@ -0,0 +1,96 @@
+import gzip
+import random
+import pysam
+import pytest
+from SDRranger import misc
+from SDRranger.config import CommandLineArguments
+from SDRranger.main import parse_docopt_args
+from SDRranger.scatter import scatter_count, gather, fastq_shard_ranges, write_fastq_records
+
+
+def run(argv):
+    arguments = CommandLineArguments(parse_docopt_args(argv))
+    {'scatter_count': scatter_count, 'gather': gather}[arguments.command](arguments)
+
+
+def write_bam(fpath, rna, nreads=200, seed=0):
+    """A small coordinate sorted bam file of tagged reads on a few features."""
+    rng = random.Random(seed)
+    refs = [('chr1', 100000), ('chr2', 50000)]
+    features = [(tid, start, f'G{tid}_{start}') for tid, (ref, length) in enumerate(refs) for start in range(1000, length - 5000, 20000)]
+    cbs = [''.join(rng.choice('ACGT') for _ in range(8)) for _ in range(5)]
+    reads = []
+    for i in range(nreads):
+        tid, start, gx = rng.choice(features)
+        read = pysam.AlignedSegment()
+        read.query_name = f'r{i}'
+        read.query_sequence = 'A' * 50
+        read.reference_id = tid
+        read.reference_start = start + rng.randrange(1000)
+        read.mapping_quality = 255
+        read.cigarstring = '50M'
+        cb = rng.choice(cbs)
+        tags = [('CB', cb), ('CR', cb), ('GX', gx), ('GN', gx.lower())]
+        if rna:
+            tags.append(('UR', ''.join(rng.choice('AC') for _ in range(4))))
+        read.set_tags(tags)
+        reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': ref, 'LN': length} for ref, length in refs]}
+    with pysam.AlignmentFile(fpath, 'wb', header=header) as bam:
+        for read in reads:
+            bam.write(read)
+    pysam.index(fpath)
+
+
+def scatter_and_gather(bam_fpath, nshards, out_dir):
+    partial_dirs = [str(out_dir / f'partial_{shard}') for shard in range(nshards)]
+    for shard, partial_dir in enumerate(partial_dirs):
+        run(['scatter_count', bam_fpath, f'--shard={shard}', f'--nshards={nshards}', f'--output-dir={partial_dir}', '--threads=1'])
+    run(['gather', *partial_dirs, f'--output-dir={out_dir / "gathered"}', '--threads=1'])
+    return out_dir / 'gathered'
+
+
+@pytest.mark.parametrize('rna', [True, False])
+def test_more_region_shards_than_shards(tmp_path, rna):
+    bam_fpath = str(tmp_path / 'in.bam')
+    write_bam(bam_fpath, rna)
+    nshards = 16
+    assert len(misc.get_genomic_shards(bam_fpath, nshards * misc.shards_per_region)) < nshards  # some slices are empty
+    single = scatter_and_gather(bam_fpath, 1, tmp_path / 'single')
+    sharded = scatter_and_gather(bam_fpath, nshards, tmp_path / 'sharded')
+
+    for dirname in ['raw_reads_bc_matrix', 'raw_umis_bc_matrix'] if rna else ['raw_reads_bc_matrix']:
+        M, bcs, features = misc.read_matrix(str(sharded / dirname))
+        M_single, bcs_single, features_single = misc.read_matrix(str(single / dirname))
+        assert (bcs, features) == (bcs_single, features_single)
+        assert (M != M_single).nnz == 0
+    if rna:
+        with pysam.AlignmentFile(str(sharded / 'RNA_with_bc_umi.sorted.bam')) as bam, \
+                pysam.AlignmentFile(str(single / 'RNA_with_bc_umi.sorted.bam')) as bam_single:
+            assert [read.query_name for read in bam] == [read.query_name for read in bam_single]
+
+
+@pytest.mark.parametrize('gzipped', [False, True])
+def test_fastq_shards_partition_records(tmp_path, gzipped):
+    rng = random.Random(0)
+    fpaths, contents = [tmp_path / 'R1.fq', tmp_path / 'R2.fq'], [[], []]
+    for i in range(2000):
+        name = f'M:{rng.randrange(10 ** rng.randrange(1, 6))}:{i}'
+        for mate, length, content in zip('12', (28, rng.randrange(40, 150)), contents):
+            content.append(f'@{name} {mate}:N:0\n{"A" * length}\n+\n{"".join(rng.choice("@+#F") for _ in range(length))}\n')
+    for fpath, content in zip(fpaths, contents):
+        with (gzip.open if gzipped else open)(fpath, 'wt') as f:
+            f.write(''.join(content))
+
+    nshards = 7
+    shard_contents = [[], []]
+    for shard in range(nshards):
+        by_offset, ranges = fastq_shard_ranges(str(fpaths[0]), str(fpaths[1]), shard, nshards)
+        assert by_offset != gzipped
+        for fpath, (start, end), shards in zip(fpaths, ranges, shard_contents):
+            write_fastq_records(str(fpath), str(tmp_path / 'out.fq'), start, end, by_offset)
+            shards.append((tmp_path / 'out.fq').read_text())
+    for content, shards in zip(contents, shard_contents):
+        assert ''.join(shards) == ''.join(content)
+    assert [shard.count('\n') for shard in shard_contents[0]] == [shard.count('\n') for shard in shard_contents[1]]
@@ -0,0 +1,71 @@
+import os
+import re
+import signal
+import logging
+import pytest
+from SDRranger.star import SharedGenome
+
+
+stub_STAR = """#!/bin/sh
+echo "$@" >> "$STAR_STUB_LOG"
+case "$*" in
+    *LoadAndExit*)
+        if [ -n "$STAR_STUB_FAIL" ]; then
+            echo "EXITING because of fatal ERROR: could not create shared memory segment"
+            exit 1
+        fi
+        sleep 0.2;;
+esac
+"""
+
+
+@pytest.fixture
+def star_calls(tmp_path, monkeypatch):
+    """Puts a stub STAR on the PATH and returns a function listing the --genomeLoad of its calls."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'STAR').write_text(stub_STAR)
+    (bin_dir / 'STAR').chmod(0o755)
+    log_fpath = tmp_path / 'STAR.log'
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('STAR_STUB_LOG', str(log_fpath))
+
+    def calls():
+        if not log_fpath.exists():
+            return []
+        return [re.search(r'--genomeLoad (\w+)', line).group(1) for line in log_fpath.read_text().splitlines()]
+    return calls
+
+
+def test_genome_loaded_once_for_nested_uses(tmp_path, star_calls, caplog):
+    caplog.set_level(logging.INFO)
+    sigterm_handler = signal.getsignal(signal.SIGTERM)
+    with SharedGenome(str(tmp_path / 'ref'), str(tmp_path / 'out' / 'genome_')) as genome:
+        assert star_calls() == []
+        with genome:
+            assert genome.star_options() == ['--genomeLoad LoadAndKeep']
+            assert genome.star_options() == ['--genomeLoad LoadAndKeep']
+        assert star_calls() == ['LoadAndExit']  # kept until the outermost use exits
+        assert genome.star_options() == ['--genomeLoad LoadAndKeep']
+    assert star_calls() == ['LoadAndExit', 'Remove']
+    assert signal.getsignal(signal.SIGTERM) == sigterm_handler
+
+    saved = re.search(r'STAR genome loaded once for 3 runs, saving about (\d+)s', caplog.text)
+    assert saved and int(saved.group(1)) == round(2 * genome.load_time)
+    assert genome.load_time >= 0.2
+
+
+def test_genome_not_loaded_without_runs(tmp_path, star_calls):
+    with SharedGenome(str(tmp_path / 'ref'), str(tmp_path / 'out' / 'genome_')):
+        pass
+    assert star_calls() == []
+
+
+def test_runs_load_genome_without_shared_memory(tmp_path, star_calls, monkeypatch, caplog):
+    monkeypatch.setenv('STAR_STUB_FAIL', '1')
+    with SharedGenome(str(tmp_path / 'ref'), str(tmp_path / 'out' / 'genome_')) as genome:
+        assert genome.star_options() == []
+        assert genome.star_options() == []
+    assert star_calls() == ['LoadAndExit']  # tried once, nothing to remove
+    assert 'Could not load STAR genome into shared memory' in caplog.text
+    assert 'could not create shared memory segment' in caplog.text
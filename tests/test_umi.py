@@ -0,0 +1,51 @@
+import random
+from itertools import combinations
+import numpy as np
+import pytest
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from SDRranger import umi
+from SDRranger.misc import DistanceThresh
+
+
+def mutated_umis(rng, n, length, max_dist, indels):
+    """Umis within a few edits of some seeds, so that many pairs are within max_dist."""
+    seeds = [''.join(rng.choice('ACGT') for _ in range(length)) for _ in range(4)]
+    umis = set()
+    while len(umis) < n:
+        seq = list(rng.choice(seeds))
+        for _ in range(rng.randint(0, max_dist + 1)):
+            pos = rng.randrange(len(seq))
+            edit = rng.choice('sid' if indels else 's')
+            if edit == 's':
+                seq[pos] = rng.choice('ACGT')
+            elif edit == 'i':
+                seq.insert(pos, rng.choice('ACGT'))
+            elif len(seq) > 1:
+                del seq[pos]
+        umis.add(''.join(seq))
+    return sorted(umis)
+
+
+@pytest.mark.parametrize('dist_type', ['hamming', 'levenshtein', 'freediv'])
+@pytest.mark.parametrize('max_dist', [1, 2])
+def test_adjacent_pairs_match_all_pairs(dist_type, max_dist):
+    rng = random.Random(max_dist)
+    umis = mutated_umis(rng, 4 * umi.all_pairs_max_umis, 10, max_dist, indels=dist_type != 'hamming')
+    dist_func = DistanceThresh(dist_type, max_dist)
+    expected = [(i, j) for i, j in combinations(range(len(umis)), 2) if dist_func(umis[i], umis[j]) is not False]
+    assert expected  # the umis are close enough to have neighbors
+    assert umi.get_adjacent_pairs(umis, max_dist=max_dist, dist_type=dist_type) == expected
+
+
+@pytest.mark.parametrize('dist_type', ['hamming', 'levenshtein', 'freediv'])
+def test_components_match_scipy(dist_type):
+    umis = mutated_umis(random.Random(0), 4 * umi.all_pairs_max_umis, 10, 1, indels=dist_type != 'hamming')
+    edges = umi.get_adjacent_pairs(umis, dist_type=dist_type)
+    n_vals, component_array = umi.get_connected_components(umis, dist_type=dist_type)
+    rows, cols = np.array(edges).T
+    graph = scipy.sparse.coo_matrix((np.ones(len(edges)), (rows, cols)), shape=(len(umis), len(umis)))
+    expected_n_vals, expected_component_array = connected_components(graph, directed=False)
+    assert n_vals == expected_n_vals
+    # components are numbered in order of their first umi by both
+    assert np.array_equal(component_array, expected_component_array)